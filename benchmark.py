@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='Benchmarks for GEGAN')
+parser.add_argument('--mode', dest='mode', type=str, default='startup',
+                    help='benchmark to run: startup, scaling, autotune, recompute, specialize, restart, precision, '
+                         'style_search, preview')
+parser.add_argument('--target', dest='target', type=str, default='export,infer,train',
+                    help='targets to measure or tune, separate by comma')
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=16, help='number of examples in batch')
+parser.add_argument('--inst_norm', dest='inst_norm', type=int, default=0,
+                    help='use conditional instance normalization in your model')
+parser.add_argument('--experiment_dir', dest='experiment_dir', type=str, default='benchmark_experiment',
+                    help='scratch experiment directory for the training benchmarks')
+parser.add_argument('--workers', dest='workers', type=str, default='1,2,4,8',
+                    help='numbers of data parallel workers to measure, separate by comma')
+parser.add_argument('--steps', dest='steps', type=int, default=20, help='training steps for each measurement')
+parser.add_argument('--cpu_profile', dest='cpu_profile', type=str, default='cpu_profile.json',
+                    help='where autotune records the cpu profile')
+parser.add_argument('--memory_cap', dest='memory_cap', type=float, default=None,
+                    help='peak memory in MB a tuned configuration is allowed to use')
+parser.add_argument('--batch_sizes', dest='batch_sizes', type=str, default='8,16,32,64',
+                    help='batch sizes autotune tries, separate by comma')
+parser.add_argument('--recompute_configs', dest='recompute_configs', type=str,
+                    default='none;encoder;decoder;vgg;encoder,decoder,vgg',
+                    help='recompute settings to compare, separate by semicolon')
+parser.add_argument('--recompute', dest='recompute', type=str, default='', help=argparse.SUPPRESS)
+parser.add_argument('--intra_op_threads', dest='intra_op_threads', type=int, default=0, help=argparse.SUPPRESS)
+parser.add_argument('--inter_op_threads', dest='inter_op_threads', type=int, default=0, help=argparse.SUPPRESS)
+parser.add_argument('--model_dir', dest='model_dir', type=str, default=None,
+                    help='directory that saves the model checkpoints, for the inference benchmarks')
+parser.add_argument('--embedding_id', dest='embedding_id', type=int, default=0, help='style used by inference benchmarks')
+parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='number of runs for each measurement')
+parser.add_argument('--styles', dest='styles', type=str, default='1000,5000,20000',
+                    help='numbers of indexed styles style_search measures, separate by comma')
+parser.add_argument('--preview_factor', dest='preview_factor', type=int, default=4,
+                    help='preview benchmark: the preview is image_size / preview_factor')
+parser.add_argument('--image_size', dest='image_size', type=int, default=64, help='preview benchmark: image size')
+parser.add_argument('--graph_cache', dest='graph_cache', type=int, default=1, help=argparse.SUPPRESS)
+parser.add_argument('--precision', dest='precision', type=str, default='float32', help=argparse.SUPPRESS)
+parser.add_argument('--child', dest='child', type=int, default=0, help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+
+def startup_child(target):
+    """
+    Measure the startup phases of one target, runs in a fresh interpreter
+    so that import time is accounted for
+    """
+    timings = dict()
+    start = time.time()
+    import tensorflow as tf
+    timings["import_tf"] = time.time() - start
+
+    tick = time.time()
+    from model.gegan import GEGAN
+    timings["import_model"] = time.time() - tick
+
+    tick = time.time()
+    model = GEGAN(batch_size=args.batch_size)
+    timings["construct"] = time.time() - tick
+
+    tick = time.time()
+    model.build_model(is_training=(target == "train"), inst_norm=args.inst_norm)
+    if target == "train":
+        # what every target used to pay for in the constructor
+        model.get_train_dataloader()
+    timings["build"] = time.time() - tick
+
+    tick = time.time()
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+    timings["session"] = time.time() - tick
+
+    timings["total"] = time.time() - start
+    print(json.dumps(timings))
+
+
+def startup():
+    phases = ["import_tf", "import_model", "construct", "build", "session", "total"]
+    print("%-8s" % "target" + "".join("%14s" % p for p in phases))
+    for target in args.target.split(","):
+        runs = list()
+        for _ in range(args.repeat):
+            cmd = [sys.executable, __file__, "--mode=startup", "--child=1", "--target=%s" % target,
+                   "--batch_size=%d" % args.batch_size, "--inst_norm=%d" % args.inst_norm]
+            try:
+                out = subprocess.check_output(cmd)
+            except subprocess.CalledProcessError:
+                print("%-8s failed, training resources probably missing" % target)
+                break
+            runs.append(json.loads(out.decode("utf-8").strip().splitlines()[-1]))
+        if not runs:
+            continue
+        best = dict((p, min(r[p] for r in runs)) for p in phases)
+        print("%-8s" % target + "".join("%13.3fs" % best[p] for p in phases))
+
+
+def scaling_worker(reducer):
+    import tensorflow as tf
+    from model.gegan import GEGAN
+
+    with tf.Session() as sess:
+        model = GEGAN(args.experiment_dir, batch_size=args.batch_size)
+        model.register_session(sess)
+        model.build_model(is_training=True, inst_norm=args.inst_norm)
+        if reducer.num_workers == 1:
+            # the single process baseline does not go through the reducer
+            reducer = None
+        return model.train(resume=False, max_steps=args.steps, checkpoint_steps=args.steps + 1, reducer=reducer)
+
+
+def scaling():
+    from model.parallel import run_workers
+
+    print("%8s%16s%10s%12s" % ("workers", "examples/sec", "speedup", "efficiency"))
+    baseline = None
+    for num_workers in [int(w) for w in args.workers.split(",")]:
+        # the parent never creates a session, every run is forked
+        stats = run_workers(num_workers, scaling_worker)[0]
+        throughput = stats["examples_per_sec"]
+        if baseline is None:
+            baseline = throughput / num_workers
+        speedup = throughput / baseline
+        print("%8d%16.2f%9.2fx%11.1f%%" % (num_workers, throughput, speedup, 100.0 * speedup / num_workers))
+
+
+def probe_child(target):
+    """
+    Run a few steps of target with synthetic data under the thread pools,
+    batch size and recompute blocks given on the command line, report
+    throughput, step time and peak memory
+    """
+    import resource
+    import numpy as np
+    import tensorflow as tf
+    from model.gegan import GEGAN
+    from model.optim import LocalUpdate
+    from model.cpu_profile import session_config
+
+    profile = {"intra_op_threads": args.intra_op_threads,
+               "inter_op_threads": args.inter_op_threads}
+    with tf.Session(config=session_config(profile)) as sess:
+        model = GEGAN(batch_size=args.batch_size, recompute=args.recompute, precision=args.precision)
+        model.register_session(sess)
+        model.build_model(is_training=(target == "train"), inst_norm=args.inst_norm)
+        input_handle, loss_handle, eval_handle, _ = model.retrieve_handles()
+
+        if target == "train":
+            g_vars, d_vars = model.retrieve_trainable_vars()
+            d_update = LocalUpdate(tf.train.AdamOptimizer(0.0001, beta1=0.5), loss_handle.d_loss, d_vars)
+            g_update = LocalUpdate(tf.train.AdamOptimizer(0.0001, beta1=0.5), loss_handle.g_loss, g_vars)
+
+            def step(feed_dict):
+                d_update.run(sess, loss_handle.d_loss, [feed_dict])
+                g_update.run(sess, loss_handle.g_loss, [feed_dict])
+                g_update.run(sess, loss_handle.g_loss, [feed_dict])
+        else:
+            def step(feed_dict):
+                sess.run(eval_handle.fake_s, feed_dict=feed_dict)
+
+        sess.run(tf.global_variables_initializer())
+        images = np.random.uniform(-1.0, 1.0, [model.batch_size, model.input_width,
+                                               model.input_width, model.input_filters]).astype(np.float32)
+        labels = np.random.randint(0, model.embedding_num, model.batch_size)
+        feed_dict = {input_handle.real_data: images, input_handle.embedding_ids: labels}
+
+        # warm up
+        step(feed_dict)
+        start = time.time()
+        for _ in range(args.steps):
+            step(feed_dict)
+        elapsed = time.time() - start
+
+    # ru_maxrss is in KB on linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print(json.dumps({"examples_per_sec": args.steps * args.batch_size / elapsed,
+                      "step_time": elapsed / args.steps,
+                      "peak_memory_mb": peak_mb}))
+
+
+def run_probe(target, intra=0, inter=0, batch_size=None, recompute="", precision="float32"):
+    cmd = [sys.executable, __file__, "--mode=probe", "--child=1", "--target=%s" % target,
+           "--intra_op_threads=%d" % intra, "--inter_op_threads=%d" % inter,
+           "--batch_size=%d" % (batch_size or args.batch_size), "--steps=%d" % args.steps,
+           "--inst_norm=%d" % args.inst_norm, "--recompute=%s" % recompute, "--precision=%s" % precision]
+    out = subprocess.check_output(cmd)
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+def autotune():
+    from model.cpu_profile import autotune as search, save_profile
+
+    # export runs the inference graph
+    targets = list()
+    for target in args.target.split(","):
+        target = "infer" if target == "export" else target
+        if target not in targets:
+            targets.append(target)
+
+    for target in targets:
+        def probe(intra, inter, batch_size):
+            result = run_probe(target, intra, inter, batch_size)
+            return result["examples_per_sec"], result["peak_memory_mb"]
+
+        print("autotune %s" % target)
+        profile = search(probe, batch_sizes=[int(b) for b in args.batch_sizes.split(",")],
+                         memory_cap_mb=args.memory_cap)
+        save_profile(args.cpu_profile, target, profile)
+        print("%s profile saved at %s: %s" % (target, args.cpu_profile, json.dumps(profile, sort_keys=True)))
+
+
+def recompute():
+    """
+    Peak memory versus step time of the training step for each recompute setting
+    """
+    print("%-28s%14s%14s" % ("recompute", "step time", "peak memory"))
+    for config in args.recompute_configs.split(";"):
+        blocks = "" if config == "none" else config
+        result = run_probe("train", batch_size=args.batch_size, recompute=blocks)
+        print("%-28s%13.3fs%11.1f MB" % (config, result["step_time"], result["peak_memory_mb"]))
+
+
+def precision():
+    """
+    Difference of the bfloat16 outputs to the float32 ones with the same
+    weights, then the throughput of both policies
+    """
+    import numpy as np
+    import tensorflow as tf
+    from model.gegan import GEGAN
+    from model.ops import init_embedding
+
+    with tf.Session() as sess:
+        models = [GEGAN(batch_size=args.batch_size, precision=p) for p in ("float32", "bfloat16")]
+        images = tf.placeholder(tf.float32, [args.batch_size, 64, 64, 3])
+        ids = tf.placeholder(tf.int64, [args.batch_size])
+        embedding = init_embedding(models[0].embedding_num, models[0].embedding_dim)
+        outputs = list()
+        for reuse, model in enumerate(models):
+            # the second policy reuses the float32 weights
+            fake, _ = model.generator(images, embedding, ids, args.inst_norm, is_training=False, reuse=bool(reuse))
+            _, logits, category = model.discriminator(fake, is_training=False, reuse=bool(reuse))
+            outputs.append([fake, logits, category])
+        sess.run(tf.global_variables_initializer())
+        if args.model_dir:
+            models[0].register_session(sess)
+            models[0].restore_model(tf.train.Saver(var_list=tf.global_variables()), args.model_dir)
+
+        feed_dict = {images: np.random.uniform(-1.0, 1.0, [args.batch_size, 64, 64, 3]),
+                     ids: np.random.randint(0, models[0].embedding_num, args.batch_size)}
+        full, reduced = sess.run(outputs, feed_dict=feed_dict)
+    print("%-22s%14s%14s" % ("bfloat16 vs float32", "max abs", "mean abs"))
+    for name, a, b in zip(["generator output", "real/fake logits", "category logits"], full, reduced):
+        print("%-22s%14.5f%14.5f" % (name, np.abs(a - b).max(), np.abs(a - b).mean()))
+
+    print("%-8s%-10s%16s%14s%14s" % ("target", "precision", "examples/sec", "step time", "peak memory"))
+    for target in args.target.split(","):
+        if target not in ("train", "infer"):
+            continue
+        for policy in ("float32", "bfloat16"):
+            result = run_probe(target, precision=policy)
+            print("%-8s%-10s%16.2f%13.3fs%11.1f MB" % (target, policy, result["examples_per_sec"],
+                                                      result["step_time"], result["peak_memory_mb"]))
+
+
+def time_fn(fn, steps):
+    # warm up
+    fn()
+    start = time.time()
+    for _ in range(steps):
+        fn()
+    return (time.time() - start) / steps
+
+
+def specialize():
+    """
+    Latency of the full generator versus the one specialized to a style
+    """
+    import numpy as np
+    import tensorflow as tf
+    from model.gegan import GEGAN
+    from model.specialize import StyleGenerator
+
+    source = np.random.uniform(-1.0, 1.0, [args.batch_size, 64, 64, 3]).astype(np.float32)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        model = GEGAN(batch_size=args.batch_size)
+        model.register_session(sess)
+        model.build_model(is_training=False, inst_norm=args.inst_norm)
+        saver = tf.train.Saver(var_list=model.retrieve_generator_vars())
+        model.restore_model(saver, args.model_dir)
+        input_handle, _, eval_handle, _ = model.retrieve_handles()
+        feed_dict = {input_handle.real_data: source,
+                     input_handle.embedding_ids: [args.embedding_id] * args.batch_size}
+        full = time_fn(lambda: sess.run(eval_handle.fake_s, feed_dict=feed_dict), args.steps)
+
+    tick = time.time()
+    generator = StyleGenerator(args.model_dir, args.embedding_id, batch_size=args.batch_size,
+                               inst_norm=args.inst_norm)
+    compile_time = time.time() - tick
+    specialized = time_fn(lambda: generator.generate(source), args.steps)
+    generator.close()
+
+    print("full generator:        %8.2f ms/batch" % (full * 1000))
+    print("specialized generator: %8.2f ms/batch (compiled in %.2fs)" % (specialized * 1000, compile_time))
+
+
+def restart_child():
+    """
+    One training step in a fresh interpreter, resuming the checkpoint of
+    the previous run, like a restart after preemption
+    """
+    start = time.time()
+    import tensorflow as tf
+    from model.gegan import GEGAN
+
+    with tf.Session() as sess:
+        model = GEGAN(args.experiment_dir, batch_size=args.batch_size)
+        model.register_session(sess)
+        model.build_train_graph(inst_norm=args.inst_norm, graph_cache=args.graph_cache)
+        stats = model.train(resume=True, max_steps=1, checkpoint_steps=2)
+    print(json.dumps({"graph": stats["graph"], "first_step": stats["time_to_first_step"],
+                      "process": time.time() - start}))
+
+
+def restart():
+    def run(graph_cache):
+        cmd = [sys.executable, __file__, "--mode=restart", "--child=1", "--graph_cache=%d" % graph_cache,
+               "--experiment_dir=%s" % args.experiment_dir, "--batch_size=%d" % args.batch_size,
+               "--inst_norm=%d" % args.inst_norm]
+        return json.loads(subprocess.check_output(cmd).decode("utf-8").strip().splitlines()[-1])
+
+    # the first cached run builds and exports the graph, the others import it
+    exported = run(graph_cache=1)
+    print("export run: %.2fs to first step" % exported["first_step"])
+    print("%-10s%16s%16s" % ("graph", "first step", "process"))
+    for graph_cache in [0, 1]:
+        runs = [run(graph_cache) for _ in range(args.repeat)]
+        print("%-10s%15.2fs%15.2fs" % (runs[0]["graph"], min(r["first_step"] for r in runs),
+                                       min(r["process"] for r in runs)))
+
+
+def style_search():
+    """
+    Latency of batched top-k queries over style indexes of growing size,
+    memory mapped like style_index.py loads them
+    """
+    import shutil
+    import tempfile
+    import numpy as np
+    from model.style_index import StyleIndex
+
+    index_dir = tempfile.mkdtemp()
+    try:
+        print("%-10s%-8s%16s%16s" % ("styles", "dim", "1 query", "%d queries" % args.batch_size))
+        for count in [int(c) for c in args.styles.split(",")]:
+            for dim in (64, 512):
+                StyleIndex.build(np.random.randn(count, dim)).save(index_dir)
+                index = StyleIndex.load(index_dir)
+                single = np.random.randn(1, dim)
+                batch = np.random.randn(args.batch_size, dim)
+                one = time_fn(lambda: index.search(single, k=5), args.steps)
+                many = time_fn(lambda: index.search(batch, k=5), args.steps)
+                print("%-10d%-8d%13.2f ms%13.2f ms" % (count, dim, one * 1000, many * 1000))
+    finally:
+        shutil.rmtree(index_dir)
+
+
+def preview():
+    """
+    Latency of the preview and of its refinement versus the full generator,
+    for one request at a time like an editor sends them
+    """
+    import numpy as np
+    from model.preview import PreviewGenerator
+
+    batch_size = 1
+    source = np.random.uniform(-1.0, 1.0, [batch_size, args.image_size, args.image_size, 3]).astype(np.float32)
+    ids = [args.embedding_id] * batch_size
+    generator = PreviewGenerator(args.model_dir, preview_factor=args.preview_factor, batch_size=batch_size,
+                                 image_size=args.image_size, embedding_num=max(2, args.embedding_id + 1),
+                                 inst_norm=args.inst_norm)
+    full = time_fn(lambda: generator.generate(source, ids), args.steps)
+
+    def request():
+        _, refinement = generator.generate_preview(source, ids)
+        refinement.result()
+        return refinement
+
+    request()
+    refinements = [request() for _ in range(args.steps)]
+    generator.close()
+    preview_latency = np.median([r.preview_latency for r in refinements])
+    latency = np.median([r.latency for r in refinements])
+    width = args.image_size // args.preview_factor
+    print("full generator:        %8.2f ms" % (full * 1000))
+    print("preview %3dx%-3d:       %8.2f ms" % (width, width, preview_latency * 1000))
+    print("refined %3dx%-3d:       %8.2f ms after the request" % (args.image_size, args.image_size, latency * 1000))
+
+
+def main():
+    if args.mode == "startup":
+        if args.child:
+            startup_child(args.target)
+        else:
+            startup()
+    elif args.mode == "scaling":
+        scaling()
+    elif args.mode == "probe":
+        probe_child(args.target)
+    elif args.mode == "autotune":
+        autotune()
+    elif args.mode == "recompute":
+        recompute()
+    elif args.mode == "specialize":
+        specialize()
+    elif args.mode == "precision":
+        precision()
+    elif args.mode == "restart":
+        if args.child:
+            restart_child()
+        else:
+            restart()
+    elif args.mode == "style_search":
+        style_search()
+    elif args.mode == "preview":
+        preview()
+    else:
+        raise Exception("unknown benchmark mode %s" % args.mode)
+
+
+if __name__ == '__main__':
+    main()
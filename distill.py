@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+
+import tensorflow as tf
+
+from model.gegan import GEGAN
+from model.distill import Distiller, report
+from model.cpu_profile import load_profile, session_config
+from model.utils import list_glyphs
+
+parser = argparse.ArgumentParser(description='Distill a trained generator into a compact one')
+parser.add_argument('--experiment_dir', dest='experiment_dir', required=True,
+                    help='experiment directory, the student checkpoints are saved under it')
+parser.add_argument('--experiment_id', dest='experiment_id', type=int, default=0,
+                    help='sequence id for the experiments you prepare to run')
+parser.add_argument('--teacher_dir', dest='teacher_dir', required=True,
+                    help='checkpoint directory of the trained generator')
+parser.add_argument('--source_dir', dest='source_dir', required=True,
+                    help='directory of the source glyph images to distill on, no targets needed')
+parser.add_argument('--report_dir', dest='report_dir', type=str, default=None,
+                    help='held-out source glyphs for the quality report, default to source_dir')
+parser.add_argument('--generator_dim', dest='generator_dim', type=int, default=32,
+                    help='filters of the first student layer')
+parser.add_argument('--kernel_size', dest='kernel_size', type=int, default=3, help='kernel size of the student')
+parser.add_argument('--generator_depth', dest='generator_depth', type=int, default=None,
+                    help='encoder layers of the student, default to the full depth of the image size')
+parser.add_argument('--teacher_generator_dim', dest='teacher_generator_dim', type=int, default=64,
+                    help='filters of the first teacher layer')
+parser.add_argument('--teacher_kernel_size', dest='teacher_kernel_size', type=int, default=5,
+                    help='kernel size of the teacher')
+parser.add_argument('--teacher_generator_depth', dest='teacher_generator_depth', type=int, default=None,
+                    help='encoder layers of the teacher, default to the full depth of the image size')
+parser.add_argument('--teacher_base_size', dest='teacher_base_size', type=int, default=None,
+                    help='first stage image size if the teacher was trained progressively')
+parser.add_argument('--feature_penalty', dest='feature_penalty', type=float, default=0.0,
+                    help='weight of matching the teacher encoder layers, 0 matches the outputs only')
+parser.add_argument('--image_size', dest='image_size', type=int, default=64,
+                    help="size of your input and output image")
+parser.add_argument('--embedding_num', dest='embedding_num', type=int, default=2,
+                    help="number for distinct embeddings")
+parser.add_argument('--embedding_dim', dest='embedding_dim', type=int, default=64, help="dimension for embedding")
+parser.add_argument('--inst_norm', dest='inst_norm', type=int, default=0,
+                    help='use conditional instance normalization in your model')
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=None,
+                    help='number of examples in batch, default to the cpu profile or 16')
+parser.add_argument('--lr', dest='lr', type=float, default=0.0002, help='learning rate for adam')
+parser.add_argument('--max_steps', dest='max_steps', type=int, default=20000, help='number of distillation steps')
+parser.add_argument('--checkpoint_steps', dest='checkpoint_steps', type=int, default=1000,
+                    help='number of steps in between two checkpoints')
+parser.add_argument('--resume', dest='resume', type=int, default=1, help='resume from previous distillation')
+parser.add_argument('--report_only', dest='report_only', type=int, default=0,
+                    help='skip training, only compare the latest student with the teacher')
+parser.add_argument('--cpu_profile', dest='cpu_profile', type=str, default=None,
+                    help='cpu profile tuned by benchmark.py --mode=autotune')
+args = parser.parse_args()
+profile = load_profile(args.cpu_profile, "train")
+if args.batch_size is None:
+    args.batch_size = profile["batch_size"]
+
+
+def build_models():
+    common = dict(batch_size=args.batch_size, input_width=args.image_size, output_width=args.image_size,
+                  embedding_num=args.embedding_num, embedding_dim=args.embedding_dim)
+    teacher = GEGAN(generator_dim=args.teacher_generator_dim, kernel_size=args.teacher_kernel_size,
+                    generator_depth=args.teacher_generator_depth, base_width=args.teacher_base_size, **common)
+    student = GEGAN(args.experiment_dir, experiment_id=args.experiment_id, generator_dim=args.generator_dim,
+                    kernel_size=args.kernel_size, generator_depth=args.generator_depth, **common)
+    return teacher, student
+
+
+def main(_):
+    config = session_config(profile)
+    teacher, student = build_models()
+    _, student_dir = student.get_model_id_and_dir()
+
+    if not args.report_only:
+        with tf.Graph().as_default(), tf.Session(config=config) as sess:
+            distiller = Distiller(teacher, student, args.teacher_dir, inst_norm=args.inst_norm,
+                                  feature_penalty=args.feature_penalty, lr=args.lr)
+            distiller.train(sess, list_glyphs(args.source_dir), steps=args.max_steps,
+                            checkpoint_steps=args.checkpoint_steps, resume=args.resume)
+
+    teacher, student = build_models()
+    report(teacher, student, args.teacher_dir, student_dir, list_glyphs(args.report_dir or args.source_dir),
+           inst_norm=args.inst_norm, config=session_config(load_profile(args.cpu_profile, "infer")))
+
+
+if __name__ == '__main__':
+    tf.app.run()
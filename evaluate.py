@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import os
+
+from model.cpu_profile import session_config
+from model.evaluator import create_evaluator
+
+parser = argparse.ArgumentParser(description='Evaluate the checkpoints of an experiment as they are written')
+parser.add_argument('--experiment_dir', dest='experiment_dir', required=True,
+                    help='experiment directory, data, samples,checkpoints,etc')
+parser.add_argument('--experiment_id', dest='experiment_id', type=int, default=0,
+                    help='sequence id for the experiments you prepare to run')
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=16,
+                    help='batch size the experiment is trained with, it names the checkpoint directory')
+parser.add_argument('--eval_dir', dest='eval_dir', required=True,
+                    help='held-out images under eval_dir/<embedding id>/')
+parser.add_argument('--eval_batch_size', dest='eval_batch_size', type=int, default=128,
+                    help='number of examples in evaluation batch')
+parser.add_argument('--image_size', dest='image_size', type=int, default=64,
+                    help="size of your input and output image")
+parser.add_argument('--base_size', dest='base_size', type=int, default=None,
+                    help='first stage image size if the model was trained progressively')
+parser.add_argument('--embedding_num', dest='embedding_num', type=int, default=2,
+                    help="number for distinct embeddings")
+parser.add_argument('--embedding_dim', dest='embedding_dim', type=int, default=64, help="dimension for embedding")
+parser.add_argument('--inst_norm', dest='inst_norm', type=int, default=0,
+                    help='use conditional instance normalization in your model')
+parser.add_argument('--threads', dest='threads', type=int, default=2,
+                    help='threads of the evaluation session, leave the rest of the cores to training')
+parser.add_argument('--poll_seconds', dest='poll_seconds', type=int, default=30,
+                    help='seconds in between two looks at the checkpoint directory')
+parser.add_argument('--watch_pid', dest='watch_pid', type=int, default=None,
+                    help='exit once this process (the trainer) is gone and its last checkpoint is evaluated')
+args = parser.parse_args()
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def main():
+    config = session_config({"intra_op_threads": args.threads, "inter_op_threads": 1})
+    evaluator = create_evaluator(args.experiment_dir, args.experiment_id, args.batch_size, args.eval_dir,
+                                 eval_batch_size=args.eval_batch_size, image_size=args.image_size,
+                                 base_width=args.base_size, embedding_num=args.embedding_num,
+                                 embedding_dim=args.embedding_dim, inst_norm=bool(args.inst_norm),
+                                 config=config)
+    alive = (lambda: process_alive(args.watch_pid)) if args.watch_pid else None
+    try:
+        evaluator.watch(poll_seconds=args.poll_seconds, alive=alive)
+    finally:
+        evaluator.close()
+
+
+if __name__ == '__main__':
+    main()
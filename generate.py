@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import json
+import math
+import os
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from model.gegan import GEGAN
+from model.cpu_profile import load_profile, session_config
+from model.cache import GlyphCache
+from model.specialize import StyleGeneratorCache
+from model.pipeline import Stage, run_pipeline, print_report
+from model.utils import denormalize_image, list_glyphs, load_glyphs
+
+parser = argparse.ArgumentParser(description='Bulk generation of whole fonts')
+parser.add_argument('--model_dir', dest='model_dir', required=True,
+                    help='directory that saves the model checkpoints')
+parser.add_argument('--source_dir', dest='source_dir', required=True,
+                    help='directory of the source glyph images, one file per character')
+parser.add_argument('--embedding_ids', dest='embedding_ids', type=str, default='0',
+                    help='styles to generate, separate by comma')
+parser.add_argument('--save_dir', dest='save_dir', type=str, default='save_dir',
+                    help='generated glyphs are saved under save_dir/<embedding id>/')
+parser.add_argument('--format', dest='format', type=str, default='glyphs',
+                    help='glyphs writes one png per character, atlas packs each chunk into one png and a json index')
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=None,
+                    help='number of examples in batch, default to the cpu profile or 16')
+parser.add_argument('--image_size', dest='image_size', type=int, default=64,
+                    help="size of your input and output image")
+parser.add_argument('--base_size', dest='base_size', type=int, default=None,
+                    help='first stage image size if the model was trained progressively')
+parser.add_argument('--inst_norm', dest='inst_norm', type=int, default=0,
+                    help='use conditional instance normalization in your model')
+parser.add_argument('--generator_dim', dest='generator_dim', type=int, default=64,
+                    help='filters of the first generator layer, smaller for a distilled student')
+parser.add_argument('--kernel_size', dest='kernel_size', type=int, default=5, help='kernel size of the generator')
+parser.add_argument('--embedding_num', dest='embedding_num', type=int, default=2,
+                    help='number for distinct embeddings, one more for every font added by onboard.py')
+parser.add_argument('--generator_depth', dest='generator_depth', type=int, default=None,
+                    help='encoder layers of the generator, default to the full depth of the image size')
+parser.add_argument('--cpu_profile', dest='cpu_profile', type=str, default=None,
+                    help='cpu profile tuned by benchmark.py --mode=autotune')
+parser.add_argument('--chunk_size', dest='chunk_size', type=int, default=256,
+                    help='glyphs moved through the pipeline together, and packed in one atlas')
+parser.add_argument('--loader_threads', dest='loader_threads', type=int, default=4,
+                    help='threads reading and decoding the source glyphs')
+parser.add_argument('--writer_threads', dest='writer_threads', type=int, default=4,
+                    help='threads encoding and writing the generated glyphs')
+parser.add_argument('--queue_size', dest='queue_size', type=int, default=4,
+                    help='chunks buffered between two stages')
+parser.add_argument('--specialize', dest='specialize', type=int, default=0,
+                    help='compile a generator specialized to each style instead of running the full generator')
+parser.add_argument('--cache_dir', dest='cache_dir', type=str, default=None,
+                    help='keep the generated glyphs in a glyph cache under cache_dir, reused by later runs')
+parser.add_argument('--cache_mb', dest='cache_mb', type=int, default=1024,
+                    help='size in MB of the disk tier of the glyph cache')
+parser.add_argument('--cache_items', dest='cache_items', type=int, default=4096,
+                    help='glyphs kept in the memory tier of the glyph cache')
+args = parser.parse_args()
+profile = load_profile(args.cpu_profile, "infer")
+if args.batch_size is None:
+    args.batch_size = profile["batch_size"]
+
+
+def load_chunk(chunk):
+    index, paths = chunk
+    names, images = load_glyphs(paths, args.image_size)
+    return index, names, images
+
+
+def model_stage(run_batch, embedding_ids, glyph_cache=None):
+    """
+    run_batch(images, embedding_id) generates one batch of batch_size
+    """
+    def generate(chunk):
+        index, names, images = chunk
+        count = len(images)
+        if glyph_cache is not None:
+            # the cache pads the misses to the batch size itself
+            generated = dict()
+            for embedding_id in embedding_ids:
+                generated[embedding_id] = glyph_cache.generate(images, embedding_id,
+                                                               lambda batch, e=embedding_id: run_batch(batch, e),
+                                                               batch_size=args.batch_size)
+            return index, names, generated
+
+        # the graph has a fixed batch size, pad the last batch
+        padded = int(math.ceil(count / float(args.batch_size))) * args.batch_size
+        if padded > count:
+            images = np.concatenate([images, np.repeat(images[:1], padded - count, axis=0)])
+
+        generated = dict()
+        for embedding_id in embedding_ids:
+            outputs = list()
+            for start in range(0, padded, args.batch_size):
+                outputs.append(run_batch(images[start:start + args.batch_size], embedding_id))
+            generated[embedding_id] = np.concatenate(outputs)[:count]
+        return index, names, generated
+    return generate
+
+
+def write_glyphs(chunk):
+    _, names, generated = chunk
+    for embedding_id, images in generated.items():
+        style_dir = os.path.join(args.save_dir, str(embedding_id))
+        for name, image in zip(names, denormalize_image(images).astype(np.uint8)):
+            Image.fromarray(image).save(os.path.join(style_dir, "%s.png" % name))
+
+
+def write_atlas(chunk):
+    index, names, generated = chunk
+    size = args.image_size
+    columns = int(math.ceil(math.sqrt(len(names))))
+    rows = int(math.ceil(len(names) / float(columns)))
+    for embedding_id, images in generated.items():
+        atlas = np.full([rows * size, columns * size, 3], 255, dtype=np.uint8)
+        boxes = dict()
+        for i, (name, image) in enumerate(zip(names, denormalize_image(images).astype(np.uint8))):
+            y, x = (i // columns) * size, (i % columns) * size
+            atlas[y:y + size, x:x + size] = image
+            boxes[name] = [x, y, size, size]
+        atlas_path = os.path.join(args.save_dir, str(embedding_id), "atlas_%05d" % index)
+        Image.fromarray(atlas).save(atlas_path + ".png")
+        with open(atlas_path + ".json", "w") as f:
+            json.dump(boxes, f, sort_keys=True)
+
+
+def main(_):
+    if args.format not in ("glyphs", "atlas"):
+        raise Exception("unknown output format %s" % args.format)
+    embedding_ids = [int(i) for i in args.embedding_ids.split(",")]
+    for embedding_id in embedding_ids:
+        style_dir = os.path.join(args.save_dir, str(embedding_id))
+        if not os.path.exists(style_dir):
+            os.makedirs(style_dir)
+
+    paths = list_glyphs(args.source_dir)
+    chunks = [(i, paths[start:start + args.chunk_size])
+              for i, start in enumerate(range(0, len(paths), args.chunk_size))]
+    print("%d source glyphs in %d chunks, %d styles" % (len(paths), len(chunks), len(embedding_ids)))
+
+    glyph_cache = None
+    if args.cache_dir:
+        glyph_cache = GlyphCache(args.model_dir, cache_dir=args.cache_dir, memory_items=args.cache_items,
+                                 disk_mb=args.cache_mb, image_shape=(args.image_size, args.image_size, 3))
+    writer = write_atlas if args.format == "atlas" else write_glyphs
+
+    def run(run_batch):
+        stages = [Stage("load", load_chunk, workers=args.loader_threads),
+                  Stage("model", model_stage(run_batch, embedding_ids, glyph_cache), workers=1),
+                  Stage("write", writer, workers=args.writer_threads)]
+        return run_pipeline(chunks, stages, queue_size=args.queue_size)
+
+    if args.specialize:
+        # one compiled generator per style, all of them stay loaded
+        styles = StyleGeneratorCache(capacity=len(embedding_ids), batch_size=args.batch_size,
+                                     image_size=args.image_size, base_width=args.base_size,
+                                     inst_norm=args.inst_norm, config=session_config(profile),
+                                     generator_dim=args.generator_dim, kernel_size=args.kernel_size,
+                                     generator_depth=args.generator_depth, embedding_num=args.embedding_num)
+        stats = run(lambda images, embedding_id: styles.get(args.model_dir, embedding_id).generate(images))
+        styles.clear()
+    else:
+        with tf.Session(config=session_config(profile)) as sess:
+            model = GEGAN(batch_size=args.batch_size, input_width=args.image_size, output_width=args.image_size,
+                          base_width=args.base_size, generator_dim=args.generator_dim,
+                          kernel_size=args.kernel_size, generator_depth=args.generator_depth,
+                          embedding_num=args.embedding_num)
+            model.register_session(sess)
+            model.build_model(is_training=False, inst_norm=args.inst_norm)
+            saver = tf.train.Saver(var_list=model.retrieve_generator_vars())
+            if not model.restore_model(saver, args.model_dir):
+                raise Exception("no checkpoint found in %s" % args.model_dir)
+            input_handle, _, eval_handle, _ = model.retrieve_handles()
+
+            def run_batch(images, embedding_id):
+                return sess.run(eval_handle.fake_s, feed_dict={input_handle.real_data: images,
+                                                               input_handle.embedding_ids: [embedding_id] *
+                                                                                           args.batch_size})
+            stats = run(run_batch)
+
+    print_report(stats)
+    if glyph_cache is not None:
+        glyph_cache.close()
+        print("glyph cache: %s" % json.dumps(glyph_cache.stats(), sort_keys=True))
+    glyphs = len(paths) * len(embedding_ids)
+    print("%d glyphs generated, %.2f glyphs/sec" % (glyphs, glyphs / stats["seconds"]))
+
+
+if __name__ == '__main__':
+    tf.app.run()
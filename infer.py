@@ -5,7 +5,8 @@ from __future__ import absolute_import
 import tensorflow as tf
 import os
 import argparse
-from model.unet import UNet
+from model.gegan import GEGAN
+from model.cpu_profile import load_profile, session_config
 from model.utils import compile_frames_to_gif
 
 """
@@ -16,7 +17,23 @@ People are made to have fun and be 中二 sometimes
 parser = argparse.ArgumentParser(description='Inference for unseen data')
 parser.add_argument('--model_dir', dest='model_dir', required=True,
                     help='directory that saves the model checkpoints')
-parser.add_argument('--batch_size', dest='batch_size', type=int, default=16, help='number of examples in batch')
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=None,
+                    help='number of examples in batch, default to the cpu profile or 16')
+parser.add_argument('--image_size', dest='image_size', type=int, default=64,
+                    help="size of your input and output image")
+parser.add_argument('--base_size', dest='base_size', type=int, default=None,
+                    help='first stage image size if the model was trained progressively')
+parser.add_argument('--generator_dim', dest='generator_dim', type=int, default=64,
+                    help='filters of the first generator layer, smaller for a distilled student')
+parser.add_argument('--kernel_size', dest='kernel_size', type=int, default=5, help='kernel size of the generator')
+parser.add_argument('--embedding_num', dest='embedding_num', type=int, default=2,
+                    help='number for distinct embeddings, one more for every font added by onboard.py')
+parser.add_argument('--precision', dest='precision', type=str, default='float32',
+                    help='float32, or bfloat16 convolutions with float32 weights')
+parser.add_argument('--generator_depth', dest='generator_depth', type=int, default=None,
+                    help='encoder layers of the generator, default to the full depth of the image size')
+parser.add_argument('--cpu_profile', dest='cpu_profile', type=str, default=None,
+                    help='cpu profile tuned by benchmark.py --mode=autotune')
 parser.add_argument('--source_obj', dest='source_obj', type=str, required=True, help='the source images for inference')
 parser.add_argument('--embedding_ids', default='embedding_ids', type=str, help='embeddings involved')
 parser.add_argument('--save_dir', default='save_dir', type=str, help='path to save inferred images')
@@ -29,14 +46,19 @@ parser.add_argument('--output_gif', dest='output_gif', type=str, default=None, h
 parser.add_argument('--uroboros', dest='uroboros', type=int, default=0,
                     help='Shōnen yo, you have stepped into uncharted territory')
 args = parser.parse_args()
+profile = load_profile(args.cpu_profile, "infer")
+if args.batch_size is None:
+    args.batch_size = profile["batch_size"]
 
 
 def main(_):
-    config = tf.ConfigProto()
-    config.gpu_options.allow_growth = True
+    config = session_config(profile)
 
     with tf.Session(config=config) as sess:
-        model = UNet(batch_size=args.batch_size)
+        model = GEGAN(batch_size=args.batch_size, input_width=args.image_size, output_width=args.image_size,
+                      base_width=args.base_size, generator_dim=args.generator_dim,
+                      kernel_size=args.kernel_size, generator_depth=args.generator_depth,
+                      embedding_num=args.embedding_num, precision=args.precision)
         model.register_session(sess)
         model.build_model(is_training=False, inst_norm=args.inst_norm)
         embedding_ids = [int(i) for i in args.embedding_ids.split(",")]
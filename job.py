@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+
+from model.job import run_job, merge
+from model.cpu_profile import load_profile
+from model.utils import list_glyphs
+
+parser = argparse.ArgumentParser(description='Sharded, resumable generation of many styles')
+parser.add_argument('--job_dir', dest='job_dir', required=True,
+                    help='directory of the manifest and the finished units, run again with it to resume')
+parser.add_argument('--model_dir', dest='model_dir', required=True,
+                    help='directory that saves the model checkpoints')
+parser.add_argument('--source_dir', dest='source_dir', required=True,
+                    help='directory of the source glyph images, one file per character')
+parser.add_argument('--embedding_ids', dest='embedding_ids', type=str, required=True,
+                    help='styles to generate, separate by comma, or a range like 0-99')
+parser.add_argument('--save_dir', dest='save_dir', type=str, default=None,
+                    help='merge the finished job into save_dir/<embedding id>/')
+parser.add_argument('--num_workers', dest='num_workers', type=int, default=1,
+                    help='number of worker processes')
+parser.add_argument('--glyphs_per_unit', dest='glyphs_per_unit', type=int, default=512,
+                    help='number of characters of one style in a work unit')
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=None,
+                    help='number of examples in batch, default to the cpu profile or 16')
+parser.add_argument('--image_size', dest='image_size', type=int, default=64,
+                    help="size of your input and output image")
+parser.add_argument('--base_size', dest='base_size', type=int, default=None,
+                    help='first stage image size if the model was trained progressively')
+parser.add_argument('--generator_dim', dest='generator_dim', type=int, default=64,
+                    help='filters of the first generator layer, smaller for a distilled student')
+parser.add_argument('--kernel_size', dest='kernel_size', type=int, default=5, help='kernel size of the generator')
+parser.add_argument('--generator_depth', dest='generator_depth', type=int, default=None,
+                    help='encoder layers of the generator, default to the full depth of the image size')
+parser.add_argument('--precision', dest='precision', type=str, default='float32',
+                    help='float32, or bfloat16 convolutions with float32 weights')
+parser.add_argument('--inst_norm', dest='inst_norm', type=int, default=0,
+                    help='use conditional instance normalization in your model')
+parser.add_argument('--cpu_profile', dest='cpu_profile', type=str, default=None,
+                    help='cpu profile tuned by benchmark.py --mode=autotune')
+args = parser.parse_args()
+
+
+def parse_ids(ids):
+    parsed = list()
+    for part in ids.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            parsed.extend(range(int(first), int(last) + 1))
+        else:
+            parsed.append(int(part))
+    return parsed
+
+
+def main():
+    profile = load_profile(args.cpu_profile, "infer")
+    batch_size = args.batch_size or profile["batch_size"]
+    stats = run_job(args.job_dir, args.model_dir, list_glyphs(args.source_dir), parse_ids(args.embedding_ids),
+                    num_workers=args.num_workers, glyphs_per_unit=args.glyphs_per_unit, batch_size=batch_size,
+                    image_size=args.image_size, base_width=args.base_size, inst_norm=bool(args.inst_norm),
+                    profile=profile, generator_dim=args.generator_dim, kernel_size=args.kernel_size,
+                    generator_depth=args.generator_depth, precision=args.precision)
+    if stats["units"]:
+        print("%d units, %d glyphs in %.2fs, %.2f glyphs/sec" %
+              (stats["units"], stats["glyphs"], stats["seconds"], stats["glyphs_per_sec"]))
+    if args.save_dir:
+        merge(args.job_dir, args.save_dir)
+
+
+if __name__ == '__main__':
+    main()
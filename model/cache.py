@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Content addressed cache of generated glyphs, in front of the generator.
+# A result is keyed by (hash of the source glyph pixels, style, checkpoint
+# id), the style being an embedding id or the interpolation weights.
+# Two tiers:
+# * memory: the most recently used results, as numpy arrays
+# * disk: a fixed number of slots in a memory mapped .npy file, with a
+#   json index of the slot of each key, so the cache survives restarts
+#   and its size is bounded by disk_mb. The index is only written by
+#   flush, so every slot also holds the digest of its key, written after
+#   the glyph: a slot reused since the last flush no longer matches the
+#   key of the index and reads as a miss, also when the process died
+#   while writing it. The two files are only synced by flush and the
+#   kernel writes them back in any order, so this does not hold after a
+#   host crash: a slot written since the last flush may then pair a torn
+#   glyph with its digest
+# Both are evicted least recently used first. The checkpoint id changes
+# whenever a checkpoint is written or exported in model_dir, which drops
+# every cached result.
+
+
+def checkpoint_id(model_dir):
+    """
+    Identify the latest checkpoint in model_dir, export_generator always
+    writes the same path so the modification time is part of the id
+    """
+    state_file = os.path.join(model_dir, "checkpoint")
+    if not os.path.exists(state_file):
+        raise Exception("no checkpoint found in %s" % model_dir)
+    with open(state_file) as f:
+        # first line is model_checkpoint_path: "<path>"
+        path = f.readline().split(":", 1)[1].strip().strip('"')
+    if not os.path.isabs(path):
+        path = os.path.join(model_dir, path)
+    index = path + ".index"
+    mtime = os.path.getmtime(index if os.path.exists(index) else state_file)
+    return "%s@%.6f" % (path, mtime)
+
+
+DIGEST_BYTES = 20
+
+
+def key_digest(key):
+    return np.frombuffer(hashlib.sha1(key.encode("utf-8")).digest(), dtype=np.uint8)
+
+
+def style_key(style):
+    """
+    An embedding id, or the interpolation weights over the embeddings
+    """
+    if isinstance(style, (int, np.integer)):
+        return "id:%d" % style
+    weights = np.asarray(style, dtype=np.float32).reshape(-1)
+    return "w:" + ",".join("%.6g" % w for w in weights)
+
+
+class GlyphCache(object):
+    """
+    Two tier LRU cache of generated glyphs for the checkpoint in model_dir.
+    Without cache_dir only the memory tier is used.
+    """
+    def __init__(self, model_dir, cache_dir=None, memory_items=1024, disk_mb=1024,
+                 image_shape=(64, 64, 3), dtype=np.float32):
+        self.model_dir      = model_dir
+        self.cache_dir      = cache_dir
+        self.memory_items   = memory_items
+        self.image_shape    = tuple(image_shape)
+        self.dtype          = np.dtype(dtype)
+        self.lock           = threading.Lock()
+        self.memory         = OrderedDict()
+        self.counters       = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "invalidations": 0}
+
+        self.checkpoint     = None
+        self.state_mtime    = None
+        self.slots          = None
+        self.digests        = None
+        if cache_dir:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            item_bytes = int(np.prod(self.image_shape)) * self.dtype.itemsize
+            self.disk_slots = max(1, int(disk_mb * 1024 * 1024 // item_bytes))
+            self._open_disk()
+        self._check_checkpoint()
+
+    def _open_disk(self):
+        slots_path = os.path.join(self.cache_dir, "glyphs.npy")
+        digests_path = os.path.join(self.cache_dir, "digests.npy")
+        index_path = os.path.join(self.cache_dir, "index.json")
+        shape = (self.disk_slots,) + self.image_shape
+        digests_shape = (self.disk_slots, DIGEST_BYTES)
+
+        index = None
+        if os.path.exists(slots_path) and os.path.exists(digests_path) and os.path.exists(index_path):
+            self.slots = np.load(slots_path, mmap_mode="r+")
+            self.digests = np.load(digests_path, mmap_mode="r+")
+            with open(index_path) as f:
+                index = json.load(f)
+            if self.slots.shape != shape or self.slots.dtype != self.dtype or self.digests.shape != digests_shape:
+                index = None
+        if index is None:
+            self.slots = np.lib.format.open_memmap(slots_path, mode="w+", dtype=self.dtype, shape=shape)
+            self.digests = np.lib.format.open_memmap(digests_path, mode="w+", dtype=np.uint8, shape=digests_shape)
+            index = {"checkpoint": None, "entries": []}
+
+        self.checkpoint = index["checkpoint"]
+        # least recently used first
+        self.disk = OrderedDict((key, slot) for key, slot in index["entries"])
+        used = set(self.disk.values())
+        self.free_slots = [s for s in range(self.disk_slots - 1, -1, -1) if s not in used]
+
+    def _check_checkpoint(self):
+        # stat is cheap, the checkpoint state file is only parsed when it changed
+        state_file = os.path.join(self.model_dir, "checkpoint")
+        mtime = os.path.getmtime(state_file) if os.path.exists(state_file) else None
+        if mtime is not None and mtime == self.state_mtime:
+            return
+        self.state_mtime = mtime
+        current = checkpoint_id(self.model_dir)
+        if current != self.checkpoint:
+            if self.checkpoint is not None:
+                print("checkpoint changed to %s, glyph cache invalidated" % current)
+                self.counters["invalidations"] += 1
+            self.memory.clear()
+            if self.slots is not None:
+                self.disk.clear()
+                self.free_slots = list(range(self.disk_slots - 1, -1, -1))
+            self.checkpoint = current
+
+    def key(self, source, style):
+        source = np.ascontiguousarray(source)
+        digest = hashlib.sha1(source.tobytes())
+        digest.update(str(source.shape).encode("utf-8"))
+        return "%s/%s/%s" % (digest.hexdigest(), style_key(style), self.checkpoint)
+
+    def _remember(self, key, result):
+        self.memory[key] = result
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _store(self, key, result):
+        self._remember(key, result)
+        if self.slots is None or key in self.disk:
+            return
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            _, slot = self.disk.popitem(last=False)
+        # invalid while the glyph is being written
+        self.digests[slot] = 0
+        self.slots[slot] = result
+        self.digests[slot] = key_digest(key)
+        self.disk[key] = slot
+
+    def _lookup(self, key):
+        result = self.memory.pop(key, None)
+        if result is not None:
+            self.memory[key] = result
+            self.counters["memory_hits"] += 1
+            return result
+        if self.slots is not None and key in self.disk:
+            slot = self.disk.pop(key)
+            if np.array_equal(self.digests[slot], key_digest(key)):
+                self.disk[key] = slot
+                result = np.array(self.slots[slot])
+                self._remember(key, result)
+                self.counters["disk_hits"] += 1
+                return result
+            # the slot was reused after the index was written
+            self.free_slots.append(slot)
+        self.counters["misses"] += 1
+        return None
+
+    def get(self, source, style):
+        with self.lock:
+            self._check_checkpoint()
+            return self._lookup(self.key(source, style))
+
+    def put(self, source, style, result):
+        with self.lock:
+            self._check_checkpoint()
+            self._store(self.key(source, style), np.asarray(result, dtype=self.dtype))
+
+    def generate(self, sources, style, generate_fn, batch_size=None):
+        """
+        Results for a batch of source glyphs in one style, generate_fn is
+        only called on the misses. With batch_size the misses are padded
+        to the fixed batch size of the generator graph.
+        """
+        with self.lock:
+            self._check_checkpoint()
+            keys = [self.key(source, style) for source in sources]
+            results = [self._lookup(key) for key in keys]
+        misses = [i for i, r in enumerate(results) if r is None]
+        if not misses:
+            return np.stack(results)
+
+        missed = np.stack([sources[i] for i in misses])
+        if batch_size:
+            generated = list()
+            for start in range(0, len(misses), batch_size):
+                batch = missed[start:start + batch_size]
+                count = len(batch)
+                if count < batch_size:
+                    padding = np.repeat(batch[:1], batch_size - count, axis=0)
+                    batch = np.concatenate([batch, padding])
+                generated.append(generate_fn(batch)[:count])
+            generated = np.concatenate(generated)
+        else:
+            generated = generate_fn(missed)
+
+        with self.lock:
+            for i, result in zip(misses, generated):
+                results[i] = np.asarray(result, dtype=self.dtype)
+                self._store(keys[i], results[i])
+        return np.stack(results)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["hits"]           = stats["memory_hits"] + stats["disk_hits"]
+            lookups                 = stats["hits"] + stats["misses"]
+            stats["hit_rate"]       = float(stats["hits"]) / lookups if lookups else 0.0
+            stats["memory_items"]   = len(self.memory)
+            stats["disk_items"]     = len(self.disk) if self.slots is not None else 0
+            return stats
+
+    def flush(self):
+        """
+        Write the disk tier index, so the cache is reused after a restart
+        """
+        if self.slots is None:
+            return
+        with self.lock:
+            self.slots.flush()
+            self.digests.flush()
+            index_path = os.path.join(self.cache_dir, "index.json")
+            with open(index_path + ".tmp", "w") as f:
+                json.dump({"checkpoint": self.checkpoint, "entries": list(self.disk.items())}, f)
+            os.rename(index_path + ".tmp", index_path)
+
+    def close(self):
+        self.flush()
+        self.slots = None
+        self.digests = None
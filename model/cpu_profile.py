@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import multiprocessing
+import os
+
+# CPU execution profile shared by train, infer and export.
+# A profile records the thread pools sizes, the number of reader threads
+# of the input pipeline and the batch size, for each target ("train" or
+# "infer"). It is found by autotune() and saved as json so the following
+# runs on the same host just load it. The reader threads are not probed,
+# they get the cores left over by the chosen thread pools.
+
+DEFAULT_PROFILE = {"intra_op_threads": 0,   # 0 lets tensorflow decide
+                   "inter_op_threads": 0,
+                   "reader_threads":   4,
+                   "batch_size":       16}
+
+
+def thread_candidates(cpu_count=None):
+    cpu_count = cpu_count or multiprocessing.cpu_count()
+    candidates = list()
+    n = 1
+    while n < cpu_count:
+        candidates.append(n)
+        n *= 2
+    candidates.append(cpu_count)
+    return candidates
+
+
+def autotune(probe, batch_sizes=(8, 16, 32, 64), memory_cap_mb=None, cpu_count=None, inter_op_threads=(1, 2)):
+    """
+    Search for the fastest configuration that fits in memory_cap_mb.
+    probe(intra_op_threads, inter_op_threads, batch_size) runs a short
+    benchmark and returns (examples_per_sec, peak_memory_mb).
+
+    The search is done in two stages to keep the number of probes small,
+    first the thread pools at the smallest batch size, then the batch
+    size with the best thread pools.
+    """
+    cpu_count = cpu_count or multiprocessing.cpu_count()
+    results = list()
+
+    def run(intra, inter, batch_size):
+        throughput, peak_mb = probe(intra, inter, batch_size)
+        fits = memory_cap_mb is None or peak_mb <= memory_cap_mb
+        results.append({"intra_op_threads": intra,
+                        "inter_op_threads": inter,
+                        "batch_size":       batch_size,
+                        "examples_per_sec": throughput,
+                        "peak_memory_mb":   peak_mb,
+                        "fits":             fits})
+        print("intra %2d inter %2d batch %3d -> %8.2f examples/sec, %8.1f MB%s" %
+              (intra, inter, batch_size, throughput, peak_mb, "" if fits else " (over memory cap)"))
+        return results[-1]
+
+    def best(candidates):
+        candidates = [r for r in candidates if r["fits"]]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda r: r["examples_per_sec"])
+
+    batch_sizes = sorted(batch_sizes)
+    stage = [run(intra, inter, batch_sizes[0])
+             for intra in thread_candidates(cpu_count) for inter in inter_op_threads]
+    chosen = best(stage)
+    if chosen is None:
+        raise Exception("no configuration fits in %s MB" % memory_cap_mb)
+
+    for batch_size in batch_sizes[1:]:
+        r = run(chosen["intra_op_threads"], chosen["inter_op_threads"], batch_size)
+        if not r["fits"]:
+            # larger batches will not fit either
+            break
+    chosen = best(results)
+
+    profile = dict(DEFAULT_PROFILE)
+    profile["intra_op_threads"] = chosen["intra_op_threads"]
+    profile["inter_op_threads"] = chosen["inter_op_threads"]
+    profile["batch_size"]       = chosen["batch_size"]
+    # leave the cores not used by the thread pools to the input pipeline
+    profile["reader_threads"]   = max(1, min(4, cpu_count - chosen["intra_op_threads"]))
+    profile["examples_per_sec"] = chosen["examples_per_sec"]
+    profile["peak_memory_mb"]   = chosen["peak_memory_mb"]
+    return profile
+
+
+def load_profile(path, target):
+    """
+    Return the profile of target saved in path, or the default profile
+    if there is no such file or it was tuned on a different host
+    """
+    profile = dict(DEFAULT_PROFILE)
+    if not path or not os.path.exists(path):
+        return profile
+    with open(path) as f:
+        saved = json.load(f)
+    if saved.get("cpu_count") != multiprocessing.cpu_count():
+        print("cpu profile %s was tuned on a different host, ignored" % path)
+        return profile
+    profile.update(saved.get(target, {}))
+    return profile
+
+
+def save_profile(path, target, profile):
+    saved = dict()
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+    saved["cpu_count"] = multiprocessing.cpu_count()
+    saved[target] = profile
+    with open(path, "w") as f:
+        json.dump(saved, f, indent=2, sort_keys=True)
+
+
+def session_config(profile=None, num_processes=1):
+    """
+    ConfigProto for the profile, the cores are split evenly if several
+    processes (data parallel workers) share the host
+    """
+    import tensorflow as tf
+
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    if profile:
+        intra = profile.get("intra_op_threads", 0)
+        inter = profile.get("inter_op_threads", 0)
+        if intra and num_processes > 1:
+            intra = max(1, intra // num_processes)
+        config.intra_op_parallelism_threads = intra
+        config.inter_op_parallelism_threads = inter
+    return config
@@ -8,38 +8,61 @@ import os
 # from .utils import pad_seq, bytes_to_file, \
 #     read_split_image, shift_and_resize_image, normalize_image
 
-def get_train_dataloader(batch_size):
-    image_list, label_list = get_image_label_list()
+def get_train_dataloader(batch_size, shard_index=0, num_shards=1, num_threads=4, image_size=64, labels=None):
+    image_list, label_list = get_shard(shard_index, num_shards, labels)
     images = tf.convert_to_tensor(image_list, dtype=tf.string)
     labels = tf.convert_to_tensor(label_list, dtype=tf.int64)
 
     input_queue = tf.train.slice_input_producer([images, labels], shuffle=True)
-    image, label = read_image_label_from_disk(input_queue)
+    image, label = read_image_label_from_disk(input_queue, image_size)
 
     min_after_dequeue = 1000
     capacity = min_after_dequeue + 3 * batch_size
 
     batch = tf.train.shuffle_batch([image, label],
                                    batch_size=batch_size,
-                                   num_threads=4,
+                                   num_threads=num_threads,
                                    capacity=capacity,
                                    min_after_dequeue=min_after_dequeue,
                                    name="TrainData")
 
     return batch
 
-def read_image_label_from_disk(input_queue):
+def get_example_loader(batch_size, image_size=64, num_threads=4):
+    """
+    Decode the images of a fed batch of paths, for samplers choosing the
+    examples in python (see priority.py), return (paths, images)
+    """
+    paths = tf.placeholder(tf.string, [batch_size], name="example_paths")
+    images = tf.map_fn(lambda path: read_image(path, image_size), paths, dtype=tf.float32,
+                       parallel_iterations=num_threads, back_prop=False)
+    return paths, images
+
+def read_image_label_from_disk(input_queue, image_size=64):
     label = input_queue[1]
+    return read_image(input_queue[0], image_size), label
 
-    raw_image = tf.read_file(input_queue[0])
+def read_image(path, image_size=64):
+    raw_image = tf.read_file(path)
     image = tf.image.decode_jpeg(raw_image, channels=3)
 
-    image.set_shape([64, 64, 3])
+    # images are served at the resolution being trained, which changes
+    # from stage to stage with progressive training
+    image = tf.image.resize_images(image, [image_size, image_size], method=tf.image.ResizeMethod.AREA)
+    image.set_shape([image_size, image_size, 3])
     tf.to_float(image)
 
-    return image, label
+    return image
+
+def get_shard(shard_index=0, num_shards=1, labels=None):
+    image_list, label_list = get_image_label_list(labels)
+    # every data parallel worker reads its own disjoint shard
+    return image_list[shard_index::num_shards], label_list[shard_index::num_shards]
 
-def get_image_label_list():
+def get_image_label_list(labels=None):
+    """
+    labels: only keep the images of those labels, e.g. the fonts fine tuned
+    """
     ng_path    = "/home/jcm/thesis/celebA/0/"
     gl_path    = "/home/jcm/thesis/celebA/1/"
 
@@ -49,6 +72,13 @@ def get_image_label_list():
     image_list   = ng_list + gl_list
     label_list = [0] * len(ng_list) + [1] * len(gl_list)
 
+    if labels is not None:
+        kept = [i for i, label in enumerate(label_list) if label in labels]
+        if not kept:
+            raise Exception("no training images with labels %s" % labels)
+        image_list = [image_list[i] for i in kept]
+        label_list = [label_list[i] for i in kept]
+
     return image_list, label_list
 
 # class PickledImageProvider(object):
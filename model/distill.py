@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from .ops import conv2d, init_embedding
+from .utils import load_glyphs
+from .metrics import batch_metrics, summarize
+
+# Distillation of a trained generator (teacher) into a compact one
+# (student) with a smaller generator_dim, kernel_size or generator_depth.
+# The teacher is built under the "teacher" scope and frozen, the student
+# under the usual "generator"/"embedding" names so its checkpoint exports
+# and loads like any generator. The student learns on source glyphs only,
+# no targets are needed, with random embedding ids so every style is
+# covered:
+# * L1 between the student and teacher outputs
+# * optionally the mean squared error between the encoder layers of the
+#   same width, through 1x1 convolutions adapting the student channels
+
+
+def scope_vars(prefix):
+    return [v for v in tf.global_variables() if v.op.name.startswith(prefix)]
+
+
+def student_vars():
+    return scope_vars("generator/") + scope_vars("embedding/")
+
+
+def restore_teacher(sess, teacher_dir):
+    ckpt = tf.train.get_checkpoint_state(teacher_dir)
+    if not ckpt:
+        raise Exception("no teacher checkpoint found in %s" % teacher_dir)
+    # the teacher checkpoint has no "teacher/" prefix
+    var_list = dict((v.op.name[len("teacher/"):], v) for v in scope_vars("teacher/"))
+    tf.train.Saver(var_list=var_list).restore(sess, ckpt.model_checkpoint_path)
+    print("restored teacher %s" % ckpt.model_checkpoint_path)
+
+
+def build_pair(teacher, student, source, embedding_ids, inst_norm, student_training):
+    with tf.variable_scope("teacher"):
+        t_embedding = init_embedding(teacher.embedding_num, teacher.embedding_dim)
+        t_output, _, t_layers = teacher.generator(source, t_embedding, embedding_ids, inst_norm,
+                                                  is_training=False, return_layers=True)
+    s_embedding = init_embedding(student.embedding_num, student.embedding_dim)
+    s_output, _, s_layers = student.generator(source, s_embedding, embedding_ids, inst_norm,
+                                              is_training=student_training, return_layers=True)
+    return (t_output, t_layers, t_embedding), (s_output, s_layers, s_embedding)
+
+
+class Distiller(object):
+    def __init__(self, teacher, student, teacher_dir, inst_norm=False, feature_penalty=0.0, lr=0.0002):
+        """
+        teacher, student: GEGAN with the same batch size, image size and
+            embeddings, student is given the experiment_dir to checkpoint in
+        """
+        if (teacher.batch_size, teacher.output_width, teacher.embedding_num) != \
+                (student.batch_size, student.output_width, student.embedding_num):
+            raise Exception("teacher and student differ in batch size, image size or embeddings")
+        self.teacher        = teacher
+        self.student        = student
+        self.teacher_dir    = teacher_dir
+
+        self.source = tf.placeholder(tf.float32, [student.batch_size, student.input_width, student.input_width,
+                                                  student.input_filters], name="source")
+        self.embedding_ids = tf.placeholder(tf.int64, [student.batch_size], name="embedding_ids")
+        (t_output, t_layers, t_embedding), (s_output, s_layers, s_embedding) = \
+            build_pair(teacher, student, self.source, self.embedding_ids, inst_norm, student_training=True)
+
+        self.output_loss = tf.reduce_mean(tf.abs(s_output - tf.stop_gradient(t_output)))
+        feature_losses = list()
+        if feature_penalty > 0:
+            with tf.variable_scope("distill"):
+                for name in sorted(s_layers):
+                    if name not in t_layers:
+                        continue
+                    s_layer, t_layer = s_layers[name], tf.stop_gradient(t_layers[name])
+                    if s_layer.get_shape().as_list()[1] != t_layer.get_shape().as_list()[1]:
+                        continue
+                    adapted = conv2d(s_layer, t_layer.get_shape().as_list()[-1], kh=1, kw=1, sh=1, sw=1,
+                                     scope="adapt_%s" % name)
+                    feature_losses.append(tf.reduce_mean(tf.square(adapted - t_layer)))
+        self.feature_loss = tf.add_n(feature_losses) / len(feature_losses) if feature_losses else tf.constant(0.0)
+        self.loss = self.output_loss + feature_penalty * self.feature_loss
+
+        train_vars = [v for v in tf.trainable_variables() if not v.op.name.startswith("teacher/")]
+        self.train_op = tf.train.AdamOptimizer(lr, beta1=0.5).minimize(self.loss, var_list=train_vars)
+        # start the student styles from the teacher ones when they fit
+        if s_embedding.get_shape() == t_embedding.get_shape():
+            self.init_embedding = s_embedding.assign(t_embedding)
+        else:
+            self.init_embedding = None
+        # everything but the teacher, so distillation resumes with its optimizer state
+        self.saver = tf.train.Saver(var_list=[v for v in tf.global_variables()
+                                              if not v.op.name.startswith("teacher/")], max_to_keep=3)
+
+    def train(self, sess, source_paths, steps=20000, checkpoint_steps=1000, resume=True, log_steps=50):
+        student = self.student
+        student.register_session(sess)
+        sess.run(tf.global_variables_initializer())
+        restore_teacher(sess, self.teacher_dir)
+        _, model_dir = student.get_model_id_and_dir()
+        resumed = resume and student.restore_model(self.saver, model_dir)
+        if not resumed and self.init_embedding is not None:
+            sess.run(self.init_embedding)
+
+        start_time = time.time()
+        for step in range(1, steps + 1):
+            paths = [source_paths[i] for i in np.random.randint(0, len(source_paths), student.batch_size)]
+            _, images = load_glyphs(paths, student.input_width)
+            ids = np.random.randint(0, student.embedding_num, student.batch_size)
+            _, output_loss, feature_loss = sess.run([self.train_op, self.output_loss, self.feature_loss],
+                                                    feed_dict={self.source: images, self.embedding_ids: ids})
+            if step % log_steps == 0:
+                passed = time.time() - start_time
+                print("distill step %d, %4.2fs, output_loss: %.5f, feature_loss: %.5f" %
+                      (step, passed, output_loss, feature_loss))
+            if step % checkpoint_steps == 0 or step == steps:
+                student.checkpoint(self.saver, step)
+                print("checkpoint: step %d" % step)
+        return model_dir
+
+
+def count_params(variables):
+    return sum(int(np.prod(v.get_shape().as_list())) for v in variables)
+
+
+def report(teacher, student, teacher_dir, student_dir, source_paths, inst_norm=False, steps=20, config=None):
+    """
+    Quality of the student against the teacher outputs on source_paths,
+    for every embedding, and the latency of both generators
+    """
+    batch_size = student.batch_size
+    with tf.Graph().as_default(), tf.Session(config=config) as sess:
+        source = tf.placeholder(tf.float32, [batch_size, student.input_width, student.input_width,
+                                             student.input_filters], name="source")
+        embedding_ids = tf.placeholder(tf.int64, [batch_size], name="embedding_ids")
+        (t_output, _, _), (s_output, _, _) = build_pair(teacher, student, source, embedding_ids, inst_norm,
+                                                        student_training=False)
+        restore_teacher(sess, teacher_dir)
+        student.register_session(sess)
+        if not student.restore_model(tf.train.Saver(var_list=student_vars()), student_dir):
+            raise Exception("no student checkpoint found in %s" % student_dir)
+
+        scores = dict()
+        for start in range(0, len(source_paths) - batch_size + 1, batch_size):
+            _, images = load_glyphs(source_paths[start:start + batch_size], student.input_width)
+            for embedding_id in range(student.embedding_num):
+                feed_dict = {source: images, embedding_ids: [embedding_id] * batch_size}
+                t_images, s_images = sess.run([t_output, s_output], feed_dict=feed_dict)
+                for name, values in batch_metrics(s_images, t_images).items():
+                    scores.setdefault(name, list()).append(values)
+        if not scores:
+            raise Exception("at least %d source glyphs are needed for the report" % batch_size)
+        quality = summarize(dict((name, np.concatenate(values)) for name, values in scores.items()))
+
+        feed_dict = {source: images, embedding_ids: [0] * batch_size}
+        latency = dict()
+        for name, output in [("teacher", t_output), ("student", s_output)]:
+            sess.run(output, feed_dict=feed_dict)
+            tick = time.time()
+            for _ in range(steps):
+                sess.run(output, feed_dict=feed_dict)
+            latency[name] = (time.time() - tick) / steps
+        params = {"teacher": count_params(scope_vars("teacher/generator/")),
+                  "student": count_params(scope_vars("generator/"))}
+
+    print("%-10s%14s%14s" % ("", "teacher", "student"))
+    print("%-10s%14d%14d" % ("params", params["teacher"], params["student"]))
+    print("%-10s%12.2fms%12.2fms" % ("latency", latency["teacher"] * 1000, latency["student"] * 1000))
+    print("speedup %.2fx" % (latency["teacher"] / latency["student"]))
+    print("student against teacher: %s" % ", ".join("%s %.4f" % kv for kv in sorted(quality.items())))
+    return {"latency": latency, "quality": quality, "params": params}
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from .gegan import GEGAN
+from .metrics import batch_metrics
+from .utils import list_glyphs, load_glyphs
+
+# Evaluation of the checkpoints written by GEGAN.checkpoint, out of the
+# training process. The evaluator polls the checkpoint directory, restores
+# every new checkpoint into its own inference graph, computes the metrics
+# on a held-out set in large batches and writes them as summaries under
+# logs/eval, next to the training summaries, so TensorBoard shows both.
+# The trainer only writes checkpoints and never waits for it.
+
+
+def load_eval_set(eval_dir, image_size):
+    """
+    Held-out images under eval_dir/<embedding id>/, return (images, labels)
+    """
+    images, labels = list(), list()
+    for label in sorted(os.listdir(eval_dir)):
+        label_dir = os.path.join(eval_dir, label)
+        if not os.path.isdir(label_dir) or not label.isdigit():
+            continue
+        paths = list_glyphs(label_dir)
+        if not paths:
+            continue
+        images.append(load_glyphs(paths, image_size)[1])
+        labels.extend([int(label)] * len(paths))
+    if not labels:
+        raise Exception("no held-out images found under %s/<embedding id>/" % eval_dir)
+    return np.concatenate(images), np.asarray(labels, dtype=np.int64)
+
+
+def checkpoint_step(path):
+    # saver.save appends -<global step>
+    return int(path.rsplit("-", 1)[1])
+
+
+class Evaluator(object):
+    def __init__(self, model, model_dir, log_dir, images, labels, inst_norm=False, config=None):
+        """
+        model: GEGAN to build the evaluation graph with, its batch size
+            is the evaluation batch size and can differ from training
+        """
+        self.model      = model
+        self.model_dir  = model_dir
+        self.images     = images
+        self.labels     = labels
+        self.last_step  = -1
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.sess = tf.Session(config=config)
+            model.register_session(self.sess)
+            model.build_model(is_training=False, inst_norm=inst_norm)
+            self.input_handle, self.loss_handle, self.eval_handle, _ = model.retrieve_handles()
+            # the graph has no optimizer, the slots in the checkpoint are skipped
+            self.saver = tf.train.Saver(var_list=tf.global_variables())
+        self.graph.finalize()
+        self.writer = tf.summary.FileWriter(os.path.join(log_dir, "eval"))
+
+    def new_checkpoint(self):
+        ckpt = tf.train.get_checkpoint_state(self.model_dir)
+        if not ckpt or checkpoint_step(ckpt.model_checkpoint_path) <= self.last_step:
+            return None
+        # only the latest one, the evaluator catches up instead of falling behind
+        return ckpt.model_checkpoint_path
+
+    def evaluate(self, path):
+        self.saver.restore(self.sess, path)
+        batch_size = self.model.batch_size
+        fetches = [self.eval_handle.fake_s, self.loss_handle.const_loss, self.loss_handle.category_loss,
+                   self.loss_handle.cheat_loss]
+        totals = {"const_loss": 0.0, "category_loss": 0.0, "cheat_loss": 0.0}
+
+        count = len(self.images)
+        for start in range(0, count, batch_size):
+            images = self.images[start:start + batch_size]
+            labels = self.labels[start:start + batch_size]
+            real = len(images)
+            if real < batch_size:
+                # pad the last batch, the padding is left out of the pixel
+                # metrics, the losses of that batch are weighted by its size
+                images = np.concatenate([images, np.repeat(images[:1], batch_size - real, axis=0)])
+                labels = np.concatenate([labels, np.repeat(labels[:1], batch_size - real)])
+            fake, const_loss, category_loss, cheat_loss = self.sess.run(fetches, feed_dict={
+                self.input_handle.real_data: images,
+                self.input_handle.embedding_ids: labels})
+            for name, values in batch_metrics(fake[:real], images[:real]).items():
+                totals[name] = totals.get(name, 0.0) + values.sum()
+            totals["const_loss"]    += const_loss * real
+            totals["category_loss"] += category_loss * real
+            totals["cheat_loss"]    += cheat_loss * real
+
+        return dict((k, v / count) for k, v in totals.items())
+
+    def write(self, step, metrics):
+        summary = tf.Summary(value=[tf.Summary.Value(tag="eval/%s" % k, simple_value=float(v))
+                                    for k, v in sorted(metrics.items())])
+        self.writer.add_summary(summary, step)
+        self.writer.flush()
+
+    def watch(self, poll_seconds=30, alive=None):
+        """
+        Evaluate new checkpoints until alive() returns False, alive is
+        e.g. whether the trainer is still running
+        """
+        while True:
+            path = self.new_checkpoint()
+            if path is None:
+                if alive is not None and not alive():
+                    break
+                time.sleep(poll_seconds)
+                continue
+            step = checkpoint_step(path)
+            tick = time.time()
+            try:
+                metrics = self.evaluate(path)
+            except tf.errors.NotFoundError:
+                # deleted by the saver of the trainer (max_to_keep) meanwhile
+                continue
+            self.write(step, metrics)
+            self.last_step = step
+            print("eval step %d (%.1fs): %s" % (step, time.time() - tick,
+                                                ", ".join("%s %.5f" % kv for kv in sorted(metrics.items()))))
+
+    def close(self):
+        self.writer.close()
+        self.sess.close()
+
+
+def create_evaluator(experiment_dir, experiment_id, train_batch_size, eval_dir, eval_batch_size=128,
+                     image_size=64, base_width=None, embedding_num=2, embedding_dim=64, inst_norm=False,
+                     config=None):
+    """
+    Evaluator for the checkpoints of the experiment trained with train_batch_size
+    """
+    # the checkpoint directory is named after the training batch size
+    trained = GEGAN(experiment_dir, experiment_id=experiment_id, batch_size=train_batch_size,
+                    input_width=image_size, output_width=image_size, base_width=base_width)
+    _, model_dir = trained.get_model_id_and_dir()
+
+    model = GEGAN(batch_size=eval_batch_size, input_width=image_size, output_width=image_size,
+                  base_width=base_width, embedding_num=embedding_num, embedding_dim=embedding_dim)
+    images, labels = load_eval_set(eval_dir, image_size)
+    print("evaluating %s on %d held-out images" % (model_dir, len(images)))
+    return Evaluator(model, model_dir, trained.log_dir, images, labels, inst_norm=inst_norm, config=config)
@@ -4,15 +4,16 @@ from __future__ import absolute_import
 
 import tensorflow as tf
 import numpy as np
-import scipy.misc as misc
+import math
 import os
 import time
-from tqdm import trange
 from collections import namedtuple
-from .ops import conv2d, deconv2d, lrelu, fc, batch_norm, init_embedding, conditional_instance_norm
-from .dataset import get_train_dataloader
-from .utils import normalize_image, denormalize_image, save_image
-from .vgg import VGG_Model
+from .ops import conv2d, deconv2d, lrelu, fc, batch_norm, init_embedding, conditional_instance_norm, recomputed, \
+    instance_norm, compute_precision
+
+# NOTE: scipy, tqdm, the data pipeline and the VGG model are only needed for
+# training, they are imported where they are used so that export and
+# inference do not pay for them at startup
 
 # Auxiliary wrapper classes
 # Used to save handles(important nodes in computation graph) for later evaluation
@@ -23,21 +24,58 @@ LossHandle = namedtuple("LossHandle",
                          "l1_loss",
                          "category_loss",
                          "cheat_loss",
-                         "vgg_loss"])
+                         "vgg_loss",
+                         "example_l1",
+                         "example_const",
+                         "preview_loss"])
 EvalHandle = namedtuple("EvalHandle",
                         ["encoder",
                          "fake_s",
                          "fake_c",
                          "source",
-                         "embedding"])
-InputHandle   = namedtuple("InputHandle",   ["real_data", "embedding_ids"])
+                         "embedding",
+                         "preview"])
+InputHandle   = namedtuple("InputHandle",   ["real_data", "embedding_ids", "embedding_ids_c", "bn_training",
+                                             "grow_alpha", "example_weights"])
 SummaryHandle = namedtuple("SummaryHandle", ["d_merged", "g_merged"])
+# training-only graph elements built on top of the model by build_train_ops
+TrainOps      = namedtuple("TrainOps",      ["learning_rate", "d_optimizer", "g_optimizer", "dataloader"])
+
+# filters of the encoder layers as multiples of generator_dim,
+# deeper layers (larger images) keep the last multiple
+ENCODER_MULTS = [1, 2, 4, 4, 8, 8]
+
+# blocks whose activations could be recomputed during backprop, groups
+# match the block names by prefix, e.g. "encoder" covers e2..e6 and the
+# grown layers ge1, ge2...
+RECOMPUTE_GROUPS = {"encoder": ("e", "ge"),
+                    "decoder": ("d", "gd")}
+
+
+def parse_recompute(recompute):
+    """
+    Turn "encoder,d1,vgg" into the set of names to recompute
+    """
+    if not recompute:
+        return set()
+    if isinstance(recompute, str):
+        recompute = [r.strip() for r in recompute.split(",") if r.strip()]
+    return set(recompute)
+
+
+def log2(width):
+    depth = int(round(math.log(width, 2)))
+    if 2 ** depth != width:
+        raise Exception("image width %d is not a power of 2" % width)
+    return depth
 
 
 class GEGAN(object):
     def __init__(self, experiment_dir=None, experiment_id=0, batch_size=16, input_width=64, output_width=64,
                  generator_dim=64, discriminator_dim=64, L1_penalty=100, Lconst_penalty=15, Lvgg_penalty=0.1,
-                 Lcategory_penalty=1.0, embedding_num=2, embedding_dim=64, input_filters=3, output_filters=3):
+                 Lcategory_penalty=1.0, embedding_num=2, embedding_dim=64, input_filters=3, output_filters=3,
+                 recompute=None, base_width=None, kernel_size=5, generator_depth=None, precision="float32",
+                 loss_scale=1.0, preview_factor=None):
         self.experiment_dir     = experiment_dir
         self.experiment_id      = experiment_id
         self.batch_size         = batch_size
@@ -53,8 +91,47 @@ class GEGAN(object):
         self.embedding_dim      = embedding_dim
         self.input_filters      = input_filters
         self.output_filters     = output_filters
-        self.train_dataloader   = get_train_dataloader(self.batch_size)
-        self.vgg                = VGG_Model()
+        # blocks that drop their activations and recompute them in backprop
+        self.recompute          = parse_recompute(recompute)
+        # the encoder goes all the way down to 1x1, its depth follows the
+        # image width. Progressive training starts at base_width and every
+        # doubling of the width since then inserts a grown layer
+        self.base_width         = base_width or output_width
+        self.base_depth         = log2(self.base_width)
+        self.grow_stages        = log2(output_width) - self.base_depth
+        if self.grow_stages < 0:
+            raise Exception("base width %d larger than output width %d" % (self.base_width, output_width))
+        self.grow_alpha         = None
+        # a compact generator (e.g. a distilled student) may stop the encoder
+        # before 1x1, the embedding is then tiled over the bottleneck
+        self.kernel_size        = kernel_size
+        self.generator_depth    = generator_depth or self.base_depth
+        if not 2 <= self.generator_depth <= self.base_depth:
+            raise Exception("generator depth %d out of [2, %d]" % (self.generator_depth, self.base_depth))
+        # dtype of the convolutions and matmuls of the generator, the
+        # discriminator and vgg, see ops.py. loss_scale multiplies the losses
+        # before the gradients and divides the gradients after, in case
+        # small gradients underflow in bfloat16
+        if precision not in ("float32", "bfloat16"):
+            raise Exception("unknown precision %s" % precision)
+        self.precision          = precision
+        self.compute_dtype      = tf.as_dtype(precision)
+        self.loss_scale         = loss_scale
+        # a cheap preview at output_width / preview_factor, read from the
+        # decoder layer of that width by a small head, see decoder
+        self.preview_factor     = preview_factor
+        self.preview_width      = output_width // preview_factor if preview_factor else None
+        if preview_factor and not (preview_factor > 1 and self.preview_width * preview_factor == output_width):
+            raise Exception("preview factor %d does not divide output width %d" % (preview_factor, output_width))
+        # constants of a generator specialized to one style, see specialize.py
+        self.style              = None
+        # training-only resources, created lazily by get_vgg/train
+        self.train_dataloader   = None
+        self.vgg                = None
+        self.train_ops          = None
+        # how the training graph was obtained and since when, see build_train_graph
+        self.graph_source       = None
+        self.graph_started      = None
         # init all the directories
         self.sess = None
         # experiment_dir is needed for training
@@ -74,81 +151,236 @@ class GEGAN(object):
                 os.makedirs(self.sample_dir)
                 print("create sample directory")
 
+    def get_vgg(self):
+        if self.vgg is None:
+            from .vgg import VGG_Model
+            self.vgg = VGG_Model()
+        return self.vgg
+
+    def get_train_dataloader(self, shard_index=0, num_shards=1, num_threads=4, labels=None):
+        if self.train_dataloader is None:
+            from .dataset import get_train_dataloader
+            self.train_dataloader = get_train_dataloader(self.batch_size, shard_index=shard_index,
+                                                         num_shards=num_shards, num_threads=num_threads,
+                                                         image_size=self.input_width, labels=labels)
+        return self.train_dataloader
+
+    def should_recompute(self, block):
+        if block in self.recompute:
+            return True
+        prefix = block.rstrip("0123456789")
+        return any(group in self.recompute and prefix in prefixes
+                   for group, prefixes in RECOMPUTE_GROUPS.items())
+
+    def encoder_filters(self, layer):
+        mult = ENCODER_MULTS[min(layer, len(ENCODER_MULTS)) - 1]
+        return self.generator_dim * mult
+
+    def generator_norm(self, x, is_training, scope, update_moving=True):
+        if self.style is not None:
+            # already folded into the weights of the specialized generator
+            return x
+        return batch_norm(x, is_training, scope=scope, update_moving=update_moving)
+
+    def fade_in(self, new, old):
+        """
+        Blend the output of the newest grown layer with the path it replaces
+        """
+        if self.grow_alpha is None:
+            return new
+        alpha = tf.cast(self.grow_alpha, new.dtype)
+        return alpha * new + (1.0 - alpha) * old
+
     def encoder(self, images, is_training, reuse=False):
-        with tf.variable_scope("generator"):
+        with tf.variable_scope("generator"), compute_precision(self.compute_dtype):
             if reuse:
                 tf.get_variable_scope().reuse_variables()
 
             encode_layers = dict()
 
-            def encode_layer(x, output_filters, layer):
-                act = lrelu(x)
-                conv = conv2d(act, output_filters=output_filters, scope="g_e%d_conv" % layer)
-                enc = batch_norm(conv, is_training, scope="g_e%d_bn" % layer)
-                encode_layers["e%d" % layer] = enc
+            def encode_layer(x, output_filters, name):
+                def block(x, is_recomputing=False):
+                    act = lrelu(x)
+                    conv = conv2d(act, output_filters=output_filters, kh=self.kernel_size, kw=self.kernel_size,
+                                  scope="g_%s_conv" % name)
+                    return self.generator_norm(conv, is_training, scope="g_%s_bn" % name,
+                                               update_moving=not is_recomputing)
+
+                if self.should_recompute(name):
+                    enc = recomputed(block, x)
+                else:
+                    enc = block(x)
+                encode_layers[name] = enc
                 return enc
 
-            e1 = conv2d(images, self.generator_dim, scope="g_e1_conv")
+            e1 = conv2d(images, self.generator_dim, kh=self.kernel_size, kw=self.kernel_size, scope="g_e1_conv")
             encode_layers["e1"] = e1
-            e2 = encode_layer(e1, self.generator_dim * 2, 2)
-            e3 = encode_layer(e2, self.generator_dim * 4, 3)
-            e4 = encode_layer(e3, self.generator_dim * 4, 4)
-            e5 = encode_layer(e4, self.generator_dim * 8, 5)
-            e6 = encode_layer(e5, self.generator_dim * 8, 6)
-
-            return e6, encode_layers
 
-    def decoder(self, encoded, encoding_layers, ids, inst_norm, is_training, reuse=False):
-        with tf.variable_scope("generator"):
+            # grown layers sit right after e1, the most recent one first,
+            # so every older layer keeps the width and filters of its input
+            current = e1
+            for stage in range(self.grow_stages, 0, -1):
+                enc = encode_layer(current, self.generator_dim, "ge%d" % stage)
+                if stage == self.grow_stages:
+                    enc = self.fade_in(enc, tf.nn.avg_pool(current, [1, 2, 2, 1], [1, 2, 2, 1], padding="SAME"))
+                    encode_layers["ge%d" % stage] = enc
+                current = enc
+
+            for layer in range(2, self.generator_depth + 1):
+                current = encode_layer(current, self.encoder_filters(layer), "e%d" % layer)
+
+            # the bottleneck goes into the const loss
+            return tf.cast(current, tf.float32), encode_layers
+
+    def preview_head(self, features):
+        """
+        Two convolutions from a decoder layer to an image at its width. The
+        decoder layer gets no gradient from the preview, the main generator
+        trains as without it
+        """
+        h = conv2d(tf.nn.relu(tf.stop_gradient(features)), self.generator_dim, kh=3, kw=3, sh=1, sw=1,
+                   scope="g_preview_conv1")
+        h = conv2d(tf.nn.relu(h), self.output_filters, kh=3, kw=3, sh=1, sw=1, scope="g_preview_conv2")
+        return tf.cast(tf.nn.tanh(h), tf.float32)
+
+    def decoder(self, encoded, encoding_layers, ids, inst_norm, is_training, reuse=False, preview=None):
+        """
+        preview: dict filled with the preview image ("output") and the
+            tensors the rest of the decoder needs ("resume"), feeding them
+            back computes the full output without the encoder and the layers
+            up to the preview
+        """
+        with tf.variable_scope("generator"), compute_precision(self.compute_dtype):
             if reuse:
                 tf.get_variable_scope().reuse_variables()
 
             s = self.output_width
-            s2, s4, s8, s16, s32 = int(s / 2), int(s / 4), int(s / 8), int(s / 16), int(s / 32)
-
-
-            def decode_layer(x, output_width, output_filters, layer, enc_layer, dropout=False, do_concat=True):
-                dec = deconv2d(tf.nn.relu(x), [self.batch_size, output_width,
-                                               output_width, output_filters], scope="g_d%d_deconv" % layer)
-                if layer != 6:
-                    # IMPORTANT: normalization for last layer
-                    # Very important, otherwise GAN is unstable
-                    # Trying conditional instance normalization to
-                    # overcome the fact that batch normalization offers
-                    # different train/test statistics
-                    if inst_norm:
-                        dec = conditional_instance_norm(dec, ids, self.embedding_num, scope="g_d%d_inst_norm" % layer)
-                    else:
-                        dec = batch_norm(dec, is_training, scope="g_d%d_bn" % layer)
+
+            def decode_layer(x, output_width, output_filters, name, enc_layer, dropout=False, do_concat=True,
+                             do_norm=True):
+                def block(x, is_recomputing=False):
+                    dec = deconv2d(tf.nn.relu(x), [self.batch_size, output_width, output_width, output_filters],
+                                   kh=self.kernel_size, kw=self.kernel_size, scope="g_%s_deconv" % name)
+                    if name == "d1" and self.style is not None:
+                        # contribution of the style embedding, folded at compile time
+                        dec = dec + self.style["d1_bias"]
+                    if do_norm:
+                        # IMPORTANT: normalization for last layer
+                        # Very important, otherwise GAN is unstable
+                        # Trying conditional instance normalization to
+                        # overcome the fact that batch normalization offers
+                        # different train/test statistics
+                        if inst_norm and self.style is not None:
+                            dec = instance_norm(dec, self.style["scale"][name], self.style["shift"][name])
+                        elif inst_norm:
+                            dec = conditional_instance_norm(dec, ids, self.embedding_num, scope="g_%s_inst_norm" % name)
+                        else:
+                            dec = self.generator_norm(dec, is_training, scope="g_%s_bn" % name,
+                                                      update_moving=not is_recomputing)
+                    return dec
+
+                # dropout stays out of the recomputed block,
+                # the recomputation would draw a different mask
+                if self.should_recompute(name):
+                    dec = recomputed(block, x)
+                else:
+                    dec = block(x)
                 if dropout:
-                    dec = tf.nn.dropout(dec, 0.5)
+                    dec = tf.cast(tf.nn.dropout(tf.cast(dec, tf.float32), 0.5), dec.dtype)
                 if do_concat:
                     dec = tf.concat([dec, enc_layer], 3)
                 return dec
 
-            d1 = decode_layer(encoded, s32, self.generator_dim * 8, layer=1, enc_layer=encoding_layers["e5"], dropout=True)
-            d2 = decode_layer(d1,      s16, self.generator_dim * 4, layer=2, enc_layer=encoding_layers["e4"])
-            d3 = decode_layer(d2,      s8,  self.generator_dim * 4, layer=3, enc_layer=encoding_layers["e3"])
-            d4 = decode_layer(d3,      s4,  self.generator_dim * 2, layer=4, enc_layer=encoding_layers["e2"])
-            d5 = decode_layer(d4,      s2,  self.generator_dim * 1, layer=5, enc_layer=encoding_layers["e1"])
-            d6 = decode_layer(d5,      s,   self.output_filters,    layer=6, enc_layer=None, do_concat=False)
-
-            output = tf.nn.tanh(d6)  # scale to (-1, 1)
-            return output
-
-    def generator(self, images, embeddings, embedding_ids, inst_norm, is_training, reuse=False):
+            def width(layer):
+                return layer.get_shape().as_list()[1]
+
+            def tap(current):
+                if self.preview_width is None or width(current) != self.preview_width or "output" in taps:
+                    return
+                taps["output"] = self.preview_head(current)
+                # the wider encoder layers are the skip connections still ahead
+                taps["resume"] = [current] + [layer for _, layer in sorted(encoding_layers.items())
+                                              if width(layer) > self.preview_width]
+
+            taps = dict() if preview is None else preview
+
+            # every decoder layer is concatenated with the encoder layer of
+            # the same width, d1 sits right after the bottleneck
+            depth   = self.generator_depth
+            current = encoded
+            for layer in range(1, depth - 1):
+                enc_layer = encoding_layers["e%d" % (depth - layer)]
+                current = decode_layer(current, width(enc_layer), self.encoder_filters(depth - layer), "d%d" % layer,
+                                       enc_layer=enc_layer, dropout=(layer == 1))
+                tap(current)
+
+            # the layers outside of e2, from the oldest grown one to e1
+            outer = ["ge%d" % stage for stage in range(1, self.grow_stages + 1)] + ["e1"]
+            enc_layer = encoding_layers[outer[0]]
+            current = decode_layer(current, width(enc_layer), self.generator_dim, "d%d" % (depth - 1),
+                                   enc_layer=enc_layer, dropout=(depth == 2))
+            tap(current)
+            for stage in range(1, self.grow_stages + 1):
+                enc_layer = encoding_layers[outer[stage]]
+                prev = current[:, :, :, :self.generator_dim]
+                dec = decode_layer(current, width(enc_layer), self.generator_dim, "gd%d" % stage,
+                                   enc_layer=None, do_concat=False)
+                if stage == self.grow_stages:
+                    dec = self.fade_in(dec, tf.image.resize_nearest_neighbor(prev, [width(enc_layer)] * 2))
+                current = tf.concat([dec, enc_layer], 3)
+                tap(current)
+
+            output = decode_layer(current, s, self.output_filters, "d%d" % depth, enc_layer=None,
+                                  do_concat=False, do_norm=False)
+            output = tf.nn.tanh(output)  # scale to (-1, 1)
+            if self.preview_width is not None and "output" not in taps:
+                raise Exception("no decoder layer of width %d for the preview" % self.preview_width)
+            return tf.cast(output, tf.float32)
+
+    def generator(self, images, embeddings, embedding_ids, inst_norm, is_training, reuse=False,
+                  return_layers=False, return_preview=False):
+        """
+        return_layers: also return the encoder layers by name, e.g. to
+            match intermediate features while distilling
+        return_preview: also return the preview dict of decoder, needs preview_factor
+        """
         e6, enc_layers = self.encoder(images, is_training=is_training, reuse=reuse)
-        local_embeddings = tf.nn.embedding_lookup(embeddings, ids=embedding_ids)
-        local_embeddings = tf.reshape(local_embeddings, [self.batch_size, 1, 1, self.embedding_dim])
-        embedded = tf.concat([e6, local_embeddings], 3)
-        output = self.decoder(embedded, enc_layers, embedding_ids, inst_norm, is_training=is_training, reuse=reuse)
-        return output, e6
-
-    def discriminator(self, image, is_training, reuse=False):
-        with tf.variable_scope("discriminator"):
+        if self.style is not None:
+            # the embedding is folded into the first decoder layer
+            embedded = e6
+        else:
+            local_embeddings = tf.nn.embedding_lookup(embeddings, ids=embedding_ids)
+            local_embeddings = tf.reshape(local_embeddings, [self.batch_size, 1, 1, self.embedding_dim])
+            bottleneck = e6.get_shape().as_list()[1]
+            if bottleneck > 1:
+                local_embeddings = tf.tile(local_embeddings, [1, bottleneck, bottleneck, 1])
+            embedded = tf.concat([e6, local_embeddings], 3)
+        preview = dict()
+        output = self.decoder(embedded, enc_layers, embedding_ids, inst_norm, is_training=is_training, reuse=reuse,
+                              preview=preview)
+        results = (output, e6)
+        if return_layers:
+            results += (enc_layers,)
+        if return_preview:
+            results += (preview,)
+        return results
+
+    def discriminator(self, image, is_training, reuse=False, return_features=False):
+        """
+        return_features: also return h3, the features under the real/fake
+            and category heads, e.g. to describe the style of glyphs
+        """
+        with tf.variable_scope("discriminator"), compute_precision(self.compute_dtype):
             if reuse:
                 tf.get_variable_scope().reuse_variables()
             h0 = lrelu(conv2d(image, self.discriminator_dim, scope="d_h0_conv"))
+            # grown layers keep the input width of h1, see encoder
+            for stage in range(self.grow_stages, 0, -1):
+                h = lrelu(batch_norm(conv2d(h0, self.discriminator_dim, scope="d_g%d_conv" % stage),
+                                     is_training, scope="d_g%d_bn" % stage))
+                if stage == self.grow_stages:
+                    h = self.fade_in(h, tf.nn.avg_pool(h0, [1, 2, 2, 1], [1, 2, 2, 1], padding="SAME"))
+                h0 = h
             h1 = lrelu(batch_norm(conv2d(h0, self.discriminator_dim * 2, scope="d_h1_conv"),
                                   is_training, scope="d_bn_1"))
             h2 = lrelu(batch_norm(conv2d(h1, self.discriminator_dim * 4, scope="d_h2_conv"),
@@ -159,36 +391,68 @@ class GEGAN(object):
             fc1 = fc(tf.reshape(h3, [self.batch_size, -1]), 1, scope="d_fc1")
             # category loss
             fc2 = fc(tf.reshape(h3, [self.batch_size, -1]), self.embedding_num, scope="d_fc2")
+            fc1, fc2 = tf.cast(fc1, tf.float32), tf.cast(fc2, tf.float32)
 
+            if return_features:
+                return tf.nn.sigmoid(fc1), fc1, fc2, tf.cast(h3, tf.float32)
             return tf.nn.sigmoid(fc1), fc1, fc2
 
-    def build_model(self, is_training=True, inst_norm=False, no_target_source=False):
-        real_data = tf.placeholder(tf.float32,
-                                   [self.batch_size, self.input_width, self.input_width, self.input_filters],
-                                   name='real_images')
-        embedding_ids   = tf.placeholder(tf.int64, shape=None, name="embedding_ids")
+    def build_model(self, is_training=True, inst_norm=False, no_target_source=False, inputs=None):
+        """
+        inputs: (real_data, embedding_ids) shared with the other models of
+            the graph, e.g. the trials of a sweep, placeholders by default
+        """
+        if inputs is None:
+            real_data = tf.placeholder(tf.float32,
+                                       [self.batch_size, self.input_width, self.input_width, self.input_filters],
+                                       name='real_images')
+            embedding_ids   = tf.placeholder(tf.int64, shape=None, name="embedding_ids")
+        else:
+            real_data, embedding_ids = inputs
         embedding_ids_c = tf.ones_like(embedding_ids) - embedding_ids # c means complementary
 
+        # batch norm mode while training, could be switched to the moving
+        # statistics, e.g. when gradients are accumulated over micro batches
+        if is_training:
+            bn_training = tf.placeholder_with_default(True, shape=[], name="bn_training")
+        else:
+            bn_training = False
+
+        # fade in of the layers grown by the current progressive stage
+        if is_training and self.grow_stages > 0:
+            self.grow_alpha = tf.placeholder_with_default(1.0, shape=[], name="grow_alpha")
+        else:
+            self.grow_alpha = None
+
+        # importance weights of the examples of a prioritized batch, see
+        # priority.py, the L1 and const losses are uniform means by default
+        example_weights = tf.placeholder_with_default(tf.ones([self.batch_size]), shape=[self.batch_size],
+                                                      name="example_weights")
+
         embedding = init_embedding(self.embedding_num, self.embedding_dim)
-        fake_s, encoded_real = self.generator(real_data, embedding, embedding_ids,   is_training=is_training,
-                                                inst_norm=inst_norm, reuse=False)
-        fake_c, _            = self.generator(real_data, embedding, embedding_ids_c, is_training=is_training,
+        fake_s, encoded_real, preview = self.generator(real_data, embedding, embedding_ids, is_training=bn_training,
+                                                       inst_norm=inst_norm, reuse=False, return_preview=True)
+        fake_c, _            = self.generator(real_data, embedding, embedding_ids_c, is_training=bn_training,
                                                 inst_norm=inst_norm, reuse=True)
 
         # Note it is not possible to set reuse flag back to False
         # initialize all variables before setting reuse to True
-        real_D,   real_D_logits,   real_category_logits   = self.discriminator(real_data, is_training=is_training, reuse=False)
-        fake_s_D, fake_s_D_logits, fake_s_category_logits = self.discriminator(fake_s,    is_training=is_training, reuse=True)
-        fake_c_D, fake_c_D_logits, fake_c_category_logits = self.discriminator(fake_c,    is_training=is_training, reuse=True)
+        real_D,   real_D_logits,   real_category_logits   = self.discriminator(real_data, is_training=bn_training, reuse=False)
+        fake_s_D, fake_s_D_logits, fake_s_category_logits = self.discriminator(fake_s,    is_training=bn_training, reuse=True)
+        fake_c_D, fake_c_D_logits, fake_c_category_logits = self.discriminator(fake_c,    is_training=bn_training, reuse=True)
 
         # encoding constant loss
         # this loss assume that generated imaged and real image
         # should reside in the same space and close to each other
-        encoded_fake_s = self.encoder(fake_s, is_training, reuse=True)[0]
-        encoded_fake_c = self.encoder(fake_c, is_training, reuse=True)[0]
-        const_loss_s   = tf.reduce_mean(tf.square(encoded_real - encoded_fake_s))
-        const_loss_c   = tf.reduce_mean(tf.square(encoded_real - encoded_fake_c))
-        const_loss     = (const_loss_s + const_loss_c) * self.Lconst_penalty
+        encoded_fake_s = self.encoder(fake_s, bn_training, reuse=True)[0]
+        encoded_fake_c = self.encoder(fake_c, bn_training, reuse=True)[0]
+        def example_mean(x):
+            return tf.reduce_mean(tf.reshape(x, [self.batch_size, -1]), axis=1)
+
+        const_loss_s   = example_mean(tf.square(encoded_real - encoded_fake_s))
+        const_loss_c   = example_mean(tf.square(encoded_real - encoded_fake_c))
+        example_const  = (const_loss_s + const_loss_c) * self.Lconst_penalty
+        const_loss     = tf.reduce_mean(example_weights * example_const)
 
         # category loss
         true_labels = tf.reshape(tf.one_hot(indices=embedding_ids,   depth=self.embedding_num),
@@ -212,12 +476,28 @@ class GEGAN(object):
                                                                                labels=tf.zeros_like(fake_c_D)))
 
         # L1 loss between real and generated images
-        l1_loss  = self.L1_penalty * tf.reduce_mean(tf.abs(fake_s - real_data))
+        example_l1 = self.L1_penalty * example_mean(tf.abs(fake_s - real_data))
+        l1_loss    = tf.reduce_mean(example_weights * example_l1)
+
+        # the preview head learns the real image at its width
+        if self.preview_width is not None:
+            factor = self.preview_factor
+            small_real = tf.nn.avg_pool(real_data, [1, factor, factor, 1], [1, factor, factor, 1], padding="SAME")
+            preview_loss = self.L1_penalty * tf.reduce_mean(
+                example_weights * example_mean(tf.abs(preview["output"] - small_real)))
+        else:
+            preview_loss = tf.constant(0.0, name="preview_loss")
 
         # vgg loss between real and fake_c
-        denorm_real_data = tf.clip_by_value((real_data + 1) * 127.5, 0.0, 255.0)
-        denorm_fake_c    = tf.clip_by_value((fake_c    + 1) * 127.5, 0.0, 255.0)
-        vgg_loss = self.vgg.vgg_loss(denorm_fake_c, denorm_real_data) * self.Lvgg_penalty
+        # only built for training, loading vgg-face.mat is expensive
+        if is_training:
+            denorm_real_data = tf.clip_by_value((real_data + 1) * 127.5, 0.0, 255.0)
+            denorm_fake_c    = tf.clip_by_value((fake_c    + 1) * 127.5, 0.0, 255.0)
+            with compute_precision(self.compute_dtype):
+                vgg_loss = self.get_vgg().vgg_loss(denorm_fake_c, denorm_real_data,
+                                                   recompute="vgg" in self.recompute) * self.Lvgg_penalty
+        else:
+            vgg_loss = tf.constant(0.0, name="vgg_loss")
 
         # maximize the chance generator fool the discriminator
         cheat_loss_s = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=fake_s_D_logits,
@@ -227,7 +507,7 @@ class GEGAN(object):
         cheat_loss   = cheat_loss_s + cheat_loss_c
 
         d_loss = d_loss_real + d_loss_fake_s + d_loss_fake_c + category_loss / 2.0
-        g_loss = cheat_loss + l1_loss + vgg_loss + const_loss + \
+        g_loss = cheat_loss + l1_loss + vgg_loss + const_loss + preview_loss + \
                  self.Lcategory_penalty * (fake_s_category_loss + fake_c_category_loss)
 
         # d_loss components
@@ -244,6 +524,7 @@ class GEGAN(object):
         l1_loss_summary               = tf.summary.scalar("l1_loss",              l1_loss)
         vgg_loss_summary              = tf.summary.scalar("vgg_loss",             vgg_loss)
         const_loss_summary            = tf.summary.scalar("const_loss",           const_loss)
+        preview_loss_summary          = tf.summary.scalar("preview_loss",         preview_loss)
         fake_s_category_loss_summary  = tf.summary.scalar("fake_s_category_loss", fake_s_category_loss)
         fake_c_category_loss_summary  = tf.summary.scalar("fake_c_category_loss", fake_c_category_loss)
 
@@ -259,13 +540,18 @@ class GEGAN(object):
                                              l1_loss_summary,
                                              vgg_loss_summary,
                                              const_loss_summary,
+                                             preview_loss_summary,
                                              fake_s_category_loss_summary,
                                              fake_c_category_loss_summary,
                                              g_loss_summary])
 
         # expose useful nodes in the graph as handles globally
-        input_handle    = InputHandle(real_data     = real_data,
-                                      embedding_ids = embedding_ids)
+        input_handle    = InputHandle(real_data         = real_data,
+                                      embedding_ids     = embedding_ids,
+                                      embedding_ids_c   = embedding_ids_c,
+                                      bn_training       = bn_training,
+                                      grow_alpha        = self.grow_alpha,
+                                      example_weights   = example_weights)
 
         loss_handle     = LossHandle(d_loss         = d_loss,
                                      g_loss         = g_loss,
@@ -273,13 +559,17 @@ class GEGAN(object):
                                      vgg_loss       = vgg_loss,
                                      const_loss     = const_loss,
                                      category_loss  = category_loss,
-                                     cheat_loss     = cheat_loss)
+                                     cheat_loss     = cheat_loss,
+                                     example_l1     = example_l1,
+                                     example_const  = example_const,
+                                     preview_loss   = preview_loss)
 
         eval_handle     = EvalHandle(encoder    = encoded_real,
                                      fake_s     = fake_s,
                                      fake_c     = fake_c,
                                      source     = real_data,
-                                     embedding  = embedding)
+                                     embedding  = embedding,
+                                     preview    = preview.get("output"))
 
         summary_handle  = SummaryHandle(d_merged = d_merged_summary,
                                         g_merged = g_merged_summary)
@@ -303,7 +593,7 @@ class GEGAN(object):
         if freeze_encoder:
             # exclude encoder weights
             print("freeze encoder weights")
-            g_vars = [var for var in g_vars if not ("g_e" in var.name)]
+            g_vars = [var for var in g_vars if not ("g_e" in var.name or "g_ge" in var.name)]
 
         return g_vars, d_vars
 
@@ -322,6 +612,10 @@ class GEGAN(object):
 
     def get_model_id_and_dir(self):
         model_id = "experiment_%d_batch_%d" % (self.experiment_id, self.batch_size)
+        if self.output_width != 64 or self.grow_stages > 0:
+            model_id += "_size_%d" % self.output_width
+        if self.generator_dim != 64 or self.kernel_size != 5 or self.generator_depth != self.base_depth:
+            model_id += "_g%d_k%d_d%d" % (self.generator_dim, self.kernel_size, self.generator_depth)
         model_dir = os.path.join(self.checkpoint_dir, model_id)
         return model_id, model_dir
 
@@ -341,8 +635,30 @@ class GEGAN(object):
         if ckpt:
             saver.restore(self.sess, ckpt.model_checkpoint_path)
             print("restored model %s" % model_dir)
+            return True
         else:
             print("fail to restore model %s" % model_dir)
+            return False
+
+    def restore_compatible(self, model_dir):
+        """
+        Restore the variables found in the checkpoint with the same shape,
+        e.g. from the previous stage of progressive training, the others
+        keep their initial values
+        """
+        ckpt = tf.train.get_checkpoint_state(model_dir)
+        if not ckpt:
+            print("fail to restore model %s" % model_dir)
+            return False
+
+        reader = tf.train.NewCheckpointReader(ckpt.model_checkpoint_path)
+        saved_shapes = reader.get_variable_to_shape_map()
+        var_list = [var for var in tf.global_variables()
+                    if saved_shapes.get(var.op.name) == var.get_shape().as_list()]
+        saver = tf.train.Saver(var_list=var_list)
+        saver.restore(self.sess, ckpt.model_checkpoint_path)
+        print("restored %d/%d variables from %s" % (len(var_list), len(tf.global_variables()), model_dir))
+        return True
 
     def generate_fake_samples(self, input_images, embedding_ids):
         input_handle, loss_handle, eval_handle, summary_handle = self.retrieve_handles()
@@ -360,26 +676,10 @@ class GEGAN(object):
                                                 })
         return fake_images, real_images, d_loss, g_loss, l1_loss
 
-    def validate_model(self, val_iter, epoch, step):
-        labels, images = next(val_iter)
-        fake_imgs, real_imgs, d_loss, g_loss, l1_loss = self.generate_fake_samples(images, labels)
-        print("Sample: d_loss: %.5f, g_loss: %.5f, l1_loss: %.5f" % (d_loss, g_loss, l1_loss))
-
-        merged_fake_images = merge(scale_back(fake_imgs), [self.batch_size, 1])
-        merged_real_images = merge(scale_back(real_imgs), [self.batch_size, 1])
-        merged_pair = np.concatenate([merged_real_images, merged_fake_images], axis=1)
-
-        model_id, _ = self.get_model_id_and_dir()
-
-        model_sample_dir = os.path.join(self.sample_dir, model_id)
-        if not os.path.exists(model_sample_dir):
-            os.makedirs(model_sample_dir)
-
-        sample_img_path = os.path.join(model_sample_dir, "sample_%02d_%04d.png" % (epoch, step))
-        misc.imsave(sample_img_path, merged_pair)
-
     def export_generator(self, save_dir, model_dir, model_name="gen_model"):
-        saver = tf.train.Saver()
+        # only the generator is exported, the checkpoint may hold nothing
+        # else, e.g. a distilled student
+        saver = tf.train.Saver(var_list=self.retrieve_generator_vars())
         self.restore_model(saver, model_dir)
 
         gen_saver = tf.train.Saver(var_list=self.retrieve_generator_vars())
@@ -490,74 +790,323 @@ class GEGAN(object):
             op = tf.assign(var, val, validate_shape=False)
             self.sess.run(op)
 
-    def train(self, lr=0.0002, epoch=100, schedule=10, resume=True, flip_labels=False,
-              freeze_encoder=False, fine_tune=None, sample_steps=50, checkpoint_steps=1000):
+    def update_class(self, accumulate_steps=1, reducer=None):
+        from .optim import LocalUpdate, AllReduceUpdate, AccumulateUpdate
+        if accumulate_steps > 1:
+            return AccumulateUpdate
+        if reducer is None:
+            return LocalUpdate
+        return AllReduceUpdate
+
+    def build_update(self, learning_rate, loss, var_list, accumulate_steps=1, reducer=None):
+        from .optim import LocalUpdate, LossScaleOptimizer
+        adam = tf.train.AdamOptimizer(learning_rate, beta1=0.5)
+        if self.loss_scale != 1.0:
+            adam = LossScaleOptimizer(adam, self.loss_scale)
+        update = self.update_class(accumulate_steps, reducer)
+        if update is LocalUpdate:
+            return LocalUpdate(adam, loss, var_list)
+        return update(adam, loss, var_list, reducer)
+
+    def build_train_ops(self, freeze_encoder=False, reducer=None, reader_threads=4, accumulate_steps=1,
+                        fine_tune=None, sampling="uniform"):
         g_vars, d_vars = self.retrieve_trainable_vars(freeze_encoder=freeze_encoder)
+        _, loss_handle, _, _ = self.retrieve_handles()
+
+        learning_rate   = tf.placeholder(tf.float32, name="learning_rate")
+        d_optimizer     = self.build_update(learning_rate, loss_handle.d_loss, d_vars, accumulate_steps, reducer)
+        g_optimizer     = self.build_update(learning_rate, loss_handle.g_loss, g_vars, accumulate_steps, reducer)
+        if sampling == "priority":
+            # the examples are chosen in python, see priority.py
+            from .dataset import get_example_loader
+            train_dataloader = get_example_loader(self.batch_size, image_size=self.input_width,
+                                                  num_threads=reader_threads)
+        elif sampling != "uniform":
+            raise Exception("unknown sampling %s" % sampling)
+        elif reducer is None:
+            train_dataloader = self.get_train_dataloader(num_threads=reader_threads, labels=fine_tune)
+        else:
+            train_dataloader = self.get_train_dataloader(shard_index=reducer.rank, num_shards=reducer.num_workers,
+                                                         num_threads=reader_threads, labels=fine_tune)
+        self.train_ops = TrainOps(learning_rate, d_optimizer, g_optimizer, train_dataloader)
+        return self.train_ops
+
+    def train_graph_hash(self, inst_norm, freeze_encoder, reducer, reader_threads, accumulate_steps, fine_tune=None,
+                         sampling="uniform"):
+        from .graph_cache import config_hash
+        from .dataset import get_image_label_list
+        image_list, label_list = get_image_label_list(fine_tune)
+        config = {"model": [self.batch_size, self.input_width, self.output_width, self.generator_dim,
+                            self.discriminator_dim, self.L1_penalty, self.Lconst_penalty, self.Lvgg_penalty,
+                            self.Lcategory_penalty, self.embedding_num, self.embedding_dim, self.input_filters,
+                            self.output_filters, sorted(self.recompute), self.base_width, self.kernel_size,
+                            self.generator_depth, self.precision, self.loss_scale, self.preview_factor],
+                  "train": [bool(inst_norm), bool(freeze_encoder), reader_threads, accumulate_steps, sampling,
+                            None if reducer is None else [reducer.rank, reducer.num_workers]],
+                  "data":  [image_list, label_list]}
+        return config_hash(config)
+
+    def build_train_graph(self, inst_norm=False, freeze_encoder=False, reducer=None, reader_threads=4,
+                          accumulate_steps=1, fine_tune=None, sampling="uniform", graph_cache=True):
+        """
+        build_model and build_train_ops, with graph_cache the training graph is
+        exported as a MetaGraph next to the checkpoint and imported instead of
+        built the next time, as long as nothing that shapes it has changed
+        """
+        from .graph_cache import add_to_collections, get_from_collections, meta_path, export_graph
+        from .optim import collect_update, restore_update
+
+        self.graph_started = time.time()
+        _, model_dir = self.get_model_id_and_dir()
+        rank = 0 if reducer is None else reducer.rank
+        digest = None
+        if graph_cache:
+            digest = self.train_graph_hash(inst_norm, freeze_encoder, reducer, reader_threads, accumulate_steps,
+                                           fine_tune, sampling)
+
+        path = meta_path(model_dir, rank, digest) if digest else None
+        if path and os.path.exists(path):
+            tf.train.import_meta_graph(path)
+            handles = list()
+            for group, handle in [("input", InputHandle), ("loss", LossHandle), ("eval", EvalHandle),
+                                  ("summary", SummaryHandle)]:
+                handles.append(handle(**get_from_collections(group, handle._fields)))
+            self.input_handle, self.loss_handle, self.eval_handle, self.summary_handle = handles
+            self.grow_alpha = self.input_handle.grow_alpha
+            train = get_from_collections("train", ["learning_rate", "dataloader"], lists=["dataloader"])
+            update = self.update_class(accumulate_steps, reducer)
+            self.train_dataloader = train["dataloader"]
+            self.train_ops = TrainOps(train["learning_rate"], restore_update(update, "d_optimizer", reducer),
+                                      restore_update(update, "g_optimizer", reducer), self.train_dataloader)
+            self.graph_source = "imported"
+        else:
+            self.build_model(is_training=True, inst_norm=inst_norm)
+            train_ops = self.build_train_ops(freeze_encoder, reducer, reader_threads, accumulate_steps, fine_tune,
+                                             sampling)
+            self.graph_source = "built"
+            if path:
+                for group, handle in zip(["input", "loss", "eval", "summary"], self.retrieve_handles()):
+                    add_to_collections(group, handle._asdict())
+                add_to_collections("train", {"learning_rate": train_ops.learning_rate,
+                                             "dataloader": list(train_ops.dataloader)})
+                collect_update(train_ops.d_optimizer, "d_optimizer")
+                collect_update(train_ops.g_optimizer, "g_optimizer")
+                export_graph(model_dir, rank, digest)
+                print("exported training graph %s" % path)
+        print("training graph %s in %.2fs" % (self.graph_source, time.time() - self.graph_started))
+        return self.train_ops
+
+    def train(self, lr=0.0002, epoch=100, schedule=10, resume=True, flip_labels=False,
+              freeze_encoder=False, fine_tune=None, sample_steps=50, checkpoint_steps=1000,
+              max_steps=100000, reducer=None, reader_threads=4, accumulate_steps=1, bn_mode="micro",
+              init_dir=None, fade_steps=0, phases=None, plateau_delta=0.01, plateau_warmup=1000,
+              sampling="uniform", priority=None):
+        """
+        schedule: number of epochs in between the learning rate is halved, 0 to keep it
+        flip_labels: shuffle the labels of the complementary generator pass
+        fine_tune: labels to train on, None for all of them
+        accumulate_steps: number of micro batches of batch_size whose gradients
+            are summed up before each update, the effective batch size is
+            batch_size * accumulate_steps while the memory stays at one micro batch
+        bn_mode: batch norm behaviour while accumulating, "micro" normalizes
+            with the statistics of each micro batch, "moving" uses the moving
+            statistics learned so far and keeps them frozen, for fine tuning
+            a restored checkpoint or init_dir only
+        init_dir: checkpoint directory to take the compatible weights from when
+            there is nothing to resume, e.g. the previous progressive stage
+        fade_steps: number of steps over which the layers grown by the
+            current progressive stage are faded in, only when it starts from
+            init_dir
+        phases: PlateauRule list, switching flip_labels, the learning rate,
+            freeze_encoder or stopping on plateaus of the losses, see phases.py
+        plateau_delta: relative improvement of a smoothed loss that resets its plateau
+        plateau_warmup: number of steps before any rule fires
+        sampling: "uniform" shuffled queue or "priority", examples drawn in
+            proportion to their recent L1 and const losses
+        priority: PrioritySampler options, e.g. {"alpha": 1.0, "beta": 0.5, "floor": 0.1}
+        """
+        from tqdm import trange
+        from .utils import denormalize_image, save_image
+        from .phases import PhaseController
+        from .dataset import get_image_label_list
+
         input_handle, loss_handle, eval_handle, summary_handle = self.retrieve_handles()
 
         if not self.sess:
             raise Exception("no session registered")
 
-        learning_rate   = tf.placeholder(tf.float32, name="learning_rate")
-        d_optimizer     = tf.train.AdamOptimizer(learning_rate, beta1=0.5).minimize(loss_handle.d_loss, var_list=d_vars)
-        g_optimizer     = tf.train.AdamOptimizer(learning_rate, beta1=0.5).minimize(loss_handle.g_loss, var_list=g_vars)
+        # in data parallel mode only the chief writes samples and checkpoints
+        is_chief        = reducer is None or reducer.is_chief
+
+        if bn_mode not in ("micro", "moving"):
+            raise Exception("unknown batch norm mode %s" % bn_mode)
+
+        if self.train_ops is None:
+            # the model was built by the caller, build_train_graph was not used
+            self.graph_source, self.graph_started = "built", time.time()
+            self.build_train_ops(freeze_encoder, reducer, reader_threads, accumulate_steps, fine_tune, sampling)
+        learning_rate, d_optimizer, g_optimizer, train_dataloader = self.train_ops
         tf.global_variables_initializer().run()
+        tf.local_variables_initializer().run()
         real_data       = input_handle.real_data
         embedding_ids   = input_handle.embedding_ids
 
         tf.train.start_queue_runners(sess=self.sess)
         saver = tf.train.Saver(max_to_keep=3)
-        summary_writer = tf.summary.FileWriter(self.log_dir, self.sess.graph)
+        if is_chief:
+            summary_writer = tf.summary.FileWriter(self.log_dir, self.sess.graph)
 
-        if resume:
-            _, model_dir = self.get_model_id_and_dir()
-            self.restore_model(saver, model_dir)
+        num_workers = 1 if reducer is None else reducer.num_workers
+        controller = PhaseController(phases or [], lr, flip_labels=flip_labels, freeze_encoder=freeze_encoder,
+                                     min_delta=plateau_delta, warmup=plateau_warmup, reducer=reducer)
+        _, model_dir = self.get_model_id_and_dir()
+        phases_path = os.path.join(model_dir, "phases.json")
 
-        max_step    = 100000
-        current_lr  = 0.0001
+        restored = False
+        if resume:
+            restored = self.restore_model(saver, model_dir)
+            if restored and controller.load(phases_path):
+                print("resumed phase: lr %g, flip_labels %s, freeze_encoder %s" %
+                      (controller.lr, controller.flip_labels, controller.freeze_encoder))
+        initialized = False
+        if not restored and init_dir:
+            initialized = self.restore_compatible(init_dir)
+        if bn_mode == "moving" and not restored and not initialized:
+            # frozen statistics are never updated, from scratch they would
+            # stay at their initial values
+            raise Exception("bn_mode moving needs a checkpoint to resume or an init_dir")
+        if not initialized:
+            # only layers grown on top of the previous stage are faded in. A
+            # resumed stage faded them in before its checkpoint, its steps
+            # count from 0 again and would blend them back out
+            fade_steps = 0
+
+        sampler = None
+        if sampling == "priority":
+            from .dataset import get_shard
+            from .priority import PrioritySampler, PriorityLoader
+            rank = 0 if reducer is None else reducer.rank
+            image_list, label_list = get_shard(rank, num_workers, fine_tune)
+            sampler = PrioritySampler(len(image_list), **(priority or {}))
+            priority_path = os.path.join(model_dir, "priorities_%d.npy" % rank)
+            if restored and sampler.load(priority_path):
+                print("resumed the priorities of %d examples" % len(sampler))
+            loader = PriorityLoader(self.sess, sampler, image_list, label_list, train_dataloader,
+                                    self.batch_size)
+
+        if reducer is not None:
+            from .parallel import sync_variables
+            # vgg weights are constants loaded from disk, everything else
+            # starts from the values of the chief
+            replicated_vars = [var for var in tf.global_variables() if not var.name.startswith("vgg/")]
+            bn_stat_vars    = [var for var in replicated_vars if "moving_" in var.name]
+            sync_variables(self.sess, reducer, replicated_vars, average=False)
+
+        def freeze():
+            # the encoder was trained so far, the generator gets a new update
+            # without its weights, the saver leaves the new optimizer slots out
+            created = set(tf.global_variables())
+            g_vars, _ = self.retrieve_trainable_vars(freeze_encoder=True)
+            update = self.build_update(learning_rate, loss_handle.g_loss, g_vars, accumulate_steps, reducer)
+            self.sess.run(tf.variables_initializer([v for v in tf.global_variables() if v not in created]))
+            return update
+
+        def log_phase(t):
+            summary = tf.Summary(value=[tf.Summary.Value(tag="phase/lr", simple_value=controller.lr),
+                                        tf.Summary.Value(tag="phase/flip_labels",
+                                                         simple_value=float(controller.flip_labels)),
+                                        tf.Summary.Value(tag="phase/freeze_encoder",
+                                                         simple_value=float(controller.freeze_encoder))])
+            summary_writer.add_summary(summary, t)
+            summary_writer.flush()
+
+        if controller.freeze_encoder and not freeze_encoder:
+            g_optimizer = freeze()
+        encoder_frozen = controller.freeze_encoder
+
+        # the schedule is in epochs of this worker's shard
+        if schedule > 0:
+            examples = len(get_image_label_list(fine_tune)[0]) // num_workers
+            schedule_steps = max(1, schedule * examples // (self.batch_size * accumulate_steps))
+        max_step    = max_steps
         log_step    = 50
-
-        for t in trange(max_step):
-            batch_images, labels = self.sess.run(self.train_dataloader)
-            batch_images = batch_images / 127.5 - 1.0
+        check_step  = 50
+        if is_chief:
+            log_phase(0)
+
+        # max_steps can be 0, e.g. a finished stage resumed
+        t, time_to_first_step = -1, None
+        start_time = time.time()
+        for t in trange(max_step, disable=not is_chief):
+            feed_dicts = list()
+            batch_indices = list()
+            for _ in range(accumulate_steps):
+                if sampler is None:
+                    batch_images, labels = self.sess.run(train_dataloader)
+                else:
+                    batch_images, labels, indices, weights = loader.next()
+                    batch_indices.append(indices)
+                batch_images = batch_images / 127.5 - 1.0
+
+                feed_dict = {
+                    real_data: batch_images,
+                    embedding_ids: labels,
+                    learning_rate: controller.lr
+                }
+                if controller.flip_labels:
+                    # label shuffling, the complementary pass gets the labels
+                    # of other examples of the batch instead
+                    feed_dict[input_handle.embedding_ids_c] = np.random.permutation(labels)
+                if sampler is not None:
+                    feed_dict[input_handle.example_weights] = weights
+                if bn_mode == "moving":
+                    feed_dict[input_handle.bn_training] = False
+                if input_handle.grow_alpha is not None and fade_steps > 0:
+                    feed_dict[input_handle.grow_alpha] = min(1.0, float(t) / fade_steps)
+                feed_dicts.append(feed_dict)
 
             # optimize D
-            _, batch_d_loss, d_summary = self.sess.run([d_optimizer,
-                                                        loss_handle.d_loss,
-                                                        summary_handle.d_merged],
-                                                       feed_dict={
-                                                           real_data: batch_images,
-                                                           embedding_ids: labels,
-                                                           learning_rate: current_lr
-                                                       })
+            batch_d_loss, d_summary = d_optimizer.run(self.sess,
+                                                      [loss_handle.d_loss,
+                                                       summary_handle.d_merged],
+                                                      feed_dicts)
             # optimize G
-            _, batch_g_loss = self.sess.run([g_optimizer, loss_handle.g_loss],
-                                            feed_dict={
-                                                real_data: batch_images,
-                                                embedding_ids: labels,
-                                                learning_rate: current_lr
-                                            })
+            batch_g_loss = g_optimizer.run(self.sess, loss_handle.g_loss, feed_dicts)
 
             # magic move to train G again
             # according to https://github.com/carpedm20/DCGAN-tensorflow
             # collect all the losses along the way
-            _, batch_g_loss, category_loss, cheat_loss, \
-            const_loss, l1_loss, vgg_loss, g_summary = self.sess.run([g_optimizer,
-                                                                     loss_handle.g_loss,
-                                                                     loss_handle.category_loss,
-                                                                     loss_handle.cheat_loss,
-                                                                     loss_handle.const_loss,
-                                                                     loss_handle.l1_loss,
-                                                                     loss_handle.vgg_loss,
-                                                                     summary_handle.g_merged],
-                                                                    feed_dict={
-                                                                        real_data: batch_images,
-                                                                        embedding_ids: labels,
-                                                                        learning_rate: current_lr
-                                                                    })
-
-            if t % log_step == 0:
+            micro_results = g_optimizer.run(self.sess,
+                                            [loss_handle.g_loss,
+                                             loss_handle.category_loss,
+                                             loss_handle.cheat_loss,
+                                             loss_handle.const_loss,
+                                             loss_handle.l1_loss,
+                                             loss_handle.vgg_loss,
+                                             summary_handle.g_merged,
+                                             loss_handle.example_l1,
+                                             loss_handle.example_const],
+                                            feed_dicts, collect=True)
+            # the logged losses are those of the last micro batch
+            batch_g_loss, category_loss, cheat_loss, \
+            const_loss, l1_loss, vgg_loss, g_summary, _, _ = micro_results[-1]
+            if sampler is not None:
+                # every example drawn for the step gets its loss
+                for indices, results in zip(batch_indices, micro_results):
+                    sampler.update(indices, results[-2] + results[-1])
+            # the names are phases.LOSSES
+            controller.update({"d_loss": batch_d_loss, "g_loss": batch_g_loss, "category_loss": category_loss,
+                               "cheat_loss": cheat_loss, "const_loss": const_loss, "l1_loss": l1_loss,
+                               "vgg_loss": vgg_loss})
+            if t == 0:
+                time_to_first_step = time.time() - self.graph_started
+                if is_chief:
+                    print("time to first step: %.2fs (graph %s)" % (time_to_first_step, self.graph_source))
+
+            if t % log_step == 0 and is_chief:
                 print("[{}]/[{}] D_loss: {} G_loss: {} vgg_loss: {}".format(t, max_step, batch_d_loss, batch_g_loss, vgg_loss))
+                if sampler is not None:
+                    print("priority sampling: %s" % ", ".join("%s %.4f" % kv for kv in sorted(sampler.stats().items())))
                 fake_s, fake_c = self.sess.run([eval_handle.fake_s, eval_handle.fake_c],
                                                feed_dict={
                                                    real_data: batch_images,
@@ -570,6 +1119,40 @@ class GEGAN(object):
                 save_image(fake_s, os.path.join(self.experiment_dir, "sample", "{}_fake_s.jpg".format(t)))
                 save_image(fake_c, os.path.join(self.experiment_dir, "sample", "{}_fake_c.jpg".format(t)))
 
-            if t % checkpoint_steps == 0:
-                print("Checkpoint: save checkpoint step: {}".format(t))
-                self.checkpoint(saver, t)
+            switched = t > 0 and t % check_step == 0 and controller.check(t)
+            if schedule > 0 and t > 0 and t % schedule_steps == 0:
+                controller.switch(t, "decay_lr", "schedule")
+                switched = True
+            if switched:
+                if controller.freeze_encoder and not encoder_frozen:
+                    g_optimizer = freeze()
+                    encoder_frozen = True
+                if is_chief:
+                    log_phase(t)
+
+            if t % checkpoint_steps == 0 or t == max_step - 1 or controller.stop:
+                if reducer is not None:
+                    # every replica tracked its own batch norm statistics
+                    sync_variables(self.sess, reducer, bn_stat_vars, average=True)
+                if is_chief:
+                    print("Checkpoint: save checkpoint step: {}".format(t))
+                    self.checkpoint(saver, t)
+                    controller.save(phases_path)
+                if sampler is not None:
+                    # every worker samples its own shard
+                    sampler.save(priority_path)
+            if controller.stop:
+                print("early stop at step %d" % t)
+                break
+
+        elapsed = time.time() - start_time
+        steps = t + 1
+        trained = steps * self.batch_size * accumulate_steps * num_workers
+        if sampler is not None:
+            loader.close()
+        return {"steps": steps,
+                "seconds": elapsed,
+                "graph": self.graph_source,
+                "time_to_first_step": time_to_first_step,
+                "switches": controller.switches,
+                "examples_per_sec": trained / elapsed if steps else 0.0}
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import glob
+import hashlib
+import json
+import os
+
+import tensorflow as tf
+
+# Cache of the built training graph as a MetaGraph next to the checkpoint.
+# Building it in python walks the vgg .mat file, builds every generator,
+# discriminator and encoder pass, the summaries and both optimizers;
+# importing the MetaGraph skips all of that on a restart.
+#
+# The cached graph is only used when the hash of everything that shapes
+# it matches: the model configuration, the training options, the image
+# list baked into the input pipeline, the tensorflow version and the
+# source of the model package. The python objects used by the training
+# loop (handles, optimizers) are found back through graph collections
+# named gegan/<group>/<member>.
+
+PREFIX = "gegan"
+
+
+def add_to_collections(group, members):
+    """
+    members: {name: tensor, operation or list of them}, None and python
+    values (e.g. bn_training=False outside of training) are left out
+    """
+    for name, value in members.items():
+        if value is None or isinstance(value, (bool, int, float)):
+            continue
+        values = value if isinstance(value, list) else [value]
+        for v in values:
+            tf.add_to_collection("%s/%s/%s" % (PREFIX, group, name), v)
+
+
+def get_from_collections(group, names, lists=()):
+    members = dict()
+    for name in names:
+        values = tf.get_collection("%s/%s/%s" % (PREFIX, group, name))
+        members[name] = list(values) if name in lists else (values[0] if values else None)
+    return members
+
+
+def source_digest():
+    digest = hashlib.sha1()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(package_dir, "*.py"))):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def config_hash(config):
+    config = dict(config)
+    config["tensorflow"]    = tf.__version__
+    config["source"]        = source_digest()
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def meta_path(model_dir, rank, digest):
+    # one graph per data parallel rank, the input shard differs
+    return os.path.join(model_dir, "train_graph_%d_%s.meta" % (rank, digest[:16]))
+
+
+def export_graph(model_dir, rank, digest):
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+    path = meta_path(model_dir, rank, digest)
+    for stale in glob.glob(os.path.join(model_dir, "train_graph_%d_*.meta" % rank)):
+        if stale != path:
+            os.remove(stale)
+    tf.train.export_meta_graph(filename=path + ".tmp", clear_devices=True)
+    os.rename(path + ".tmp", path)
+    return path
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+if sys.version_info[0] >= 3:
+    import queue
+else:
+    import Queue as queue
+
+# Sharded, resumable generation of many styles x many characters.
+# The (style, glyph range) space is split into work units recorded in
+# job_dir/manifest.json. A unit is done once its output job_dir/units/<id>.npy
+# exists, it is written to a temporary file and renamed, so a unit killed
+# halfway is simply run again and a restarted job skips the finished ones.
+#
+# The generator weights are extracted from the checkpoint once into
+# job_dir/weights/*.npy. The workers memory map them and the graph takes
+# the weights as placeholders fed straight from the mapped arrays. The
+# .npy data is 64 byte aligned, so tensorflow uses the buffers in place
+# instead of copying them, and all the workers share one copy of the
+# weights in the page cache. Every worker reports its private (anon) and
+# shared (file) resident memory with the units it finished. Units are
+# handed out through a queue, a fast worker takes more of them.
+#
+# merge() writes the outputs in manifest order, the result does not depend
+# on which worker ran which unit.
+
+MANIFEST = "manifest.json"
+
+
+def unit_id(embedding_id, start):
+    return "s%04d_g%06d" % (embedding_id, start)
+
+
+def create_manifest(job_dir, model_dir, sources, embedding_ids, glyphs_per_unit, image_size, model=None):
+    """
+    Split the job into units, or load the manifest of the job started
+    before in job_dir. A manifest for different sources, styles, model
+    architecture or checkpoint is refused instead of mixing outputs.
+    model: GEGAN options of the architecture of the checkpoint
+    """
+    from .cache import checkpoint_id
+
+    # export_generator always writes the same path, the id also has the
+    # modification time, so a re-exported model is a different job
+    config = {"checkpoint":     checkpoint_id(model_dir),
+              "sources":        sources,
+              "embedding_ids":  embedding_ids,
+              "image_size":     image_size,
+              "model":          model or {}}
+
+    path = os.path.join(job_dir, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest["config"].get("checkpoint") != config["checkpoint"]:
+            raise Exception("the checkpoint in %s changed since the job in %s started, "
+                            "start it again in a new job_dir" % (model_dir, job_dir))
+        if manifest["config"] != config:
+            raise Exception("%s belongs to a different job" % job_dir)
+        return manifest
+
+    units = [{"id":             unit_id(embedding_id, start),
+              "embedding_id":   embedding_id,
+              "start":          start,
+              "end":            min(start + glyphs_per_unit, len(sources))}
+             for embedding_id in embedding_ids
+             for start in range(0, len(sources), glyphs_per_unit)]
+    manifest = {"config": config, "units": units}
+    for d in [job_dir, os.path.join(job_dir, "units")]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.rename(path + ".tmp", path)
+    return manifest
+
+
+def unit_path(job_dir, unit):
+    return os.path.join(job_dir, "units", unit["id"] + ".npy")
+
+
+def pending_units(job_dir, manifest):
+    return [u for u in manifest["units"] if not os.path.exists(unit_path(job_dir, u))]
+
+
+def extract_weights(job_dir, model_dir):
+    """
+    Save the generator weights of the checkpoint as .npy files the
+    workers can memory map, done once per job
+    """
+    from .specialize import read_generator_values
+
+    weights_dir = os.path.join(job_dir, "weights")
+    index_path = os.path.join(weights_dir, "index.json")
+    if os.path.exists(index_path):
+        return weights_dir
+    if not os.path.exists(weights_dir):
+        os.makedirs(weights_dir)
+
+    _, values = read_generator_values(model_dir)
+    index = dict()
+    for i, (name, value) in enumerate(sorted(values.items())):
+        filename = "%04d.npy" % i
+        np.save(os.path.join(weights_dir, filename), value.astype(np.float32))
+        index[name] = filename
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.rename(index_path + ".tmp", index_path)
+    return weights_dir
+
+
+def map_weights(weights_dir):
+    with open(os.path.join(weights_dir, "index.json")) as f:
+        index = json.load(f)
+    return dict((name, np.load(os.path.join(weights_dir, filename), mmap_mode="r"))
+                for name, filename in index.items())
+
+
+def _placeholder_getter(values, placeholders):
+    """
+    Custom getter returning a placeholder for every weight, placeholders
+    maps the weight names to them
+    """
+    import tensorflow as tf
+
+    def getter(getter, name, shape=None, *args, **kwargs):
+        value = values[name]
+        if shape is not None and list(value.shape) != list(shape):
+            raise Exception("weight %s has shape %s, expected %s" % (name, value.shape, shape))
+        if name not in placeholders:
+            placeholders[name] = tf.placeholder(tf.float32, value.shape, name=name.split("/")[-1])
+        return placeholders[name]
+    return getter
+
+
+def resident_mb():
+    """
+    (private, shared) resident memory of this process in MB, the shared
+    part counts the mapped files. None on hosts without /proc
+    """
+    path = "/proc/self/status"
+    if not os.path.exists(path):
+        return None
+    fields = dict()
+    with open(path) as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("RssAnon", "RssFile"):
+                fields[name] = int(value.split()[0]) / 1024.0
+    if len(fields) < 2:
+        return None
+    return fields["RssAnon"], fields["RssFile"]
+
+
+def _worker_main(job_dir, weights_dir, manifest, units, results, options):
+    import tensorflow as tf
+    from .gegan import GEGAN
+    from .ops import init_embedding
+    from .utils import load_glyphs, denormalize_image
+    from .cpu_profile import session_config
+
+    values = map_weights(weights_dir)
+    embedding_num, _, _, embedding_dim = values["embedding/E"].shape
+    image_size = manifest["config"]["image_size"]
+    batch_size = options["batch_size"]
+    model = GEGAN(batch_size=batch_size, input_width=image_size, output_width=image_size,
+                  embedding_num=embedding_num, embedding_dim=embedding_dim, **manifest["config"]["model"])
+
+    graph = tf.Graph()
+    with graph.as_default():
+        source = tf.placeholder(tf.float32, [batch_size, image_size, image_size, model.input_filters],
+                                name="source")
+        embedding_ids = tf.placeholder(tf.int64, [batch_size], name="embedding_ids")
+        placeholders = dict()
+        with tf.variable_scope(tf.get_variable_scope(), custom_getter=_placeholder_getter(values, placeholders)):
+            embedding = init_embedding(embedding_num, embedding_dim)
+            output, _ = model.generator(source, embedding, embedding_ids, options["inst_norm"], is_training=False)
+    graph.finalize()
+    # np.asarray drops the memmap subclass without copying the data
+    weights_feed = dict((placeholder, np.asarray(values[name])) for name, placeholder in placeholders.items())
+
+    sources = manifest["config"]["sources"]
+    with tf.Session(graph=graph, config=session_config(options["profile"], options["num_workers"])) as sess:
+        while True:
+            unit = units.get()
+            if unit is None:
+                break
+            tick = time.time()
+            _, images = load_glyphs(sources[unit["start"]:unit["end"]], image_size)
+            count = len(images)
+            padded = -(-count // batch_size) * batch_size
+            if padded > count:
+                images = np.concatenate([images, np.repeat(images[:1], padded - count, axis=0)])
+            generated = list()
+            for start in range(0, padded, batch_size):
+                feed_dict = dict(weights_feed)
+                feed_dict[source] = images[start:start + batch_size]
+                feed_dict[embedding_ids] = [unit["embedding_id"]] * batch_size
+                generated.append(sess.run(output, feed_dict=feed_dict))
+            generated = denormalize_image(np.concatenate(generated)[:count]).astype(np.uint8)
+
+            # np.save appends .npy to names without it
+            path = unit_path(job_dir, unit)
+            tmp_path = path[:-len(".npy")] + ".tmp.npy"
+            np.save(tmp_path, generated)
+            os.rename(tmp_path, path)
+            results.put((unit["id"], count, time.time() - tick, resident_mb()))
+
+
+def run_job(job_dir, model_dir, source_paths, embedding_ids, num_workers=1, glyphs_per_unit=512,
+            batch_size=16, image_size=64, base_width=None, inst_norm=False, profile=None, **model_options):
+    """
+    Run the pending units of the job on num_workers processes, return
+    {"units", "glyphs", "seconds", "glyphs_per_sec", "worker_private_mb"}
+    of this run, the last one the largest private memory of a worker
+    model_options: the architecture of the checkpoint, e.g. generator_dim,
+        kernel_size, generator_depth and precision of a distilled student
+    """
+    model = dict(model_options, base_width=base_width)
+    manifest = create_manifest(job_dir, model_dir, source_paths, embedding_ids, glyphs_per_unit, image_size,
+                               model=model)
+    pending = pending_units(job_dir, manifest)
+    print("%d units, %d done before, %d to run on %d workers" %
+          (len(manifest["units"]), len(manifest["units"]) - len(pending), len(pending), num_workers))
+    if not pending:
+        return {"units": 0, "glyphs": 0, "seconds": 0.0, "glyphs_per_sec": 0.0, "worker_private_mb": 0.0}
+    weights_dir = extract_weights(job_dir, model_dir)
+
+    units, results = multiprocessing.Queue(), multiprocessing.Queue()
+    for unit in pending:
+        units.put(unit)
+    for _ in range(num_workers):
+        units.put(None)
+
+    options = {"batch_size":    batch_size,
+               "inst_norm":     inst_norm,
+               "profile":       profile,
+               "num_workers":   num_workers}
+    start = time.time()
+    workers = [multiprocessing.Process(target=_worker_main,
+                                       args=(job_dir, weights_dir, manifest, units, results, options))
+               for _ in range(num_workers)]
+    for p in workers:
+        p.start()
+
+    glyphs, done, private_mb = 0, 0, 0.0
+    while done < len(pending):
+        try:
+            uid, count, seconds, resident = results.get(timeout=5)
+        except queue.Empty:
+            if not any(p.is_alive() for p in workers):
+                raise Exception("workers exited with %d units left, run the job again to resume" %
+                                (len(pending) - done))
+            continue
+        glyphs += count
+        done += 1
+        memory = ""
+        if resident is not None:
+            private_mb = max(private_mb, resident[0])
+            memory = ", worker rss %.1f MB private %.1f MB shared" % resident
+        print("[%d/%d] unit %s, %d glyphs in %.2fs%s" % (done, len(pending), uid, count, seconds, memory))
+    for p in workers:
+        p.join()
+    elapsed = time.time() - start
+    return {"units": len(pending), "glyphs": glyphs, "seconds": elapsed, "glyphs_per_sec": glyphs / elapsed,
+            "worker_private_mb": private_mb}
+
+
+def merge(job_dir, save_dir):
+    """
+    Concatenate the unit outputs of each style in manifest order into
+    save_dir/<embedding id>/glyphs.npy, with the glyph names in names.json
+    """
+    with open(os.path.join(job_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+    missing = pending_units(job_dir, manifest)
+    if missing:
+        raise Exception("%d units are not done yet, run the job again" % len(missing))
+
+    sources = manifest["config"]["sources"]
+    size = manifest["config"]["image_size"]
+    names = [os.path.splitext(os.path.basename(p))[0] for p in sources]
+    for embedding_id in manifest["config"]["embedding_ids"]:
+        style_dir = os.path.join(save_dir, str(embedding_id))
+        if not os.path.exists(style_dir):
+            os.makedirs(style_dir)
+        merged = np.lib.format.open_memmap(os.path.join(style_dir, "glyphs.npy"), mode="w+", dtype=np.uint8,
+                                           shape=(len(sources), size, size, 3))
+        for unit in sorted((u for u in manifest["units"] if u["embedding_id"] == embedding_id),
+                           key=lambda u: u["start"]):
+            merged[unit["start"]:unit["end"]] = np.load(unit_path(job_dir, unit), mmap_mode="r")
+        merged.flush()
+        with open(os.path.join(style_dir, "names.json"), "w") as f:
+            json.dump(names, f)
+        print("style %d merged at %s" % (embedding_id, style_dir))
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import multiprocessing
+
+import numpy as np
+
+# Glyph quality metrics between generated and ground truth glyphs, with
+# numpy only so they run in plain worker processes.
+# Every metric takes two batches [batch, height, width, channels], either
+# uint8 in [0, 255] or float in [-1, 1] as the generator outputs them, and
+# returns one value per glyph:
+# * l1: mean absolute difference of the pixels in [0, 1]
+# * ssim: structural similarity of the grayscale glyphs, gaussian window
+# * iou: intersection over union of the strokes, dark pixels after binarization
+# * perceptual: distance of multi scale gradient features, a cheap stand in
+#   for the vgg distance of the training loss which needs tensorflow
+# score() runs them over arrays of any size, e.g. memory mapped .npy files
+# of a whole font, in chunks spread over a process pool.
+
+METRICS = ("l1", "ssim", "iou", "perceptual")
+
+
+def to_unit(images):
+    """
+    Glyphs as float32 in [0, 1]
+    """
+    images = np.asarray(images)
+    if images.dtype == np.uint8:
+        return images.astype(np.float32) / 255.0
+    return (images.astype(np.float32) + 1.0) / 2.0
+
+
+def to_gray(images):
+    images = to_unit(images)
+    if images.ndim == 4:
+        images = images.mean(axis=3)
+    return images
+
+
+def l1(generated, target):
+    return np.abs(to_unit(generated) - to_unit(target)).reshape(len(generated), -1).mean(axis=1)
+
+
+def _gaussian_kernel(size=11, sigma=1.5):
+    x = np.arange(size, dtype=np.float32) - (size - 1) / 2.0
+    kernel = np.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+
+def _filter(images, kernel):
+    # separable "valid" filtering of [batch, height, width], one shifted
+    # slice per tap so the whole batch goes through each numpy op
+    size = len(kernel)
+    height, width = images.shape[1] - size + 1, images.shape[2] - size + 1
+    rows = sum(w * images[:, i:i + height, :] for i, w in enumerate(kernel))
+    return sum(w * rows[:, :, i:i + width] for i, w in enumerate(kernel))
+
+
+def ssim(generated, target, size=11, sigma=1.5):
+    a, b = to_gray(generated), to_gray(target)
+    kernel = _gaussian_kernel(min(size, a.shape[1], a.shape[2]), sigma)
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+
+    mu_a, mu_b = _filter(a, kernel), _filter(b, kernel)
+    var_a   = _filter(a * a, kernel) - mu_a * mu_a
+    var_b   = _filter(b * b, kernel) - mu_b * mu_b
+    cov     = _filter(a * b, kernel) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / \
+               ((mu_a * mu_a + mu_b * mu_b + c1) * (var_a + var_b + c2))
+    return ssim_map.reshape(len(a), -1).mean(axis=1)
+
+
+def iou(generated, target, threshold=0.5):
+    # strokes are dark on a light background
+    a, b = to_gray(generated) < threshold, to_gray(target) < threshold
+    intersection = np.logical_and(a, b).reshape(len(a), -1).sum(axis=1)
+    union = np.logical_or(a, b).reshape(len(a), -1).sum(axis=1)
+    # two blank glyphs agree
+    return np.where(union > 0, intersection / np.maximum(union, 1).astype(np.float32), 1.0)
+
+
+def _gradients(images):
+    dy = images[:, 1:, :-1] - images[:, :-1, :-1]
+    dx = images[:, :-1, 1:] - images[:, :-1, :-1]
+    return np.stack([dx, dy, np.sqrt(dx * dx + dy * dy)], axis=3)
+
+
+def _downsample(images):
+    height, width = images.shape[1] // 2 * 2, images.shape[2] // 2 * 2
+    images = images[:, :height, :width]
+    return 0.25 * (images[:, 0::2, 0::2] + images[:, 1::2, 0::2] + images[:, 0::2, 1::2] + images[:, 1::2, 1::2])
+
+
+def perceptual(generated, target, scales=3):
+    a, b = to_gray(generated), to_gray(target)
+    distance = np.zeros(len(a), dtype=np.float32)
+    used = 0
+    for scale in range(scales):
+        if min(a.shape[1], a.shape[2]) < 4:
+            break
+        distance += np.abs(_gradients(a) - _gradients(b)).reshape(len(a), -1).mean(axis=1)
+        a, b = _downsample(a), _downsample(b)
+        used += 1
+    return distance / max(used, 1)
+
+
+def batch_metrics(generated, target, metrics=METRICS):
+    functions = {"l1": l1, "ssim": ssim, "iou": iou, "perceptual": perceptual}
+    return dict((name, functions[name](generated, target).astype(np.float32)) for name in metrics)
+
+
+# arrays opened by the pool workers, keyed by path
+_opened = dict()
+
+
+def _open(array):
+    if isinstance(array, str):
+        if array not in _opened:
+            _opened[array] = np.load(array, mmap_mode="r")
+        return _opened[array]
+    return array
+
+
+def _score_chunk(task):
+    offset, generated, target, start, end, metrics = task
+    return offset, batch_metrics(_open(generated)[start:end], _open(target)[start:end], metrics)
+
+
+def score(generated, target, metrics=METRICS, chunk_size=512, processes=None):
+    """
+    Per glyph metrics of two arrays of glyphs, or paths of .npy files which
+    are memory mapped. Only chunk_size glyphs per process are in memory at a
+    time. processes=1 runs in this process, None uses every core.
+    """
+    count = len(_open(generated))
+    if len(_open(target)) != count:
+        raise Exception("%d generated glyphs for %d targets" % (count, len(_open(target))))
+
+    ranges = [(start, min(start + chunk_size, count)) for start in range(0, count, chunk_size)]
+    if isinstance(generated, str) and isinstance(target, str):
+        # the workers map the files themselves, only the ranges are sent
+        tasks = ((s, generated, target, s, e, metrics) for s, e in ranges)
+    else:
+        tasks = ((s, _open(generated)[s:e], _open(target)[s:e], 0, e - s, metrics) for s, e in ranges)
+
+    scores = dict((name, np.zeros(count, dtype=np.float32)) for name in metrics)
+    pool = None
+    if processes == 1 or len(ranges) <= 1:
+        results = (_score_chunk(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_score_chunk, tasks)
+
+    for offset, chunk in results:
+        for name, values in chunk.items():
+            scores[name][offset:offset + len(values)] = values
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return scores
+
+
+def summarize(scores):
+    return dict((name, float(np.mean(values))) for name, values in scores.items())
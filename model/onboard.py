@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from .gegan import GEGAN
+from .ops import init_embedding
+from .specialize import read_generator_values
+
+# Few shot onboarding of a new font into a trained generator. Retraining
+# the whole model for one more style takes days, while a style only lives
+# in a few rows of the generator:
+# * its row of the embedding table, concatenated at the bottleneck
+# * with inst_norm, its row of every conditional instance norm scale/shift
+# The generator is rebuilt with embedding_num + 1 and every weight read from
+# the checkpoint as a constant, like specialize.py, only the new rows are
+# variables. They start from the mean of the existing rows and are fitted
+# with L1 on a few dozen (source, target) glyph pairs of the new font, the
+# batch norms run on their moving statistics. The result is written as a
+# generator only checkpoint with embedding_num + 1 rows, the new font is the
+# last embedding id, the other styles are unchanged.
+
+
+def is_style_table(name):
+    return name == "embedding/E" or name.endswith("_inst_norm/scale") or name.endswith("_inst_norm/shift")
+
+
+def _onboard_getter(values, rows):
+    def getter(getter, name, shape=None, *args, **kwargs):
+        value = values[name]
+        if not is_style_table(name):
+            return tf.constant(value, name=name.split("/")[-1])
+        if shape is not None and [value.shape[0] + 1] + list(value.shape[1:]) != list(shape):
+            raise Exception("%s has shape %s in the checkpoint, expected one row less than %s" %
+                            (name, value.shape, shape))
+        row = getter(name + "_onboard", shape=[1] + list(value.shape[1:]), dtype=tf.float32,
+                     initializer=tf.constant_initializer(value.mean(axis=0, keepdims=True)), trainable=True)
+        rows[name] = row
+        return tf.concat([tf.constant(value), row], 0)
+    return getter
+
+
+def write_generator_values(values, save_dir, step=0):
+    """
+    Save {variable name: value} as a checkpoint in save_dir, restorable by
+    the generator savers of infer.py and export.py
+    """
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        var_list = dict((name, tf.Variable(value, name=name)) for name, value in values.items())
+        sess.run(tf.global_variables_initializer())
+        return tf.train.Saver(var_list=var_list).save(sess, os.path.join(save_dir, "gegan.model"), global_step=step)
+
+
+class Onboarder(object):
+    """
+    Fit the style rows of one new font on a frozen generator, with its own
+    graph and session
+    """
+    def __init__(self, model_dir, batch_size=16, image_size=64, inst_norm=False, lr=0.01, config=None,
+                 **model_options):
+        """
+        model_options: generator shape of the checkpoint, e.g. generator_dim
+        """
+        self.version, self.values = read_generator_values(model_dir)
+        embedding_num, _, _, embedding_dim = self.values["embedding/E"].shape
+        # the new font gets the id after the existing ones
+        self.embedding_id = embedding_num
+        self.batch_size = batch_size
+
+        model = GEGAN(batch_size=batch_size, input_width=image_size, output_width=image_size,
+                      embedding_num=embedding_num + 1, embedding_dim=embedding_dim, **model_options)
+        self.rows = dict()
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            shape = [batch_size, image_size, image_size, model.input_filters]
+            self.source = tf.placeholder(tf.float32, shape, name="source")
+            self.target = tf.placeholder(tf.float32, shape[:3] + [model.output_filters], name="target")
+            ids = tf.fill([batch_size], tf.constant(self.embedding_id, dtype=tf.int64))
+            with tf.variable_scope(tf.get_variable_scope(), custom_getter=_onboard_getter(self.values, self.rows)):
+                embedding = init_embedding(model.embedding_num, model.embedding_dim)
+                self.output, _ = model.generator(self.source, embedding, ids, inst_norm, is_training=False)
+            self.loss = tf.reduce_mean(tf.abs(self.output - self.target))
+            self.train_op = tf.train.AdamOptimizer(lr).minimize(self.loss, var_list=list(self.rows.values()))
+            init_op = tf.global_variables_initializer()
+        self.graph.finalize()
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self.sess.run(init_op)
+        print("onboarding as embedding id %d, %d style rows trainable" % (self.embedding_id, len(self.rows)))
+
+    def train(self, sources, targets, steps=300, log_steps=50, seed=None):
+        """
+        sources, targets: normalized glyph pairs of the new font, batches are
+        drawn from them with replacement. Return the average L1 of the
+        last log_steps steps
+        """
+        random = np.random.RandomState(seed)
+        start_time = time.time()
+        losses = list()
+        for step in range(steps):
+            indices = random.randint(0, len(sources), self.batch_size)
+            _, loss = self.sess.run([self.train_op, self.loss], feed_dict={self.source: sources[indices],
+                                                                          self.target: targets[indices]})
+            losses = losses[-(log_steps - 1):] + [loss]
+            if step % log_steps == 0 or step == steps - 1:
+                print("onboard step %d, %4.2fs, l1_loss %.5f" % (step, time.time() - start_time, np.mean(losses)))
+        return float(np.mean(losses))
+
+    def generate(self, sources):
+        return self.sess.run(self.output, feed_dict={self.source: sources})
+
+    def snapshot(self):
+        """
+        The generator values with the new style rows appended
+        """
+        rows = self.sess.run(self.rows)
+        values = dict(self.values)
+        for name, row in rows.items():
+            values[name] = np.concatenate([values[name], row], axis=0)
+        return values
+
+    def save(self, save_dir):
+        return write_generator_values(self.snapshot(), save_dir)
+
+    def close(self):
+        self.sess.close()
@@ -2,11 +2,43 @@
 from __future__ import print_function
 from __future__ import absolute_import
 import tensorflow as tf
+from contextlib import contextmanager
 
+# Precision policy. Variables are always float32, they are the master
+# weights the optimizers update. Inside compute_precision(tf.bfloat16) the
+# convolutions, deconvolutions and matmuls cast their inputs and weights to
+# bfloat16 and return bfloat16 activations, normalization layers compute
+# their statistics in float32 and cast back. Models cast their outputs to
+# float32 so the losses are reduced in float32.
+_compute_dtypes = [tf.float32]
 
-def batch_norm(x, is_training, epsilon=1e-5, decay=0.9, scope="batch_norm"):
-    return tf.contrib.layers.batch_norm(x, decay=decay, updates_collections=None, epsilon=epsilon,
-                                        scale=True, is_training=is_training, scope=scope)
+
+@contextmanager
+def compute_precision(dtype):
+    _compute_dtypes.append(tf.as_dtype(dtype))
+    try:
+        yield
+    finally:
+        _compute_dtypes.pop()
+
+
+def compute_dtype():
+    return _compute_dtypes[-1]
+
+
+# update ops of the moving statistics nobody runs, see recomputed
+SKIPPED_UPDATES = "skipped_batch_norm_updates"
+
+
+def batch_norm(x, is_training, epsilon=1e-5, decay=0.9, scope="batch_norm", update_moving=True):
+    """
+    update_moving: False normalizes with the batch statistics as usual but
+        leaves the moving statistics alone
+    """
+    updates_collections = None if update_moving else SKIPPED_UPDATES
+    normed = tf.contrib.layers.batch_norm(tf.cast(x, tf.float32), decay=decay, updates_collections=updates_collections,
+                                          epsilon=epsilon, scale=True, is_training=is_training, scope=scope)
+    return tf.cast(normed, x.dtype)
 
 
 def conv2d(x, output_filters, kh=5, kw=5, sh=2, sw=2, stddev=0.02, scope="conv2d"):
@@ -14,10 +46,11 @@ def conv2d(x, output_filters, kh=5, kw=5, sh=2, sw=2, stddev=0.02, scope="conv2d
         shape = x.get_shape().as_list()
         W = tf.get_variable('W', [kh, kw, shape[-1], output_filters],
                             initializer=tf.truncated_normal_initializer(stddev=stddev))
-        Wconv = tf.nn.conv2d(x, W, strides=[1, sh, sw, 1], padding='SAME')
+        dtype = compute_dtype()
+        Wconv = tf.nn.conv2d(tf.cast(x, dtype), tf.cast(W, dtype), strides=[1, sh, sw, 1], padding='SAME')
 
         biases = tf.get_variable('b', [output_filters], initializer=tf.constant_initializer(0.0))
-        Wconv_plus_b = tf.reshape(tf.nn.bias_add(Wconv, biases), Wconv.get_shape())
+        Wconv_plus_b = tf.reshape(tf.nn.bias_add(Wconv, tf.cast(biases, dtype)), Wconv.get_shape())
 
         return Wconv_plus_b
 
@@ -29,11 +62,12 @@ def deconv2d(x, output_shape, kh=5, kw=5, sh=2, sw=2, stddev=0.02, scope="deconv
         W = tf.get_variable('W', [kh, kw, output_shape[-1], input_shape[-1]],
                             initializer=tf.random_normal_initializer(stddev=stddev))
 
-        deconv = tf.nn.conv2d_transpose(x, W, output_shape=output_shape,
+        dtype = compute_dtype()
+        deconv = tf.nn.conv2d_transpose(tf.cast(x, dtype), tf.cast(W, dtype), output_shape=output_shape,
                                         strides=[1, sh, sw, 1])
 
         biases = tf.get_variable('b', [output_shape[-1]], initializer=tf.constant_initializer(0.0))
-        deconv_plus_b = tf.reshape(tf.nn.bias_add(deconv, biases), deconv.get_shape())
+        deconv_plus_b = tf.reshape(tf.nn.bias_add(deconv, tf.cast(biases, dtype)), deconv.get_shape())
 
         return deconv_plus_b
 
@@ -49,7 +83,8 @@ def fc(x, output_size, stddev=0.02, scope="fc"):
                             tf.random_normal_initializer(stddev=stddev))
         b = tf.get_variable("b", [output_size],
                             initializer=tf.constant_initializer(0.0))
-        return tf.matmul(x, W) + b
+        dtype = compute_dtype()
+        return tf.matmul(tf.cast(x, dtype), tf.cast(W, dtype)) + tf.cast(b, dtype)
 
 
 def init_embedding(size, dimension, stddev=0.01, scope="embedding"):
@@ -65,11 +100,38 @@ def conditional_instance_norm(x, ids, labels_num, mixed=False, scope="conditiona
         scale = tf.get_variable("scale", [labels_num, output_filters], tf.float32, tf.constant_initializer(1.0))
         shift = tf.get_variable("shift", [labels_num, output_filters], tf.float32, tf.constant_initializer(0.0))
 
-        mu, sigma = tf.nn.moments(x, [1, 2], keep_dims=True)
-        norm = (x - mu) / tf.sqrt(sigma + 1e-5)
-
         batch_scale = tf.reshape(tf.nn.embedding_lookup([scale], ids=ids), [batch_size, 1, 1, output_filters])
         batch_shift = tf.reshape(tf.nn.embedding_lookup([shift], ids=ids), [batch_size, 1, 1, output_filters])
 
-        z = norm * batch_scale + batch_shift
-        return z
+        return instance_norm(x, batch_scale, batch_shift)
+
+
+def instance_norm(x, scale, shift):
+    x32 = tf.cast(x, tf.float32)
+    mu, sigma = tf.nn.moments(x32, [1, 2], keep_dims=True)
+    norm = (x32 - mu) / tf.sqrt(sigma + 1e-5)
+
+    z = norm * scale + shift
+    return tf.cast(z, x.dtype)
+
+
+def recomputed(fn, *inputs):
+    """
+    Apply fn to the inputs without keeping its intermediate activations
+    alive for the backward pass, they are recomputed from the inputs during
+    backprop. Trades compute for memory.
+    fn(*inputs, is_recomputing) must not change any state when
+    is_recomputing is True, e.g. batch_norm(update_moving=False), the
+    moving statistics would be updated twice per step otherwise
+    """
+    calls = list()
+
+    def traced(*args):
+        # the first call builds the forward pass, any later one a
+        # recomputation in the gradients
+        calls.append(len(calls))
+        return fn(*args, is_recomputing=len(calls) > 1)
+
+    # recompute_grad only supports resource variables
+    with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+        return tf.contrib.layers.recompute_grad(traced)(*inputs)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import tensorflow as tf
+
+from .graph_cache import add_to_collections, get_from_collections
+
+# Update strategies used by GEGAN.train.
+# All of them expose the same run(sess, fetches, feed_dicts) call, which
+# performs one parameter update from a list of micro batch feed dicts and
+# returns the values of fetches for the last one, so the training loop
+# does not need to know how the gradients are produced.
+# MEMBERS lists the graph elements of each strategy, so it can be found
+# back in a training graph imported from a MetaGraph, see graph_cache.py.
+
+
+def _dense_gradients(optimizer, loss, var_list):
+    grads_and_vars = optimizer.compute_gradients(loss, var_list=var_list)
+    grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+    # embedding_lookup produces IndexedSlices, make them dense
+    # so they could be fed back and summed up
+    return [(tf.convert_to_tensor(g), v) for g, v in grads_and_vars]
+
+
+class LossScaleOptimizer(tf.train.Optimizer):
+    """
+    Compute the gradients of loss * loss_scale and divide them back before
+    they are applied, keeps small gradients of reduced precision activations
+    from flushing to zero. The slots stay those of the wrapped optimizer.
+    """
+    def __init__(self, optimizer, loss_scale):
+        super(LossScaleOptimizer, self).__init__(use_locking=False, name="LossScale")
+        self.optimizer  = optimizer
+        self.loss_scale = float(loss_scale)
+
+    def compute_gradients(self, loss, var_list=None, **kwargs):
+        grads_and_vars = self.optimizer.compute_gradients(loss * self.loss_scale, var_list=var_list, **kwargs)
+        unscaled = list()
+        for g, v in grads_and_vars:
+            if isinstance(g, tf.IndexedSlices):
+                g = tf.IndexedSlices(g.values / self.loss_scale, g.indices, g.dense_shape)
+            elif g is not None:
+                g = g / self.loss_scale
+            unscaled.append((g, v))
+        return unscaled
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        return self.optimizer.apply_gradients(grads_and_vars, global_step=global_step, name=name)
+
+
+def collect_update(update, group):
+    add_to_collections(group, dict((name, getattr(update, name, None)) for name in update.MEMBERS))
+
+
+def restore_update(cls, group, reducer=None):
+    update = cls.__new__(cls)
+    update.__dict__.update(get_from_collections(group, cls.MEMBERS, cls.LISTS))
+    update.reducer = reducer
+    return update
+
+
+class LocalUpdate(object):
+    """
+    Plain optimizer.minimize in a single process
+    """
+    MEMBERS = ["train_op"]
+    LISTS   = []
+
+    def __init__(self, optimizer, loss, var_list):
+        self.train_op = optimizer.minimize(loss, var_list=var_list)
+
+    def run(self, sess, fetches, feed_dicts, collect=False):
+        """
+        collect: return the fetches of every micro batch in a list
+        """
+        feed_dict, = feed_dicts
+        _, results = sess.run([self.train_op, fetches], feed_dict=feed_dict)
+        return [results] if collect else results
+
+
+class AllReduceUpdate(object):
+    """
+    Compute the local gradients, average them across all the workers
+    with the reducer and apply the averaged gradients
+    """
+    MEMBERS = ["grads", "placeholders", "train_op"]
+    LISTS   = ["grads", "placeholders"]
+
+    def __init__(self, optimizer, loss, var_list, reducer):
+        self.reducer        = reducer
+        grads_and_vars      = _dense_gradients(optimizer, loss, var_list)
+        self.grads          = [g for g, _ in grads_and_vars]
+        self.placeholders   = [tf.placeholder(tf.float32, v.get_shape(), name="averaged_grad")
+                               for _, v in grads_and_vars]
+        self.train_op       = optimizer.apply_gradients(zip(self.placeholders, [v for _, v in grads_and_vars]))
+
+    def run(self, sess, fetches, feed_dicts, collect=False):
+        feed_dict, = feed_dicts
+        grads, results = sess.run([self.grads, fetches], feed_dict=feed_dict)
+        grads = self.reducer.allreduce(grads)
+
+        apply_feed = dict(feed_dict)
+        apply_feed.update(zip(self.placeholders, grads))
+        sess.run(self.train_op, feed_dict=apply_feed)
+        return [results] if collect else results
+
+
+class AccumulateUpdate(object):
+    """
+    Sum the gradients of several micro batches in local variables and
+    apply their average once, so the effective batch grows without growing
+    the activations kept for the backward pass. With a reducer the averaged
+    gradients are also averaged across the data parallel workers.
+    """
+    MEMBERS = ["accumulators", "accumulate_op", "zero_op", "micro_batches", "placeholders", "train_op"]
+    LISTS   = ["accumulators", "placeholders"]
+
+    def __init__(self, optimizer, loss, var_list, reducer=None):
+        self.reducer        = reducer
+        grads_and_vars      = _dense_gradients(optimizer, loss, var_list)
+        variables           = [v for _, v in grads_and_vars]
+
+        # local variables are neither checkpointed nor synced between workers
+        self.accumulators   = [tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype), trainable=False,
+                                           collections=[tf.GraphKeys.LOCAL_VARIABLES], name="grad_accumulator")
+                               for v in variables]
+        self.accumulate_op  = tf.group(*[acc.assign_add(g) for acc, (g, _) in zip(self.accumulators, grads_and_vars)])
+        self.zero_op        = tf.group(*[acc.assign(tf.zeros_like(acc)) for acc in self.accumulators])
+        self.micro_batches  = tf.placeholder(tf.float32, shape=[], name="micro_batches")
+
+        if reducer is None:
+            averaged = [acc / self.micro_batches for acc in self.accumulators]
+        else:
+            self.placeholders = [tf.placeholder(tf.float32, v.get_shape(), name="averaged_grad") for v in variables]
+            averaged = self.placeholders
+        self.train_op       = optimizer.apply_gradients(zip(averaged, variables))
+
+    def run(self, sess, fetches, feed_dicts, collect=False):
+        """
+        Return the fetches of the last micro batch, with collect those of
+        every micro batch in a list
+        """
+        sess.run(self.zero_op)
+        collected = list()
+        for feed_dict in feed_dicts:
+            _, results = sess.run([self.accumulate_op, fetches], feed_dict=feed_dict)
+            collected.append(results)
+
+        # the last feed dict still carries the learning rate
+        apply_feed = dict(feed_dicts[-1])
+        apply_feed[self.micro_batches] = len(feed_dicts)
+        if self.reducer is not None:
+            grads = [acc / len(feed_dicts) for acc in sess.run(self.accumulators)]
+            apply_feed.update(zip(self.placeholders, self.reducer.allreduce(grads)))
+        sess.run(self.train_op, feed_dict=apply_feed)
+        return collected if collect else results
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from .utils import normalize_image, denormalize_image
+
+# Restyling of whole pages. A page, rendered or rendered here from text,
+# is cut into glyph cells on a regular grid (the layout). Cells are keyed
+# by their pixels, so a character repeated on the pages of a group goes
+# through the generator once, and blank cells not at all. The generated
+# glyphs are pasted back into the cells of every page.
+#
+# Work is done per group of pages, so the generator batches are filled
+# with the unique cells of several pages:
+#   cut_group -> generate_group -> composite_group
+# which map to the load, model and write stages of model/pipeline.py.
+
+
+class PageLayout(object):
+    def __init__(self, cell_size=64, margin=0, columns=None, rows=None, blank_threshold=250):
+        """
+        columns/rows: number of cells, default to what fits in the page
+        blank_threshold: cells whose darkest pixel is lighter are blank
+        """
+        self.cell_size          = cell_size
+        self.margin             = margin
+        self.columns            = columns
+        self.rows               = rows
+        self.blank_threshold    = blank_threshold
+
+    def grid(self, width, height):
+        columns = self.columns or (width - 2 * self.margin) // self.cell_size
+        rows = self.rows or (height - 2 * self.margin) // self.cell_size
+        return columns, rows
+
+    def cell_box(self, row, column):
+        x = self.margin + column * self.cell_size
+        y = self.margin + row * self.cell_size
+        return x, y, x + self.cell_size, y + self.cell_size
+
+
+def render_text(text, font_path, layout, columns=20):
+    """
+    Render text with the source font into a page, one character per cell,
+    wrapping at columns and at newlines
+    """
+    columns = layout.columns or columns
+    lines = list()
+    for line in text.split("\n"):
+        lines.extend([line[i:i + columns] for i in range(0, len(line), columns)] or [""])
+    rows = layout.rows or len(lines)
+    size = layout.cell_size
+    page = Image.new("RGB", (2 * layout.margin + columns * size, 2 * layout.margin + rows * size), (255, 255, 255))
+    draw = ImageDraw.Draw(page)
+    # leave some room around the glyph like the training images
+    font = ImageFont.truetype(font_path, int(size * 0.8))
+    for row, line in enumerate(lines[:rows]):
+        for column, char in enumerate(line):
+            x, y, _, _ = layout.cell_box(row, column)
+            draw.text((x + size * 0.1, y + size * 0.1), char, fill=(0, 0, 0), font=font)
+    return np.asarray(page, dtype=np.uint8)
+
+
+def cut_page(page, layout):
+    """
+    Return [(row, column, key, cell)] of the non blank cells of the page
+    """
+    columns, rows = layout.grid(page.shape[1], page.shape[0])
+    cells = list()
+    for row in range(rows):
+        for column in range(columns):
+            x0, y0, x1, y1 = layout.cell_box(row, column)
+            cell = page[y0:y1, x0:x1]
+            if cell.shape[:2] != (layout.cell_size, layout.cell_size) or cell.min() > layout.blank_threshold:
+                continue
+            cells.append((row, column, hashlib.sha1(cell.tobytes()).hexdigest(), cell))
+    return cells
+
+
+def cut_group(pages, layout):
+    """
+    pages: [(name, page array)], return the group with the cells of every
+    page and the unique cells across all of them
+    """
+    unique = dict()
+    cut = list()
+    for name, page in pages:
+        cells = cut_page(page, layout)
+        for _, _, key, cell in cells:
+            unique.setdefault(key, cell)
+        cut.append((name, page, [(row, column, key) for row, column, key, _ in cells]))
+    return {"pages": cut, "unique": unique}
+
+
+def generate_group(group, generate_fn, batch_size, image_size):
+    """
+    Run the unique cells of the group through generate_fn in fixed size
+    batches, generate_fn maps normalized images to normalized images
+    """
+    keys = sorted(group["unique"])
+    generated = dict()
+    for start in range(0, len(keys), batch_size):
+        batch_keys = keys[start:start + batch_size]
+        cells = [group["unique"][k] for k in batch_keys]
+        cell_size = cells[0].shape[0]
+        if cell_size != image_size:
+            cells = [np.asarray(Image.fromarray(c).resize((image_size, image_size), Image.LANCZOS)) for c in cells]
+        images = normalize_image(np.stack(cells).astype(np.float32))
+        if len(images) < batch_size:
+            images = np.concatenate([images, np.repeat(images[:1], batch_size - len(images), axis=0)])
+        outputs = denormalize_image(generate_fn(images)[:len(batch_keys)]).astype(np.uint8)
+        for key, output in zip(batch_keys, outputs):
+            if cell_size != image_size:
+                output = np.asarray(Image.fromarray(output).resize((cell_size, cell_size), Image.LANCZOS))
+            generated[key] = output
+    group["generated"] = generated
+    return group
+
+
+def composite_group(group, layout, write_fn):
+    """
+    Paste the generated cells into a copy of every page and hand it to write_fn(name, page)
+    """
+    for name, page, cells in group["pages"]:
+        restyled = page.copy()
+        for row, column, key in cells:
+            x0, y0, x1, y1 = layout.cell_box(row, column)
+            restyled[y0:y1, x0:x1] = group["generated"][key]
+        write_fn(name, restyled)
+
+
+def group_pages(pages, pages_per_group):
+    group = list()
+    for page in pages:
+        group.append(page)
+        if len(group) == pages_per_group:
+            yield group
+            group = list()
+    if group:
+        yield group
+
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import multiprocessing
+import numpy as np
+
+# Synchronous data parallel training on a single machine.
+# Every worker process owns a full copy of the graph and its own shard
+# of the input. A separate reducer process plays the role of a parameter
+# server: each collective call blocks until all the workers reached it,
+# the reducer averages (or broadcasts) the flattened values and sends the
+# result back to everyone, so all the replicas apply identical updates.
+
+ALLREDUCE = "allreduce"
+BROADCAST = "broadcast"
+BARRIER   = "barrier"
+STOP      = "stop"
+
+
+def _reducer_loop(conns):
+    num_workers = len(conns)
+    while True:
+        try:
+            ops = [conn.recv() for conn in conns]
+        except EOFError:
+            # one of the workers died, the launcher will clean up
+            break
+        if any(op != ops[0] for op in ops):
+            raise Exception("collective mismatch between workers: %s" % ops)
+
+        op = ops[0]
+        if op == STOP:
+            break
+        elif op == ALLREDUCE:
+            total = None
+            for conn in conns:
+                values = np.frombuffer(conn.recv_bytes(), dtype=np.float32)
+                if total is None:
+                    total = values.copy()
+                else:
+                    total += values
+            total /= num_workers
+            payload = total.tobytes()
+        elif op == BROADCAST:
+            payloads = [conn.recv_bytes() for conn in conns]
+            payload = payloads[0]
+        elif op == BARRIER:
+            payload = b""
+        else:
+            raise Exception("unknown collective %s" % op)
+
+        for conn in conns:
+            conn.send_bytes(payload)
+
+
+class Reducer(object):
+    """
+    Worker side handle to the reducer process
+    """
+    def __init__(self, conn, rank, num_workers):
+        self.conn        = conn
+        self.rank        = rank
+        self.num_workers = num_workers
+
+    @property
+    def is_chief(self):
+        return self.rank == 0
+
+    def _exchange(self, op, arrays):
+        arrays = [np.asarray(a, dtype=np.float32) for a in arrays]
+        self.conn.send(op)
+        if arrays:
+            flat = np.concatenate([a.ravel() for a in arrays])
+        else:
+            flat = np.zeros([0], dtype=np.float32)
+        self.conn.send_bytes(flat.tobytes())
+        result = np.frombuffer(self.conn.recv_bytes(), dtype=np.float32)
+
+        # split the flat buffer back into the original shapes
+        outputs = list()
+        offset = 0
+        for a in arrays:
+            outputs.append(result[offset:offset + a.size].reshape(a.shape))
+            offset += a.size
+        return outputs
+
+    def allreduce(self, arrays):
+        """Average the arrays across all the workers"""
+        return self._exchange(ALLREDUCE, arrays)
+
+    def broadcast(self, arrays):
+        """Every worker gets the arrays of the chief"""
+        return self._exchange(BROADCAST, arrays)
+
+    def barrier(self):
+        self.conn.send(BARRIER)
+        self.conn.recv_bytes()
+
+    def close(self):
+        self.conn.send(STOP)
+        self.conn.close()
+
+
+def sync_variables(sess, reducer, variables, average=True):
+    """
+    Make the value of the variables identical on all the workers,
+    either by averaging them or by copying the values of the chief
+    """
+    values = sess.run(variables)
+    if average:
+        values = reducer.allreduce(values)
+    else:
+        values = reducer.broadcast(values)
+    for var, val in zip(variables, values):
+        var.load(val, sess)
+
+
+def _worker_main(worker_fn, rank, num_workers, conn, results, args):
+    reducer = Reducer(conn, rank, num_workers)
+    result = worker_fn(reducer, *args)
+    reducer.close()
+    results.put((rank, result))
+
+
+def run_workers(num_workers, worker_fn, *args):
+    """
+    Run worker_fn(reducer, *args) in num_workers processes with a reducer
+    process in between, return the results of the workers ordered by rank.
+    Must be called before any tf.Session is created in this process.
+    """
+    pipes   = [multiprocessing.Pipe() for _ in range(num_workers)]
+    results = multiprocessing.Queue()
+
+    reducer = multiprocessing.Process(target=_reducer_loop, args=([p[0] for p in pipes],), name="reducer")
+    reducer.daemon = True
+    reducer.start()
+
+    workers = list()
+    for rank in range(num_workers):
+        worker = multiprocessing.Process(target=_worker_main,
+                                         args=(worker_fn, rank, num_workers, pipes[rank][1], results, args),
+                                         name="worker_%d" % rank)
+        worker.start()
+        workers.append(worker)
+
+    outputs = dict()
+    try:
+        while len(outputs) < num_workers:
+            try:
+                rank, result = results.get(timeout=1.0)
+                outputs[rank] = result
+            except Exception:
+                failed = [w for w in workers if w.exitcode not in (None, 0)]
+                if failed:
+                    raise Exception("%s exited with code %d" % (failed[0].name, failed[0].exitcode))
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        if reducer.is_alive():
+            reducer.terminate()
+
+    return [outputs[rank] for rank in range(num_workers)]
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import os
+
+import numpy as np
+
+# Training phases switched by plateau detection instead of by hand.
+# The controller keeps an exponential moving average of every loss
+# component of the training step. A rule watches one of them and fires its
+# action once the average has not improved by min_delta (relative) for
+# patience steps, and optionally only once it is below a threshold, e.g.
+# d_loss flatlining near zero is the cue for label shuffling:
+# * flip_labels: the complementary generator pass gets shuffled labels
+# * decay_lr: halve the learning rate, can fire again after patience steps
+# * freeze_encoder: stop updating the encoder weights
+# * stop: end the training with a last checkpoint
+# In data parallel training the averages are allreduced before every
+# check, so all the workers switch at the same step.
+
+ACTIONS = ("flip_labels", "decay_lr", "freeze_encoder", "stop")
+# the loss components the training step reports to the controller
+LOSSES = ("d_loss", "g_loss", "category_loss", "cheat_loss", "const_loss", "l1_loss", "vgg_loss")
+
+
+class PlateauRule(object):
+    def __init__(self, loss, action, patience=2000, below=None):
+        if loss not in LOSSES:
+            raise Exception("unknown phase loss %s, expected one of %s" % (loss, ", ".join(LOSSES)))
+        if action not in ACTIONS:
+            raise Exception("unknown phase action %s, expected one of %s" % (action, ", ".join(ACTIONS)))
+        self.loss       = loss
+        self.action     = action
+        self.patience   = patience
+        self.below      = below
+
+    def __repr__(self):
+        return "%s:%s:%d" % (self.loss, self.action, self.patience)
+
+
+def parse_rules(spec):
+    """
+    "d_loss:flip_labels:2000:0.1,l1_loss:decay_lr:3000" is a list of
+    loss:action[:patience[:below]]
+    """
+    rules = list()
+    for rule in spec.split(","):
+        fields = rule.split(":")
+        if not 2 <= len(fields) <= 4:
+            raise Exception("phase rule %s is not loss:action[:patience[:below]]" % rule)
+        patience = int(fields[2]) if len(fields) > 2 else 2000
+        below = float(fields[3]) if len(fields) > 3 else None
+        rules.append(PlateauRule(fields[0], fields[1], patience, below))
+    return rules
+
+
+class PhaseController(object):
+    def __init__(self, rules, lr, flip_labels=False, freeze_encoder=False, smoothing=0.98, min_delta=0.01,
+                 warmup=1000, decay=0.5, min_lr=1e-6, reducer=None):
+        """
+        warmup: no rule fires before that many steps
+        """
+        self.rules          = rules
+        self.smoothing      = smoothing
+        self.min_delta      = min_delta
+        self.warmup         = warmup
+        self.decay          = decay
+        self.min_lr         = min_lr
+        self.reducer        = reducer
+        # the phase
+        self.lr             = lr
+        self.flip_labels    = flip_labels
+        self.freeze_encoder = freeze_encoder
+        self.stop           = False
+        # the tracking
+        self.averages       = dict()
+        self.best           = dict()
+        self.switches       = list()
+
+    def update(self, losses):
+        """
+        losses: {name: value} of the last training step
+        """
+        for name, value in losses.items():
+            average = self.averages.get(name)
+            self.averages[name] = value if average is None else \
+                self.smoothing * average + (1 - self.smoothing) * value
+
+    def averaged(self):
+        names = sorted(self.averages)
+        values = np.asarray([self.averages[n] for n in names], dtype=np.float32)
+        if self.reducer is not None:
+            values, = self.reducer.allreduce([values])
+        return dict(zip(names, values.tolist()))
+
+    def check(self, step):
+        """
+        Evaluate the rules, call it every few steps at the same step on every
+        worker. Return the switches made, [(action, loss, average)]
+        """
+        averages = self.averaged()
+        made = list()
+        for index, rule in enumerate(self.rules):
+            if rule.loss not in averages or self.done(rule):
+                continue
+            value = averages[rule.loss]
+            best, best_step = self.best.get(index, (value, step))
+            if value < best * (1.0 - self.min_delta):
+                best, best_step = value, step
+            self.best[index] = (best, best_step)
+            if step < self.warmup or step - best_step < rule.patience:
+                continue
+            if rule.below is not None and value >= rule.below:
+                continue
+            self.switch(step, rule.action, rule.loss, value)
+            # a repeated action waits for another plateau
+            self.best[index] = (value, step)
+            made.append((rule.action, rule.loss, value))
+        return made
+
+    def done(self, rule):
+        if rule.action == "decay_lr":
+            return self.lr * self.decay < self.min_lr
+        return getattr(self, rule.action)
+
+    def switch(self, step, action, reason, value=0.0):
+        if action == "decay_lr":
+            self.lr *= self.decay
+        else:
+            setattr(self, action, True)
+        self.switches.append({"step": step, "action": action, "reason": reason, "value": value, "lr": self.lr})
+        print("phase switch at step %d: %s (%s %.5f), lr %g" % (step, action, reason, value, self.lr))
+
+    def state(self):
+        return {"lr": self.lr, "flip_labels": self.flip_labels, "freeze_encoder": self.freeze_encoder,
+                "switches": self.switches}
+
+    def save(self, path):
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.state(), f, indent=2)
+        os.rename(path + ".tmp", path)
+
+    def load(self, path):
+        """
+        Continue in the phase saved next to the checkpoint being resumed
+        """
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            state = json.load(f)
+        self.lr             = state["lr"]
+        self.flip_labels    = state["flip_labels"]
+        self.freeze_encoder = state["freeze_encoder"]
+        self.switches       = state["switches"]
+        return True
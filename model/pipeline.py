@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import threading
+import time
+
+if sys.version_info[0] >= 3:
+    import queue
+else:
+    import Queue as queue
+
+# Staged pipeline with bounded queues between the stages, e.g. loading,
+# the model and writing for bulk generation. Each stage runs fn on a pool
+# of threads (the heavy parts of decoding, encoding and sess.run release
+# the GIL), so disk, preprocessing and compute overlap. The queues are
+# bounded, a slow stage blocks the ones in front of it instead of piling
+# up results in memory.
+#
+# Every worker accounts for its time as
+# * busy: running fn
+# * starved: waiting for an item from the previous stage
+# * blocked: waiting for room in the queue of the next stage
+# the stage with the highest busy share is the bottleneck.
+
+_STOP = object()
+
+
+class Stage(object):
+    def __init__(self, name, fn, workers=1):
+        """
+        fn(item) returns the item for the next stage, or None to drop it
+        """
+        self.name       = name
+        self.fn         = fn
+        self.workers    = workers
+        self.lock       = threading.Lock()
+        self.items      = 0
+        self.busy       = 0.0
+        self.starved    = 0.0
+        self.blocked    = 0.0
+        self.running    = workers
+
+    def account(self, busy, starved, blocked):
+        with self.lock:
+            self.items      += 1
+            self.busy       += busy
+            self.starved    += starved
+            self.blocked    += blocked
+
+    def finish(self):
+        # returns True for the last worker of the stage to stop
+        with self.lock:
+            self.running -= 1
+            return self.running == 0
+
+
+def run_pipeline(items, stages, queue_size=4):
+    """
+    Feed items through the stages, return the per stage utilization report
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    errors = list()
+
+    def work(index, stage):
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(stages) else None
+        while True:
+            tick = time.time()
+            item = inbox.get()
+            starved = time.time() - tick
+            if item is _STOP:
+                break
+            if errors:
+                # drain without working so every thread reaches the stop
+                continue
+            tick = time.time()
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                errors.append(e)
+                continue
+            busy = time.time() - tick
+            tick = time.time()
+            if outbox is not None and result is not None:
+                outbox.put(result)
+            stage.account(busy, starved, time.time() - tick)
+        if stage.finish() and outbox is not None:
+            for _ in range(stages[index + 1].workers):
+                outbox.put(_STOP)
+
+    threads = list()
+    for index, stage in enumerate(stages):
+        for _ in range(stage.workers):
+            t = threading.Thread(target=work, args=(index, stage))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+    start = time.time()
+    for item in items:
+        queues[0].put(item)
+    for _ in range(stages[0].workers):
+        queues[0].put(_STOP)
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    if errors:
+        raise errors[0]
+    return report(stages, elapsed)
+
+
+def report(stages, elapsed):
+    stats = {"seconds": elapsed, "stages": list()}
+    for stage in stages:
+        capacity = max(elapsed * stage.workers, 1e-9)
+        stats["stages"].append({"name":      stage.name,
+                                "workers":   stage.workers,
+                                "items":     stage.items,
+                                "busy":      stage.busy / capacity,
+                                "starved":   stage.starved / capacity,
+                                "blocked":   stage.blocked / capacity})
+    return stats
+
+
+def print_report(stats):
+    print("%-10s%9s%9s%9s%10s%10s" % ("stage", "workers", "items", "busy", "starved", "blocked"))
+    for s in stats["stages"]:
+        print("%-10s%9d%9d%8.1f%%%9.1f%%%9.1f%%" % (s["name"], s["workers"], s["items"], 100 * s["busy"],
+                                                  100 * s["starved"], 100 * s["blocked"]))
+    bottleneck = max(stats["stages"], key=lambda s: s["busy"])
+    print("finished in %.2fs, bottleneck: %s" % (stats["seconds"], bottleneck["name"]))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import threading
+import time
+
+import tensorflow as tf
+
+from .gegan import GEGAN
+from .ops import init_embedding
+
+if sys.version_info[0] >= 3:
+    import queue
+else:
+    import Queue as queue
+
+# Two stage inference for interactive use. A model trained with
+# preview_factor has a small head on the decoder layer of width
+# output_width / preview_factor, e.g. 16x16 for 64x64 glyphs. A request
+# first runs the encoder, the decoder up to that layer and the head, and
+# returns the coarse preview right away. The widest decoder layers, where
+# most of the generator time goes, run afterwards in a background thread:
+# the decoder layer and the encoder skip connections computed for the
+# preview are fed back, so the refinement does not run the encoder again.
+# A refinement still queued when the next request arrives can be
+# cancelled, e.g. while the user is typing.
+
+
+class Refinement(object):
+    """
+    The full resolution result of a request, computed in the background
+    """
+    def __init__(self, feed_dict, started):
+        self.feed_dict          = feed_dict
+        self.started            = started
+        self.preview_latency    = None
+        self.latency            = None
+        self.output             = None
+        self.error              = None
+        self.cancelled          = False
+        self.event              = threading.Event()
+
+    def done(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def result(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise Exception("refinement not done after %.2fs" % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+
+class PreviewGenerator(object):
+    """
+    Generator returning a preview and a Refinement for every request, with
+    its own graph, session and refinement thread
+    """
+    def __init__(self, model_dir, preview_factor=4, batch_size=1, image_size=64, embedding_num=2, inst_norm=False,
+                 config=None, **model_options):
+        """
+        model_dir: checkpoint trained with the same preview_factor, None
+            keeps the random weights, e.g. for benchmarks
+        """
+        model = GEGAN(batch_size=batch_size, input_width=image_size, output_width=image_size,
+                      embedding_num=embedding_num, preview_factor=preview_factor, **model_options)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.source = tf.placeholder(tf.float32, [batch_size, image_size, image_size, model.input_filters],
+                                         name="source")
+            self.embedding_ids = tf.placeholder(tf.int64, [batch_size], name="embedding_ids")
+            embedding = init_embedding(model.embedding_num, model.embedding_dim)
+            self.output, _, preview = model.generator(self.source, embedding, self.embedding_ids, inst_norm,
+                                                      is_training=False, return_preview=True)
+            self.preview = preview["output"]
+            self.resume = preview["resume"]
+            saver = tf.train.Saver(var_list=tf.global_variables())
+            init_op = tf.global_variables_initializer()
+        self.graph.finalize()
+        self.sess = tf.Session(graph=self.graph, config=config)
+        if model_dir is None:
+            self.sess.run(init_op)
+        else:
+            ckpt = tf.train.get_checkpoint_state(model_dir)
+            if not ckpt:
+                raise Exception("no checkpoint found in %s" % model_dir)
+            saver.restore(self.sess, ckpt.model_checkpoint_path)
+
+        self.refinements = queue.Queue()
+        self.thread = threading.Thread(target=self._refine)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def generate_preview(self, source_images, embedding_ids):
+        """
+        Return the preview and the Refinement of its full resolution result
+        """
+        started = time.time()
+        preview, resume = self.sess.run([self.preview, self.resume],
+                                        feed_dict={self.source: source_images, self.embedding_ids: embedding_ids})
+        feed_dict = dict(zip(self.resume, resume))
+        feed_dict[self.embedding_ids] = embedding_ids
+        refinement = Refinement(feed_dict, started)
+        refinement.preview_latency = time.time() - started
+        self.refinements.put(refinement)
+        return preview, refinement
+
+    def generate(self, source_images, embedding_ids):
+        """
+        The full resolution result in one go, without preview
+        """
+        return self.sess.run(self.output, feed_dict={self.source: source_images, self.embedding_ids: embedding_ids})
+
+    def _refine(self):
+        while True:
+            refinement = self.refinements.get()
+            if refinement is None:
+                return
+            if not refinement.cancelled:
+                try:
+                    refinement.output = self.sess.run(self.output, feed_dict=refinement.feed_dict)
+                except Exception as e:
+                    refinement.error = e
+                refinement.latency = time.time() - refinement.started
+            # the fed activations are not needed any more
+            refinement.feed_dict = None
+            refinement.event.set()
+
+    def close(self):
+        self.refinements.put(None)
+        self.thread.join()
+        self.sess.close()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import sys
+import threading
+
+import numpy as np
+
+if sys.version_info[0] >= 3:
+    import queue
+else:
+    import Queue as queue
+
+# Loss aware sampling of the training examples. The shuffled queue of
+# dataset.py gives every image the same share of the steps, while the
+# generator keeps failing on a few hard ones (many strokes, rare shapes).
+# The sampler keeps one float per example, a moving average of its L1 and
+# const losses taken from the training step, and draws batches with a
+# probability proportional to it:
+# * examples never seen yet get the largest priority so they are seen once
+# * a floor, a fraction of the mean, keeps easy examples in the rotation
+# * alpha flattens (< 1) or sharpens (> 1) the distribution
+# The L1 and const losses of a drawn batch are weighted by the importance
+# weights (N * P(i)) ** -beta normalized to a mean of 1, beta = 1 removes
+# the bias of the sampling entirely, 0 ignores it.
+
+
+class PrioritySampler(object):
+    def __init__(self, num_examples, alpha=1.0, beta=0.5, floor=0.1, decay=0.5, seed=None):
+        """
+        decay: weight of the previous loss in the moving average of an example
+        """
+        self.alpha  = alpha
+        self.beta   = beta
+        self.floor  = floor
+        self.decay  = decay
+        self.random = np.random.RandomState(seed)
+        # sample runs on the loader thread, update on the training thread
+        self.lock   = threading.Lock()
+        # nan until the example has been trained on
+        self.losses = np.full(num_examples, np.nan, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.losses)
+
+    def probabilities(self):
+        with self.lock:
+            return self._probabilities()
+
+    def _probabilities(self):
+        seen = ~np.isnan(self.losses)
+        if not seen.any():
+            return np.full(len(self), 1.0 / len(self))
+        losses = self.losses[seen]
+        priorities = np.full(len(self), losses.max(), dtype=np.float64)
+        priorities[seen] = np.maximum(losses, self.floor * losses.mean())
+        priorities = np.maximum(priorities, 1e-8) ** self.alpha
+        return priorities / priorities.sum()
+
+    def sample(self, batch_size):
+        """
+        Return the indices of a batch and their importance weights
+        """
+        with self.lock:
+            probabilities = self._probabilities()
+            indices = self.random.choice(len(self), batch_size, p=probabilities)
+        weights = (len(self) * probabilities[indices]) ** -self.beta
+        return indices, (weights / weights.mean()).astype(np.float32)
+
+    def update(self, indices, losses):
+        with self.lock:
+            previous = self.losses[indices]
+            self.losses[indices] = np.where(np.isnan(previous), losses,
+                                            self.decay * previous + (1 - self.decay) * losses)
+
+    def stats(self):
+        with self.lock:
+            losses = self.losses.copy()
+            probabilities = self._probabilities()
+        seen = ~np.isnan(losses)
+        # share of the sampling mass on the hardest tenth of the examples
+        top = np.sort(probabilities)[-max(1, len(self) // 10):].sum()
+        return {"seen": float(seen.mean()), "mean_loss": float(np.nanmean(losses)) if seen.any() else 0.0,
+                "top_decile_share": float(top)}
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by the chief meanwhile
+                pass
+        with self.lock:
+            losses = self.losses.copy()
+        np.save(path + ".tmp.npy", losses)
+        os.rename(path + ".tmp.npy", path)
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return False
+        losses = np.load(path)
+        if losses.shape != self.losses.shape:
+            print("skip the priorities of %s, the data changed" % path)
+            return False
+        with self.lock:
+            self.losses = losses
+        return True
+
+
+class PriorityLoader(object):
+    """
+    Draw batches from the sampler and decode them with the example loader
+    of dataset.py in a background thread, a few batches ahead
+    """
+    def __init__(self, sess, sampler, image_list, label_list, example_loader, batch_size, prefetch=2):
+        self.sess           = sess
+        self.sampler        = sampler
+        self.image_list     = np.asarray(image_list)
+        self.label_list     = np.asarray(label_list, dtype=np.int64)
+        self.paths, self.images = example_loader
+        self.batch_size     = batch_size
+        self.batches        = queue.Queue(maxsize=prefetch)
+        self.stopped        = False
+        self.thread         = threading.Thread(target=self._load)
+        self.thread.daemon  = True
+        self.thread.start()
+
+    def _load(self):
+        while not self.stopped:
+            indices, weights = self.sampler.sample(self.batch_size)
+            images = self.sess.run(self.images, feed_dict={self.paths: self.image_list[indices]})
+            self.batches.put((images, self.label_list[indices], indices, weights))
+
+    def next(self):
+        """
+        Return (images, labels, indices, weights)
+        """
+        return self.batches.get()
+
+    def close(self):
+        self.stopped = True
+        try:
+            # unblock the loader waiting on a full queue
+            self.batches.get_nowait()
+        except queue.Empty:
+            pass
+        self.thread.join()
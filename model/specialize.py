@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+from .gegan import GEGAN
+
+# Generators specialized to a single embedding id, for serving a few known
+# styles. The weights are read from a checkpoint and folded with numpy:
+# * the style embedding concatenated (tiled if the encoder stops before
+#   1x1) at the bottleneck only feeds the first decoder deconvolution, its
+#   contribution becomes a bias map
+# * batch norm runs on moving statistics at inference, it is folded into
+#   the weights and biases of the convolution in front of it
+# * the conditional instance norm scale/shift rows of the style become
+#   constants. They cannot go into the deconv weights, the instance
+#   normalization in between would cancel them
+# The specialized graph has no embedding lookup, no concat at the
+# bottleneck and no batch norm ops left.
+
+BN_EPSILON = 1e-5
+
+
+def read_generator_values(model_dir):
+    """
+    Read the generator weights of the latest checkpoint in model_dir,
+    return (checkpoint path, {variable name: value})
+    """
+    ckpt = tf.train.get_checkpoint_state(model_dir)
+    if not ckpt:
+        raise Exception("no checkpoint found in %s" % model_dir)
+    reader = tf.train.NewCheckpointReader(ckpt.model_checkpoint_path)
+    values = dict()
+    for name in reader.get_variable_to_shape_map():
+        if "/Adam" in name:
+            continue
+        if name.startswith("generator/") or name.startswith("embedding/"):
+            values[name] = reader.get_tensor(name)
+    return ckpt.model_checkpoint_path, values
+
+
+def _deconv_constant(inputs, kernel, output_width):
+    """
+    conv2d_transpose of a constant [1, width, width, channels] input
+    """
+    stride = output_width // inputs.shape[1]
+    with tf.Graph().as_default(), tf.Session() as sess:
+        output = tf.nn.conv2d_transpose(tf.constant(inputs.astype(np.float32)), tf.constant(kernel),
+                                        output_shape=[1, output_width, output_width, kernel.shape[2]],
+                                        strides=[1, stride, stride, 1])
+        return sess.run(output)
+
+
+def fold_generator(values, embedding_id, model):
+    """
+    Fold the style and the batch norms into the generator weights of model,
+    return (folded values, style constants for GEGAN.style)
+    """
+    values = dict(values)
+    style = {"scale": dict(), "shift": dict()}
+
+    # d1 sees the embedding, tiled over the bottleneck, as a constant input
+    # and its contribution is a fixed map of the output of d1, twice as wide
+    bottleneck = model.output_width // 2 ** (model.generator_depth + model.grow_stages)
+    embedding = values["embedding/E"][embedding_id].reshape([1, 1, 1, -1])
+    embedding = np.tile(embedding, [1, bottleneck, bottleneck, 1])
+    kernel = values["generator/g_d1_deconv/W"]
+    embedding_dim = embedding.shape[-1]
+    values["generator/g_d1_deconv/W"] = kernel[:, :, :, :-embedding_dim]
+    style["d1_bias"] = _deconv_constant(np.maximum(embedding, 0.0), kernel[:, :, :, -embedding_dim:],
+                                        2 * bottleneck)
+
+    for name in list(values.keys()):
+        if name.endswith("_bn/moving_mean"):
+            prefix = name[:-len("_bn/moving_mean")]
+            mean     = values[prefix + "_bn/moving_mean"]
+            variance = values[prefix + "_bn/moving_variance"]
+            gamma    = values[prefix + "_bn/gamma"]
+            beta     = values[prefix + "_bn/beta"]
+            factor   = gamma / np.sqrt(variance + BN_EPSILON)
+
+            if prefix + "_conv/W" in values:
+                # conv2d filter [height, width, in_channels, output_channels]
+                conv = prefix + "_conv"
+                values[conv + "/W"] = values[conv + "/W"] * factor
+            else:
+                # deconv2d filter [height, width, output_channels, in_channels]
+                conv = prefix + "_deconv"
+                values[conv + "/W"] = values[conv + "/W"] * factor[:, np.newaxis]
+            values[conv + "/b"] = (values[conv + "/b"] - mean) * factor + beta
+            if prefix == "generator/g_d1":
+                style["d1_bias"] = style["d1_bias"] * factor
+        elif name.endswith("_inst_norm/scale"):
+            layer = name[len("generator/g_"):-len("_inst_norm/scale")]
+            shift = name[:-len("scale")] + "shift"
+            style["scale"][layer] = values[name][embedding_id].reshape([1, 1, 1, -1])
+            style["shift"][layer] = values[shift][embedding_id].reshape([1, 1, 1, -1])
+
+    values = dict((k, v.astype(np.float32)) for k, v in values.items())
+    return values, style
+
+
+def _constant_getter(values):
+    def getter(getter, name, shape=None, *args, **kwargs):
+        value = values[name]
+        if shape is not None and list(value.shape) != list(shape):
+            raise Exception("folded %s has shape %s, expected %s" % (name, value.shape, shape))
+        return tf.constant(value, name=name.split("/")[-1])
+    return getter
+
+
+class StyleGenerator(object):
+    """
+    Generator compiled for a single embedding id, with its own graph and session
+    """
+    def __init__(self, model_dir, embedding_id, batch_size=16, image_size=64, base_width=None,
+                 inst_norm=False, config=None, **model_options):
+        """
+        model_options: the architecture of the checkpoint, e.g. generator_dim,
+            kernel_size and generator_depth of a distilled student
+        """
+        self.embedding_id = embedding_id
+        self.version, values = read_generator_values(model_dir)
+        model = GEGAN(batch_size=batch_size, input_width=image_size, output_width=image_size,
+                      base_width=base_width, **model_options)
+        values, style = fold_generator(values, embedding_id, model)
+        model.style = style
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.source = tf.placeholder(tf.float32, [batch_size, image_size, image_size, model.input_filters],
+                                         name="source")
+            with tf.variable_scope(tf.get_variable_scope(), custom_getter=_constant_getter(values)):
+                self.output, _ = model.generator(self.source, None, None, inst_norm, is_training=False)
+        self.graph.finalize()
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def generate(self, source_images):
+        return self.sess.run(self.output, feed_dict={self.source: source_images})
+
+    def close(self):
+        self.sess.close()
+
+
+class StyleGeneratorCache(object):
+    """
+    Specialized generators keyed by (model version, embedding id), the least
+    recently used one is closed when the cache is full. The model version is
+    the path of the latest checkpoint, so a new checkpoint compiles anew.
+    """
+    def __init__(self, capacity=8, **generator_kwargs):
+        self.capacity           = capacity
+        self.generator_kwargs   = generator_kwargs
+        self.generators         = OrderedDict()
+        self.lock               = threading.Lock()
+
+    def get(self, model_dir, embedding_id):
+        ckpt = tf.train.get_checkpoint_state(model_dir)
+        if not ckpt:
+            raise Exception("no checkpoint found in %s" % model_dir)
+        key = (ckpt.model_checkpoint_path, embedding_id)
+
+        with self.lock:
+            generator = self.generators.pop(key, None)
+            if generator is None:
+                generator = StyleGenerator(model_dir, embedding_id, **self.generator_kwargs)
+                while len(self.generators) >= self.capacity:
+                    _, evicted = self.generators.popitem(last=False)
+                    evicted.close()
+            # most recently used at the end
+            self.generators[key] = generator
+            return generator
+
+    def clear(self):
+        with self.lock:
+            for generator in self.generators.values():
+                generator.close()
+            self.generators.clear()
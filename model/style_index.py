@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import os
+
+import numpy as np
+
+# Nearest style search over the styles a generator was trained on, e.g. to
+# find the trained font closest to a handwriting sample, or the fonts that
+# are redundant. The index holds one unit vector per style in a float32
+# matrix saved as .npy and memory mapped when loaded, a top-k query is one
+# matrix product of the batch of queries with the rows, a chunk of rows at
+# a time, and an argpartition per chunk. Two kinds of style vectors, both
+# read from the checkpoint with no pass over the data:
+# * embedding: the rows of the embedding table, for style to style queries
+#   and for a font fitted by onboard.py
+# * discriminator: the columns of the d_fc2 category head, averaged over
+#   the positions of h3 to its channel profile. A glyph set is described
+#   by the mean of its h3 features over positions and glyphs, in the same
+#   space, so any handwriting sample can be queried
+# The encoder bottleneck is no style descriptor, the const loss trains it
+# to be the same for a glyph in every style.
+
+KINDS = ("embedding", "discriminator")
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.sqrt((vectors * vectors).sum(axis=-1, keepdims=True))
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def read_style_values(model_dir):
+    """
+    Read the embedding table and the discriminator weights of the latest
+    checkpoint in model_dir, return (checkpoint path, {variable name: value})
+    """
+    import tensorflow as tf
+
+    ckpt = tf.train.get_checkpoint_state(model_dir)
+    if not ckpt:
+        raise Exception("no checkpoint found in %s" % model_dir)
+    reader = tf.train.NewCheckpointReader(ckpt.model_checkpoint_path)
+    values = dict()
+    for name in reader.get_variable_to_shape_map():
+        if "/Adam" in name:
+            continue
+        if name == "embedding/E" or name.startswith("discriminator/"):
+            values[name] = reader.get_tensor(name)
+    return ckpt.model_checkpoint_path, values
+
+
+def style_vectors(values, kind):
+    """
+    One row per embedding id
+    """
+    if kind == "embedding":
+        embedding = values["embedding/E"]
+        return embedding.reshape([embedding.shape[0], -1])
+    if kind == "discriminator":
+        if "discriminator/d_fc2/W" not in values:
+            raise Exception("no discriminator in the checkpoint, it was exported generator only")
+        # d_fc2/W is [h * w * channels, embedding_num] over the flattened h3
+        weights = values["discriminator/d_fc2/W"]
+        channels = values["discriminator/d_h3_conv/b"].shape[0]
+        return weights.reshape([-1, channels, weights.shape[1]]).mean(axis=0).T
+    raise Exception("unknown style kind %s, expected one of %s" % (kind, ", ".join(KINDS)))
+
+
+class StyleIndex(object):
+    def __init__(self, vectors, ids=None, kind="embedding", version=None):
+        """
+        vectors: unit rows, see build, possibly memory mapped
+        ids: embedding id of every row, default to the row number
+        """
+        self.vectors    = vectors
+        self.ids        = np.arange(len(vectors)) if ids is None else np.asarray(ids)
+        self.kind       = kind
+        self.version    = version
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @classmethod
+    def build(cls, vectors, ids=None, kind="embedding", version=None):
+        return cls(normalize(vectors), ids, kind, version)
+
+    def search(self, queries, k=5, chunk_size=65536):
+        """
+        Cosine top-k of a batch of queries, return (ids, scores) both
+        [queries, k] in decreasing similarity
+        """
+        queries = normalize(np.atleast_2d(queries))
+        k = min(k, len(self))
+        rows = np.arange(len(queries))[:, np.newaxis]
+        top_scores = np.zeros([len(queries), 0], dtype=np.float32)
+        top_index = np.zeros([len(queries), 0], dtype=np.int64)
+        for start in range(0, len(self), chunk_size):
+            scores = np.dot(queries, self.vectors[start:start + chunk_size].T)
+            index = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+            scores = np.concatenate([top_scores, scores], axis=1)
+            index = np.concatenate([top_index, index], axis=1)
+            if scores.shape[1] > k:
+                best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores, index = scores[rows, best], index[rows, best]
+            top_scores, top_index = scores, index
+        order = np.argsort(-top_scores, axis=1)
+        return self.ids[top_index[rows, order]], top_scores[rows, order]
+
+    def vectors_of(self, ids):
+        positions = dict((int(i), p) for p, i in enumerate(self.ids))
+        return np.asarray(self.vectors[[positions[int(i)] for i in ids]])
+
+    def neighbors(self, ids, k=5):
+        """
+        The k styles closest to the indexed styles ids, themselves excluded
+        """
+        found, scores = self.search(self.vectors_of(ids), k + 1)
+        results = list()
+        for i, row, row_scores in zip(ids, found, scores):
+            keep = row != i
+            results.append((row[keep][:k], row_scores[keep][:k]))
+        return results
+
+    def redundant(self, threshold=0.95, chunk_size=4096):
+        """
+        Pairs of styles with a cosine similarity of at least threshold,
+        return [(id, id, score)] most similar first
+        """
+        pairs = list()
+        vectors = np.asarray(self.vectors)
+        for start in range(0, len(self), chunk_size):
+            scores = np.dot(vectors[start:start + chunk_size], vectors.T)
+            for row, column in zip(*np.nonzero(scores >= threshold)):
+                if start + row < column:
+                    pairs.append((int(self.ids[start + row]), int(self.ids[column]), float(scores[row, column])))
+        return sorted(pairs, key=lambda p: -p[2])
+
+    def save(self, index_dir):
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        vectors_path = os.path.join(index_dir, "vectors.npy")
+        # np.save appends .npy to names without it
+        np.save(vectors_path + ".tmp.npy", np.asarray(self.vectors, dtype=np.float32))
+        os.rename(vectors_path + ".tmp.npy", vectors_path)
+        index_path = os.path.join(index_dir, "index.json")
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({"kind": self.kind, "version": self.version, "ids": [int(i) for i in self.ids]}, f)
+        os.rename(index_path + ".tmp", index_path)
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        with open(os.path.join(index_dir, "index.json")) as f:
+            index = json.load(f)
+        vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode="r" if mmap else None)
+        return cls(vectors, index["ids"], index["kind"], index["version"])
+
+
+def build_index(model_dir, kind="embedding"):
+    version, values = read_style_values(model_dir)
+    return StyleIndex.build(style_vectors(values, kind), kind=kind, version=version)
+
+
+class GlyphStyleEncoder(object):
+    """
+    Describe glyph sets by their discriminator features, in the space of the
+    discriminator index, with its own graph and session
+    """
+    def __init__(self, model_dir, batch_size=16, image_size=64, config=None, **model_options):
+        """
+        model_options: discriminator shape of the checkpoint, e.g. discriminator_dim
+        """
+        import tensorflow as tf
+        from .gegan import GEGAN
+        from .specialize import _constant_getter
+
+        self.version, values = read_style_values(model_dir)
+        self.batch_size = batch_size
+        model = GEGAN(batch_size=batch_size, input_width=image_size, output_width=image_size,
+                      embedding_num=values["discriminator/d_fc2/W"].shape[1], **model_options)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.images = tf.placeholder(tf.float32, [batch_size, image_size, image_size, model.output_filters],
+                                         name="images")
+            with tf.variable_scope(tf.get_variable_scope(), custom_getter=_constant_getter(values)):
+                _, _, _, features = model.discriminator(self.images, is_training=False, return_features=True)
+            self.features = tf.reduce_mean(features, axis=[1, 2])
+        self.graph.finalize()
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def encode(self, glyph_sets):
+        """
+        glyph_sets: list of normalized glyph arrays [glyphs, size, size, 3],
+        return one style vector per set
+        """
+        vectors = list()
+        for glyphs in glyph_sets:
+            features = list()
+            for start in range(0, len(glyphs), self.batch_size):
+                batch = glyphs[start:start + self.batch_size]
+                count = len(batch)
+                if count < self.batch_size:
+                    # the batch size is static, pad with the first glyph
+                    batch = np.concatenate([batch, np.repeat(batch[:1], self.batch_size - count, axis=0)])
+                features.append(self.sess.run(self.features, feed_dict={self.images: batch})[:count])
+            vectors.append(np.concatenate(features).mean(axis=0))
+        return np.stack(vectors)
+
+    def close(self):
+        self.sess.close()
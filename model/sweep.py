@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import os
+import time
+
+import tensorflow as tf
+
+from .gegan import GEGAN
+
+# Hyperparameter sweep of several GEGAN configurations in one process and
+# one graph. Separate train.py runs each decode the whole dataset, load
+# vgg-face.mat and start their own queue runners; here the trials share:
+# * one input pipeline, every step dequeues one batch for all of them
+# * one pair of real_data/embedding_ids inputs the trials are built on
+# * one frozen VGG, created once at the root and reused by every vgg loss
+# Each trial is built under its own trial_<n> variable scope with its own
+# optimizers, made by GEGAN.build_update like in train.py so the loss
+# scaling of the trial applies, and checkpoints under its own experiment id, with the scope
+# stripped from the names, so export.py, infer.py and evaluate.py load it
+# like any other model. The updates of all the trials go through one
+# session call per phase, so they overlap on the inter op threads.
+
+# GEGAN options a trial may override
+TRIAL_OPTIONS = ("L1_penalty", "Lconst_penalty", "Lcategory_penalty", "Lvgg_penalty", "embedding_dim",
+                 "generator_dim", "discriminator_dim", "precision", "loss_scale")
+
+
+def parse_trials(spec):
+    """
+    "L1_penalty=100,Lvgg_penalty=0.1;embedding_dim=128" or the path of a
+    json file with a list of such dicts, return [{option: value}]
+    """
+    if spec.endswith(".json"):
+        with open(spec) as f:
+            trials = json.load(f)
+    else:
+        trials = list()
+        for trial in spec.split(";"):
+            options = dict()
+            for option in trial.split(","):
+                if option.strip():
+                    key, value = option.split("=")
+                    options[key.strip()] = json.loads(value)
+            trials.append(options)
+    for options in trials:
+        for key in options:
+            if key not in TRIAL_OPTIONS:
+                raise Exception("unknown trial option %s, expected one of %s" % (key, ", ".join(TRIAL_OPTIONS)))
+    return trials
+
+
+class Trial(object):
+    def __init__(self, index, model, options):
+        self.index      = index
+        self.model      = model
+        self.options    = options
+        self.scope      = "trial_%d" % index
+        self.averages   = dict()
+
+    def update_averages(self, losses, smoothing=0.98):
+        for name, value in losses.items():
+            average = self.averages.get(name)
+            self.averages[name] = float(value if average is None else smoothing * average + (1 - smoothing) * value)
+
+
+class Sweep(object):
+    def __init__(self, experiment_dir, trials, experiment_id=0, batch_size=16, image_size=64,
+                 embedding_num=2, inst_norm=False, reader_threads=4, **options):
+        """
+        trials: [{option: value}] overriding options, the GEGAN options
+            shared by all of them. Trial n gets experiment id experiment_id + n
+        """
+        from .vgg import VGG_Model
+        from .dataset import get_train_dataloader
+
+        self.experiment_dir = experiment_dir
+        self.batch_size     = batch_size
+        self.dataloader     = get_train_dataloader(batch_size, num_threads=reader_threads, image_size=image_size)
+        self.real_data      = tf.placeholder(tf.float32, [batch_size, image_size, image_size, 3], name="real_images")
+        self.embedding_ids  = tf.placeholder(tf.int64, shape=None, name="embedding_ids")
+        self.learning_rate  = tf.placeholder(tf.float32, name="learning_rate")
+
+        vgg = VGG_Model()
+        vgg.create_variables()
+        vgg_vars = [v for v in tf.global_variables() if v.op.name.startswith("vgg/")]
+
+        self.trials = list()
+        for index, trial_options in enumerate(trials):
+            kwargs = dict(options)
+            kwargs.update(trial_options)
+            model = GEGAN(experiment_dir, experiment_id=experiment_id + index, batch_size=batch_size,
+                          input_width=image_size, output_width=image_size, embedding_num=embedding_num, **kwargs)
+            model.vgg = vgg
+            trial = Trial(index, model, trial_options)
+            existing = set(tf.global_variables())
+            with tf.variable_scope(trial.scope):
+                model.build_model(is_training=True, inst_norm=inst_norm,
+                                  inputs=(self.real_data, self.embedding_ids))
+                _, loss_handle, _, _ = model.retrieve_handles()
+                prefix = trial.scope + "/"
+                g_vars, d_vars = model.retrieve_trainable_vars()
+                g_vars = [v for v in g_vars if v.op.name.startswith(prefix)]
+                d_vars = [v for v in d_vars if v.op.name.startswith(prefix)]
+                trial.d_train = model.build_update(self.learning_rate, loss_handle.d_loss, d_vars).train_op
+                trial.g_train = model.build_update(self.learning_rate, loss_handle.g_loss, g_vars).train_op
+            # everything the trial created, with its optimizer state, plus the
+            # shared vgg weights every checkpoint of this repo carries
+            created = [v for v in tf.global_variables() if v not in existing]
+            var_list = dict((v.op.name[len(prefix):] if v.op.name.startswith(prefix) else v.op.name, v)
+                            for v in created)
+            var_list.update((v.op.name, v) for v in vgg_vars)
+            trial.saver = tf.train.Saver(var_list=var_list, max_to_keep=3)
+            model_id, trial.model_dir = model.get_model_id_and_dir()
+            trial.writer = tf.summary.FileWriter(os.path.join(model.log_dir, model_id))
+            self.trials.append(trial)
+        print("sweep of %d trials, %d trainable variables" % (len(self.trials), len(tf.trainable_variables())))
+
+    def step(self, sess, feed_dict):
+        trials = self.trials
+        handles = [t.model.retrieve_handles() for t in trials]
+        d_fetches = [[h[1].d_loss, h[3].d_merged] for h in handles]
+        _, d_results = sess.run([[t.d_train for t in trials], d_fetches], feed_dict=feed_dict)
+        sess.run([t.g_train for t in trials], feed_dict=feed_dict)
+        # train G twice like GEGAN.train, collecting the losses
+        g_fetches = [[h[1].g_loss, h[1].l1_loss, h[1].const_loss, h[1].category_loss, h[1].cheat_loss,
+                      h[1].vgg_loss, h[3].g_merged] for h in handles]
+        _, g_results = sess.run([[t.g_train for t in trials], g_fetches], feed_dict=feed_dict)
+        return d_results, g_results
+
+    def train(self, sess, lr=0.0002, steps=10000, checkpoint_steps=1000, resume=True, log_steps=50):
+        sess.run(tf.global_variables_initializer())
+        sess.run(tf.local_variables_initializer())
+        tf.train.start_queue_runners(sess=sess)
+        for trial in self.trials:
+            trial.model.register_session(sess)
+            if resume:
+                trial.model.restore_model(trial.saver, trial.model_dir)
+
+        start_time = time.time()
+        for step in range(steps):
+            images, labels = sess.run(self.dataloader)
+            feed_dict = {self.real_data: images / 127.5 - 1.0, self.embedding_ids: labels,
+                         self.learning_rate: lr}
+            d_results, g_results = self.step(sess, feed_dict)
+
+            for trial, (d_loss, d_summary), (g_loss, l1_loss, const_loss, category_loss, cheat_loss, vgg_loss,
+                                             g_summary) in zip(self.trials, d_results, g_results):
+                # l1_loss and const_loss carry the penalties a trial may
+                # sweep, l1 and const are comparable across trials
+                model = trial.model
+                trial.update_averages({"d_loss": d_loss, "g_loss": g_loss, "l1_loss": l1_loss,
+                                       "const_loss": const_loss, "category_loss": category_loss,
+                                       "cheat_loss": cheat_loss, "vgg_loss": vgg_loss,
+                                       "l1": l1_loss / model.L1_penalty,
+                                       "const": const_loss / model.Lconst_penalty if model.Lconst_penalty else 0.0})
+                if step % log_steps == 0:
+                    trial.writer.add_summary(d_summary, step)
+                    trial.writer.add_summary(g_summary, step)
+
+            if step % log_steps == 0:
+                passed = time.time() - start_time
+                print("sweep step %d, %4.2fs, %.2f examples/sec" %
+                      (step, passed, (step + 1) * self.batch_size * len(self.trials) / passed))
+                for trial in self.trials:
+                    print("  %s %s: %s" % (trial.scope, trial.options,
+                                           ", ".join("%s %.4f" % kv for kv in sorted(trial.averages.items()))))
+
+            if step % checkpoint_steps == 0 or step == steps - 1:
+                for trial in self.trials:
+                    trial.model.checkpoint(trial.saver, step)
+                    trial.writer.flush()
+                self.write_results(step)
+        return self.write_results(steps - 1)
+
+    def write_results(self, step):
+        """
+        Write sweep.json, the trials ranked by their unweighted L1
+        """
+        results = [{"trial": t.scope, "experiment_id": t.model.experiment_id, "model_dir": t.model_dir,
+                    "options": t.options, "step": step, "l1": t.averages.get("l1"), "losses": t.averages}
+                   for t in sorted(self.trials, key=lambda t: t.averages.get("l1", float("inf")))]
+        path = os.path.join(self.experiment_dir, "sweep.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(results, f, indent=2)
+        os.rename(path + ".tmp", path)
+        return results
@@ -32,6 +32,30 @@ def denormalize_image(img):
     deimg = (img + 1) * 127.5
     return np.clip(deimg, 0.0, 255.0)
 
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def list_glyphs(source_dir):
+    """
+    Source glyph images in source_dir sorted by name, one file per character
+    """
+    names = sorted(f for f in os.listdir(source_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+    return [os.path.join(source_dir, f) for f in names]
+
+
+def load_glyphs(paths, image_size):
+    """
+    Decode and normalize the glyph images, return (names, images)
+    """
+    names, images = list(), list()
+    for path in paths:
+        img = Image.open(path).convert("RGB")
+        if img.size != (image_size, image_size):
+            img = img.resize((image_size, image_size), Image.LANCZOS)
+        names.append(os.path.splitext(os.path.basename(path))[0])
+        images.append(normalize_image(np.asarray(img, dtype=np.float32)))
+    return names, np.stack(images)
+
 def read_split_image(img):
     mat = misc.imread(img).astype(np.float)
     side = int(mat.shape[1] / 2)
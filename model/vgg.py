@@ -3,6 +3,7 @@ import tensorflow as tf
 import numpy as np
 import os
 from scipy.io import loadmat
+from .ops import recomputed, compute_dtype
 
 class VGG_Model(object):
     def __init__(self):
@@ -16,12 +17,89 @@ class VGG_Model(object):
         self.average_image = np.squeeze(self.normalization[0][0]['averageImage'][0][0][0][0])
         self.image_size    = np.squeeze(self.normalization[0][0]['imageSize'][0][0])
 
+        # outputs compared by the vgg loss
+        self.loss_layers   = ["conv4_3", "conv5_3"]
+
         self.used = False
+        # fixed by the first use, models built under another variable scope
+        # (e.g. the trials of a sweep) share the same weights
+        self.scope = None
+
+    def layer_weights(self, layer):
+        name = layer[0]['name'][0][0]
+        kernel, bias = layer[0]['weights'][0][0]
+        bias   = np.squeeze(bias).reshape(-1)
+        kernel = tf.get_variable(name+"_W", initializer=tf.constant(kernel))
+        bias   = tf.get_variable(name+"_b", initializer=tf.constant(bias))
+        return kernel, bias
+
+    def create_variables(self):
+        """
+        Create the weights in the "vgg" scope of the root, before building
+        models under other scopes
+        """
+        with tf.variable_scope("vgg") as scope:
+            for _, segment in self.segments():
+                for layer in segment:
+                    if layer[0]['type'][0][0] == 'conv':
+                        self.layer_weights(layer)
+        self.scope = scope
+        self.used = True
+
+    def apply_layers(self, layers, current):
+        for layer in layers:
+            name = layer[0]['name'][0][0]
+            layer_type = layer[0]['type'][0][0]
+            if layer_type == 'conv':
+                if name[:2] == 'fc':
+                    padding = 'VALID'
+                else:
+                    padding = 'SAME'
+                stride = layer[0]['stride'][0][0]
+                kernel, bias = self.layer_weights(layer)
+                dtype  = compute_dtype()
+                conv   = tf.nn.conv2d(tf.cast(current, dtype), tf.cast(kernel, dtype),
+                                    strides=(1, stride[0], stride[0], 1), padding=padding)
+                current = tf.nn.bias_add(conv, tf.cast(bias, dtype))
+                # print(name, 'stride:', stride, 'kernel size:', tf.shape(kernel))
+            elif layer_type == 'relu':
+                current = tf.nn.relu(current)
+                # print(name)
+            elif layer_type == 'pool':
+                stride = layer[0]['stride'][0][0]
+                pool = layer[0]['pool'][0][0]
+                current = tf.nn.max_pool(current, ksize=(1, pool[0], pool[1], 1),
+                                         strides=(1, stride[0], stride[0], 1), padding='SAME')
+                # print(name, 'stride:', stride)
+            elif layer_type == 'softmax':
+                current = tf.nn.softmax(tf.reshape(current, [-1, len(self.class_names)]))
+                # print(name)
+        return current
+
+    def segments(self):
+        """
+        Split the layers up to the last loss layer into segments, each one
+        ending with a pooling layer or a loss layer
+        """
+        segments = [[]]
+        for layer in self.layers[0]:
+            name = layer[0]['name'][0][0]
+            layer_type = layer[0]['type'][0][0]
+            segments[-1].append(layer)
+            if name in self.loss_layers:
+                if name == self.loss_layers[-1]:
+                    # layers after the last loss layer are never used
+                    break
+                segments.append([])
+            elif layer_type == 'pool':
+                segments.append([])
+        return [(segment[-1][0]['name'][0][0], segment) for segment in segments if segment]
 
-    def vgg(self, input_maps, reuse=False):
-        with tf.variable_scope("vgg"):
+    def vgg(self, input_maps, reuse=False, recompute=False):
+        with tf.variable_scope(self.scope or "vgg") as scope:
             if reuse:
                 tf.get_variable_scope().reuse_variables()
+            self.scope = scope
 
             input_maps = input_maps - tf.constant(self.average_image)
             input_maps = tf.image.resize_images(input_maps, size=[self.image_size[0], self.image_size[1]])
@@ -29,50 +107,29 @@ class VGG_Model(object):
             # read layer info
             current = input_maps
             network = {}
-            for layer in self.layers[0]:
-                name = layer[0]['name'][0][0]
-                layer_type = layer[0]['type'][0][0]
-                if layer_type == 'conv':
-                    if name[:2] == 'fc':
-                        padding = 'VALID'
-                    else:
-                        padding = 'SAME'
-                    stride = layer[0]['stride'][0][0]
-                    kernel, bias = layer[0]['weights'][0][0]
-                    bias   = np.squeeze(bias).reshape(-1)
-                    kernel = tf.constant(kernel)
-                    bias   = tf.constant(bias)
-                    kernel = tf.get_variable(name+"_W", initializer=kernel)
-                    bias   = tf.get_variable(name+"_b", initializer=bias)
-                    conv   = tf.nn.conv2d(current, kernel,
-                                        strides=(1, stride[0], stride[0], 1), padding=padding)
-                    current = tf.nn.bias_add(conv, bias)
-                    # print(name, 'stride:', stride, 'kernel size:', tf.shape(kernel))
-                elif layer_type == 'relu':
-                    current = tf.nn.relu(current)
-                    # print(name)
-                elif layer_type == 'pool':
-                    stride = layer[0]['stride'][0][0]
-                    pool = layer[0]['pool'][0][0]
-                    current = tf.nn.max_pool(current, ksize=(1, pool[0], pool[1], 1),
-                                             strides=(1, stride[0], stride[0], 1), padding='SAME')
-                    # print(name, 'stride:', stride)
-                elif layer_type == 'softmax':
-                    current = tf.nn.softmax(tf.reshape(current, [-1, len(self.class_names)]))
-                    # print(name)
+            for name, segment in self.segments():
+                def block(x, segment=segment, is_recomputing=False):
+                    return self.apply_layers(segment, x)
 
+                # the 224x224 activations of each segment are the
+                # largest ones of the whole training graph
+                if recompute:
+                    current = recomputed(block, current)
+                else:
+                    current = block(current)
                 network[name] = current
 
-        return network["conv4_3"], network["conv5_3"]
+        # the loss is reduced in float32
+        return tuple(tf.cast(network[name], tf.float32) for name in self.loss_layers)
 
-    def vgg_loss(self, a, b):
+    def vgg_loss(self, a, b, recompute=False):
         if self.used == False:
-            conv4_a, conv5_a = self.vgg(a, reuse=False)
+            conv4_a, conv5_a = self.vgg(a, reuse=False, recompute=recompute)
             self.used = True
         else:
-            conv4_a, conv5_a = self.vgg(a, reuse=True)
+            conv4_a, conv5_a = self.vgg(a, reuse=True, recompute=recompute)
 
-        conv4_b, conv5_b = self.vgg(b, reuse=True)
+        conv4_b, conv5_b = self.vgg(b, reuse=True, recompute=recompute)
 
         return tf.reduce_mean(tf.abs(conv4_a - conv4_b)) + \
                tf.reduce_mean(tf.abs(conv5_a - conv5_b))
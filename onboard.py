@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import os
+import time
+
+import tensorflow as tf
+
+from model.onboard import Onboarder
+from model.cpu_profile import load_profile, session_config
+from model.utils import list_glyphs, load_glyphs
+
+parser = argparse.ArgumentParser(description='Add a new font to a trained generator from a few of its glyphs')
+parser.add_argument('--model_dir', dest='model_dir', required=True,
+                    help='checkpoint directory of the trained generator')
+parser.add_argument('--source_dir', dest='source_dir', required=True,
+                    help='directory of the source glyph images, named like the target ones')
+parser.add_argument('--target_dir', dest='target_dir', required=True,
+                    help='directory of a few dozen glyph images of the new font')
+parser.add_argument('--save_dir', dest='save_dir', required=True,
+                    help='directory to write the generator with the new font to')
+parser.add_argument('--image_size', dest='image_size', type=int, default=64,
+                    help="size of your input and output image")
+parser.add_argument('--base_size', dest='base_size', type=int, default=None,
+                    help='first stage image size if the model was trained progressively')
+parser.add_argument('--generator_dim', dest='generator_dim', type=int, default=64,
+                    help='filters of the first generator layer')
+parser.add_argument('--kernel_size', dest='kernel_size', type=int, default=5, help='kernel size of the generator')
+parser.add_argument('--generator_depth', dest='generator_depth', type=int, default=None,
+                    help='encoder layers of the generator, default to the full depth of the image size')
+parser.add_argument('--inst_norm', dest='inst_norm', type=int, default=0,
+                    help='use conditional instance normalization in your model')
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=None,
+                    help='number of examples in batch, default to the cpu profile or 16')
+parser.add_argument('--lr', dest='lr', type=float, default=0.01, help='learning rate for adam')
+parser.add_argument('--steps', dest='steps', type=int, default=300, help='number of training steps')
+parser.add_argument('--cpu_profile', dest='cpu_profile', type=str, default=None,
+                    help='cpu profile tuned by benchmark.py --mode=autotune')
+args = parser.parse_args()
+profile = load_profile(args.cpu_profile, "train")
+if args.batch_size is None:
+    args.batch_size = profile["batch_size"]
+
+
+def main(_):
+    start_time = time.time()
+    target_paths = list_glyphs(args.target_dir)
+    source_paths = [os.path.join(args.source_dir, os.path.basename(p)) for p in target_paths]
+    missing = [p for p in source_paths if not os.path.exists(p)]
+    if missing:
+        raise Exception("no source glyph for %d target glyphs, e.g. %s" % (len(missing), missing[0]))
+    _, targets = load_glyphs(target_paths, args.image_size)
+    _, sources = load_glyphs(source_paths, args.image_size)
+
+    onboarder = Onboarder(args.model_dir, batch_size=args.batch_size, image_size=args.image_size,
+                          inst_norm=args.inst_norm, lr=args.lr, config=session_config(profile),
+                          generator_dim=args.generator_dim, kernel_size=args.kernel_size,
+                          generator_depth=args.generator_depth, base_width=args.base_size)
+    l1_loss = onboarder.train(sources, targets, steps=args.steps)
+    path = onboarder.save(args.save_dir)
+    onboarder.close()
+    print("onboarded %d glyphs as embedding id %d in %.1fs, l1_loss %.5f, saved %s" %
+          (len(targets), onboarder.embedding_id, time.time() - start_time, l1_loss, path))
+    print("use --embedding_num=%d with the new checkpoint" % (onboarder.embedding_id + 1))
+
+
+if __name__ == '__main__':
+    tf.app.run()
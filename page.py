@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import io
+import json
+import os
+import threading
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from model.gegan import GEGAN
+from model.cpu_profile import load_profile, session_config
+from model.cache import GlyphCache
+from model.page import PageLayout, render_text, cut_group, generate_group, composite_group, group_pages
+from model.pipeline import Stage, run_pipeline, print_report
+from model.utils import list_glyphs
+
+parser = argparse.ArgumentParser(description='Restyle whole pages of text')
+parser.add_argument('--model_dir', dest='model_dir', required=True,
+                    help='directory that saves the model checkpoints')
+parser.add_argument('--page_dir', dest='page_dir', type=str, default=None,
+                    help='directory of rendered page images')
+parser.add_argument('--text', dest='text', type=str, default=None,
+                    help='text file to render with --font, pages are separated by form feeds')
+parser.add_argument('--font', dest='font', type=str, default=None, help='source font to render --text with')
+parser.add_argument('--embedding_id', dest='embedding_id', type=int, default=0, help='style of the restyled pages')
+parser.add_argument('--save_dir', dest='save_dir', type=str, default='save_dir', help='path to save the pages')
+parser.add_argument('--cell_size', dest='cell_size', type=int, default=64, help='size of a glyph cell on the page')
+parser.add_argument('--margin', dest='margin', type=int, default=0, help='page margin around the cell grid')
+parser.add_argument('--columns', dest='columns', type=int, default=None,
+                    help='cells per row, default to what fits in the page, 20 for --text')
+parser.add_argument('--rows', dest='rows', type=int, default=None, help='rows of cells, default to what fits')
+parser.add_argument('--pages_per_group', dest='pages_per_group', type=int, default=8,
+                    help='pages whose unique cells are batched together')
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=None,
+                    help='number of examples in batch, default to the cpu profile or 16')
+parser.add_argument('--image_size', dest='image_size', type=int, default=64,
+                    help="size of your input and output image")
+parser.add_argument('--base_size', dest='base_size', type=int, default=None,
+                    help='first stage image size if the model was trained progressively')
+parser.add_argument('--generator_dim', dest='generator_dim', type=int, default=64,
+                    help='filters of the first generator layer, smaller for a distilled student')
+parser.add_argument('--kernel_size', dest='kernel_size', type=int, default=5, help='kernel size of the generator')
+parser.add_argument('--generator_depth', dest='generator_depth', type=int, default=None,
+                    help='encoder layers of the generator, default to the full depth of the image size')
+parser.add_argument('--embedding_num', dest='embedding_num', type=int, default=2,
+                    help='number for distinct embeddings, one more for every font added by onboard.py')
+parser.add_argument('--precision', dest='precision', type=str, default='float32',
+                    help='float32, or bfloat16 convolutions with float32 weights')
+parser.add_argument('--inst_norm', dest='inst_norm', type=int, default=0,
+                    help='use conditional instance normalization in your model')
+parser.add_argument('--cpu_profile', dest='cpu_profile', type=str, default=None,
+                    help='cpu profile tuned by benchmark.py --mode=autotune')
+parser.add_argument('--loader_threads', dest='loader_threads', type=int, default=2,
+                    help='threads reading and cutting the pages')
+parser.add_argument('--writer_threads', dest='writer_threads', type=int, default=2,
+                    help='threads compositing and writing the pages')
+parser.add_argument('--cache_dir', dest='cache_dir', type=str, default=None,
+                    help='keep the generated glyphs in a glyph cache under cache_dir, reused by later runs')
+parser.add_argument('--cache_mb', dest='cache_mb', type=int, default=1024,
+                    help='size in MB of the disk tier of the glyph cache')
+parser.add_argument('--cache_items', dest='cache_items', type=int, default=4096,
+                    help='glyphs kept in the memory tier of the glyph cache')
+args = parser.parse_args()
+profile = load_profile(args.cpu_profile, "infer")
+if args.batch_size is None:
+    args.batch_size = profile["batch_size"]
+
+
+def page_sources(layout):
+    """
+    (name, loader) of every page, the loaders run in the loader stage
+    """
+    if args.page_dir:
+        for path in list_glyphs(args.page_dir):
+            name = os.path.splitext(os.path.basename(path))[0]
+            yield name, lambda path=path: np.asarray(Image.open(path).convert("RGB"), dtype=np.uint8)
+    else:
+        if not args.font:
+            raise Exception("--text needs the --font to render it with")
+        with io.open(args.text, encoding="utf-8") as f:
+            pages = f.read().split(u"\f")
+        for i, text in enumerate(pages):
+            yield "page_%05d" % i, lambda text=text: render_text(text.strip(u"\n"), args.font, layout)
+
+
+def main(_):
+    if bool(args.page_dir) == bool(args.text):
+        raise Exception("give either --page_dir or --text")
+    if not os.path.exists(args.save_dir):
+        os.makedirs(args.save_dir)
+    layout = PageLayout(cell_size=args.cell_size, margin=args.margin, columns=args.columns, rows=args.rows)
+
+    with tf.Session(config=session_config(profile)) as sess:
+        model = GEGAN(batch_size=args.batch_size, input_width=args.image_size, output_width=args.image_size,
+                      base_width=args.base_size, generator_dim=args.generator_dim,
+                      kernel_size=args.kernel_size, generator_depth=args.generator_depth,
+                      embedding_num=args.embedding_num, precision=args.precision)
+        model.register_session(sess)
+        model.build_model(is_training=False, inst_norm=args.inst_norm)
+        saver = tf.train.Saver(var_list=model.retrieve_generator_vars())
+        if not model.restore_model(saver, args.model_dir):
+            raise Exception("no checkpoint found in %s" % args.model_dir)
+        input_handle, _, eval_handle, _ = model.retrieve_handles()
+
+        def generate_fn(images):
+            return sess.run(eval_handle.fake_s, feed_dict={input_handle.real_data: images,
+                                                           input_handle.embedding_ids: [args.embedding_id] *
+                                                                                       args.batch_size})
+
+        glyph_cache = None
+        if args.cache_dir:
+            glyph_cache = GlyphCache(args.model_dir, cache_dir=args.cache_dir, memory_items=args.cache_items,
+                                     disk_mb=args.cache_mb, image_shape=(args.image_size, args.image_size, 3))
+            model_fn = generate_fn
+
+            def generate_fn(images):
+                return glyph_cache.generate(images, args.embedding_id, model_fn, batch_size=args.batch_size)
+
+        counts = {"pages": 0, "cells": 0, "generated": 0}
+        lock = threading.Lock()
+
+        def load(specs):
+            return cut_group([(name, loader()) for name, loader in specs], layout)
+
+        def generate(group):
+            return generate_group(group, generate_fn, args.batch_size, args.image_size)
+
+        def write(group):
+            composite_group(group, layout, lambda name, page: Image.fromarray(page).save(
+                os.path.join(args.save_dir, "%s.png" % name)))
+            with lock:
+                counts["pages"]     += len(group["pages"])
+                counts["cells"]     += sum(len(cells) for _, _, cells in group["pages"])
+                counts["generated"] += len(group["generated"])
+
+        stages = [Stage("load", load, workers=args.loader_threads),
+                  Stage("model", generate, workers=1),
+                  Stage("write", write, workers=args.writer_threads)]
+        stats = run_pipeline(group_pages(page_sources(layout), args.pages_per_group), stages)
+
+    print_report(stats)
+    if glyph_cache is not None:
+        glyph_cache.close()
+        print("glyph cache: %s" % json.dumps(glyph_cache.stats(), sort_keys=True))
+    print("%d pages, %d glyph cells, %d generated (%.1f%%), %.2f pages/sec" %
+          (counts["pages"], counts["cells"], counts["generated"],
+           100.0 * counts["generated"] / max(counts["cells"], 1), counts["pages"] / stats["seconds"]))
+
+
+if __name__ == '__main__':
+    tf.app.run()
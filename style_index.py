@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import time
+
+import tensorflow as tf
+
+from model.style_index import StyleIndex, GlyphStyleEncoder, build_index
+from model.cpu_profile import load_profile, session_config
+from model.utils import list_glyphs, load_glyphs
+
+parser = argparse.ArgumentParser(description='Build and query an index of the styles of a trained model')
+parser.add_argument('--mode', dest='mode', type=str, default='query',
+                    help='build: index the styles of model_dir, query: nearest styles, redundant: similar pairs')
+parser.add_argument('--index_dir', dest='index_dir', required=True, help='directory of the style index')
+parser.add_argument('--model_dir', dest='model_dir', type=str, default=None,
+                    help='checkpoint directory of the trained model, to build the index or encode glyph sets')
+parser.add_argument('--kind', dest='kind', type=str, default='embedding',
+                    help='style vectors to index, embedding or discriminator')
+parser.add_argument('--embedding_ids', dest='embedding_ids', type=str, default=None,
+                    help='query the styles closest to these indexed styles, separate by comma')
+parser.add_argument('--query_dirs', dest='query_dirs', type=str, default=None,
+                    help='query the styles closest to glyph sets, one directory of glyph images per set, '
+                         'separate by comma, needs a discriminator index')
+parser.add_argument('--top_k', dest='top_k', type=int, default=5, help='number of styles returned per query')
+parser.add_argument('--threshold', dest='threshold', type=float, default=0.95,
+                    help='cosine similarity from which two styles are reported redundant')
+parser.add_argument('--image_size', dest='image_size', type=int, default=64,
+                    help="size of your input and output image")
+parser.add_argument('--base_size', dest='base_size', type=int, default=None,
+                    help='first stage image size if the model was trained progressively')
+parser.add_argument('--discriminator_dim', dest='discriminator_dim', type=int, default=64,
+                    help='filters of the first discriminator layer')
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=None,
+                    help='number of examples in batch, default to the cpu profile or 16')
+parser.add_argument('--cpu_profile', dest='cpu_profile', type=str, default=None,
+                    help='cpu profile tuned by benchmark.py --mode=autotune')
+args = parser.parse_args()
+profile = load_profile(args.cpu_profile, "infer")
+if args.batch_size is None:
+    args.batch_size = profile["batch_size"]
+
+
+def print_results(queries, ids, scores):
+    for query, row, row_scores in zip(queries, ids, scores):
+        print("%s: %s" % (query, ", ".join("%d (%.3f)" % (i, s) for i, s in zip(row, row_scores))))
+
+
+def main(_):
+    if args.mode == "build":
+        index = build_index(args.model_dir, kind=args.kind)
+        index.save(args.index_dir)
+        print("indexed %d styles of %d dimensions from %s" % (len(index), index.vectors.shape[1], index.version))
+        return
+
+    index = StyleIndex.load(args.index_dir)
+    if args.mode == "redundant":
+        for first, second, score in index.redundant(args.threshold):
+            print("%d %d %.4f" % (first, second, score))
+    elif args.mode == "query" and args.embedding_ids:
+        ids = [int(i) for i in args.embedding_ids.split(",")]
+        start_time = time.time()
+        results = index.neighbors(ids, k=args.top_k)
+        passed = time.time() - start_time
+        print_results(ids, [r[0] for r in results], [r[1] for r in results])
+        print("%d queries over %d styles in %.2f ms" % (len(ids), len(index), passed * 1000))
+    elif args.mode == "query" and args.query_dirs:
+        if index.kind != "discriminator":
+            raise Exception("glyph sets are queried in a discriminator index, %s is a %s index" %
+                            (args.index_dir, index.kind))
+        query_dirs = args.query_dirs.split(",")
+        glyph_sets = [load_glyphs(list_glyphs(d), args.image_size)[1] for d in query_dirs]
+        encoder = GlyphStyleEncoder(args.model_dir, batch_size=args.batch_size, image_size=args.image_size,
+                                    config=session_config(profile), base_width=args.base_size,
+                                    discriminator_dim=args.discriminator_dim)
+        if encoder.version != index.version:
+            print("index built from %s, encoding with %s" % (index.version, encoder.version))
+        start_time = time.time()
+        queries = encoder.encode(glyph_sets)
+        encoded = time.time()
+        ids, scores = index.search(queries, k=args.top_k)
+        searched = time.time()
+        encoder.close()
+        print_results(query_dirs, ids, scores)
+        print("encoded %d glyph sets in %.2f ms, searched %d styles in %.2f ms" %
+              (len(query_dirs), (encoded - start_time) * 1000, len(index), (searched - encoded) * 1000))
+    else:
+        raise Exception("unknown mode %s, or no --embedding_ids/--query_dirs to query" % args.mode)
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+
+import tensorflow as tf
+
+from model.sweep import Sweep, parse_trials
+from model.cpu_profile import load_profile, session_config
+
+parser = argparse.ArgumentParser(description='Train several configurations in one process on one data pipeline')
+parser.add_argument('--experiment_dir', dest='experiment_dir', required=True,
+                    help='experiment directory, every trial checkpoints under it with its own experiment id')
+parser.add_argument('--experiment_id', dest='experiment_id', type=int, default=0,
+                    help='experiment id of the first trial, the following ones count up from it')
+parser.add_argument('--trials', dest='trials', required=True,
+                    help='trials separated by semicolon, each one options like L1_penalty=50,embedding_dim=128, '
+                         'or a json file with a list of them')
+parser.add_argument('--image_size', dest='image_size', type=int, default=64,
+                    help="size of your input and output image")
+parser.add_argument('--L1_penalty', dest='L1_penalty', type=int, default=100, help='weight for L1 loss')
+parser.add_argument('--Lconst_penalty', dest='Lconst_penalty', type=int, default=15, help='weight for const loss')
+parser.add_argument('--Lcategory_penalty', dest='Lcategory_penalty', type=float, default=1.0,
+                    help='weight for category loss')
+parser.add_argument('--Lvgg_penalty', dest='Lvgg_penalty', type=float, default=0.1, help='weight for vgg loss')
+parser.add_argument('--embedding_num', dest='embedding_num', type=int, default=2,
+                    help="number for distinct embeddings")
+parser.add_argument('--embedding_dim', dest='embedding_dim', type=int, default=64, help="dimension for embedding")
+parser.add_argument('--inst_norm', dest='inst_norm', type=int, default=0,
+                    help='use conditional instance normalization in your model')
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=None,
+                    help='number of examples in batch, default to the cpu profile or 16')
+parser.add_argument('--lr', dest='lr', type=float, default=0.0002, help='learning rate for adam')
+parser.add_argument('--max_steps', dest='max_steps', type=int, default=10000, help='number of training steps')
+parser.add_argument('--checkpoint_steps', dest='checkpoint_steps', type=int, default=1000,
+                    help='number of steps in between two checkpoints')
+parser.add_argument('--resume', dest='resume', type=int, default=1, help='resume the trials from their checkpoints')
+parser.add_argument('--cpu_profile', dest='cpu_profile', type=str, default=None,
+                    help='cpu profile tuned by benchmark.py --mode=autotune')
+args = parser.parse_args()
+profile = load_profile(args.cpu_profile, "train")
+if args.batch_size is None:
+    args.batch_size = profile["batch_size"]
+
+
+def main(_):
+    trials = parse_trials(args.trials)
+    with tf.Session(config=session_config(profile)) as sess:
+        sweep = Sweep(args.experiment_dir, trials, experiment_id=args.experiment_id, batch_size=args.batch_size,
+                      image_size=args.image_size, embedding_num=args.embedding_num, inst_norm=args.inst_norm,
+                      reader_threads=profile["reader_threads"], L1_penalty=args.L1_penalty,
+                      Lconst_penalty=args.Lconst_penalty, Lcategory_penalty=args.Lcategory_penalty,
+                      Lvgg_penalty=args.Lvgg_penalty, embedding_dim=args.embedding_dim)
+        results = sweep.train(sess, lr=args.lr, steps=args.max_steps, checkpoint_steps=args.checkpoint_steps,
+                              resume=args.resume)
+    # ranked by the unweighted L1, l1_loss is scaled by the L1_penalty of the trial
+    for result in results:
+        print("%s (experiment %d) %s: %s" % (result["trial"], result["experiment_id"], result["options"],
+                                             ", ".join("%s %.4f" % kv for kv in sorted(result["losses"].items()))))
+
+
+if __name__ == '__main__':
+    tf.app.run()
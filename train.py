@@ -4,8 +4,15 @@ from __future__ import absolute_import
 
 import tensorflow as tf
 import argparse
+import os
+import re
+import subprocess
+import sys
 
 from model.gegan import GEGAN
+from model.parallel import run_workers
+from model.cpu_profile import load_profile, session_config
+from model.phases import parse_rules
 
 parser = argparse.ArgumentParser(description='Train')
 parser.add_argument('--experiment_dir', dest='experiment_dir', required=True,
@@ -23,37 +30,208 @@ parser.add_argument('--embedding_num', dest='embedding_num', type=int, default=2
                     help="number for distinct embeddings")
 parser.add_argument('--embedding_dim', dest='embedding_dim', type=int, default=64, help="dimension for embedding")
 parser.add_argument('--epoch', dest='epoch', type=int, default=100, help='number of epoch')
-parser.add_argument('--batch_size', dest='batch_size', type=int, default=16, help='number of examples in batch')
+parser.add_argument('--batch_size', dest='batch_size', type=int, default=None,
+                    help='number of examples in batch, default to the cpu profile or 16')
 parser.add_argument('--lr', dest='lr', type=float, default=0.001, help='initial learning rate for adam')
 parser.add_argument('--schedule', dest='schedule', type=int, default=10, help='number of epochs to half learning rate')
 parser.add_argument('--resume', dest='resume', type=int, default=1, help='resume from previous training')
 parser.add_argument('--freeze_encoder', dest='freeze_encoder', type=int, default=0,
                     help="freeze encoder weights during training")
 parser.add_argument('--fine_tune', dest='fine_tune', type=str, default=None,
-                    help='specific labels id to be fine tuned')
+                    help='specific labels id to be fine tuned, separated by comma')
+parser.add_argument('--flip_labels', dest='flip_labels', type=int, default=0,
+                    help='label shuffling, the complementary generator pass gets shuffled labels')
+parser.add_argument('--phases', dest='phases', type=str, default=None,
+                    help='plateau rules loss:action[:patience[:below]] separated by comma, actions are '
+                         'flip_labels, decay_lr, freeze_encoder and stop')
+parser.add_argument('--plateau_delta', dest='plateau_delta', type=float, default=0.01,
+                    help='relative improvement of a smoothed loss that resets its plateau')
+parser.add_argument('--plateau_warmup', dest='plateau_warmup', type=int, default=1000,
+                    help='number of steps before any phase switch')
+parser.add_argument('--sampling', dest='sampling', type=str, default='uniform',
+                    help='uniform, or priority to draw the examples in proportion to their recent L1 and const losses')
+parser.add_argument('--priority_alpha', dest='priority_alpha', type=float, default=1.0,
+                    help='exponent of the priorities, lower flattens the sampling')
+parser.add_argument('--priority_beta', dest='priority_beta', type=float, default=0.5,
+                    help='strength of the importance weight correction, 1 removes the sampling bias')
+parser.add_argument('--priority_floor', dest='priority_floor', type=float, default=0.1,
+                    help='lowest priority of an example as a fraction of the mean')
+parser.add_argument('--precision', dest='precision', type=str, default='float32',
+                    help='float32, or bfloat16 convolutions and vgg with float32 weights, statistics and losses')
+parser.add_argument('--loss_scale', dest='loss_scale', type=float, default=1.0,
+                    help='scale of the losses before backprop, for gradients underflowing in bfloat16')
+parser.add_argument('--preview_factor', dest='preview_factor', type=int, default=None,
+                    help='also train a preview head at image_size / preview_factor, e.g. 4, see model/preview.py')
 parser.add_argument('--inst_norm', dest='inst_norm', type=int, default=0,
                     help='use conditional instance normalization in your model')
 parser.add_argument('--sample_steps', dest='sample_steps', type=int, default=10,
                     help='number of batches in between two samples are drawn from validation set')
 parser.add_argument('--checkpoint_steps', dest='checkpoint_steps', type=int, default=500,
                     help='number of batches in between two checkpoints')
+parser.add_argument('--num_workers', dest='num_workers', type=int, default=1,
+                    help='number of data parallel worker processes, batch_size is per worker')
+parser.add_argument('--accumulate_steps', dest='accumulate_steps', type=int, default=1,
+                    help='number of micro batches whose gradients are accumulated before each update')
+parser.add_argument('--bn_mode', dest='bn_mode', type=str, default='micro',
+                    help='batch norm while accumulating: micro (per micro batch statistics) '
+                         'or moving (frozen, resumed runs only)')
+parser.add_argument('--recompute', dest='recompute', type=str, default=None,
+                    help='blocks recomputed during backprop to save memory, separate by comma: '
+                         'encoder, decoder, vgg or single layers like e3,d1')
+parser.add_argument('--max_steps', dest='max_steps', type=int, default=100000, help='number of training steps')
+parser.add_argument('--progressive', dest='progressive', type=str, default=None,
+                    help='progressive training stages as size:steps[:batch_size], separate by comma, '
+                         'e.g. 64:20000,128:20000,256:40000:8')
+parser.add_argument('--fade_steps', dest='fade_steps', type=int, default=2000,
+                    help='steps to fade in the layers grown by each progressive stage')
+parser.add_argument('--cpu_profile', dest='cpu_profile', type=str, default=None,
+                    help='cpu profile tuned by benchmark.py --mode=autotune')
+parser.add_argument('--eval_dir', dest='eval_dir', type=str, default=None,
+                    help='held-out images under eval_dir/<embedding id>/, evaluated by a separate process')
+parser.add_argument('--eval_batch_size', dest='eval_batch_size', type=int, default=128,
+                    help='number of examples in evaluation batch')
+parser.add_argument('--graph_cache', dest='graph_cache', type=int, default=1,
+                    help='export the training graph next to the checkpoint and import it on restart')
 args = parser.parse_args()
+profile = load_profile(args.cpu_profile, "train")
+fine_tune = None
+if args.fine_tune:
+    fine_tune = [int(i) for i in args.fine_tune.split(",")]
+phases = parse_rules(args.phases) if args.phases else None
 
 
-def main(_):
-    config = tf.ConfigProto()
-    config.gpu_options.allow_growth = True
-
-    with tf.Session(config=config) as sess:
-        model = GEGAN(args.experiment_dir, batch_size=args.batch_size, experiment_id=args.experiment_id,
-                     input_width=args.image_size, output_width=args.image_size, embedding_num=args.embedding_num,
-                     embedding_dim=args.embedding_dim, L1_penalty=args.L1_penalty, Lconst_penalty=args.Lconst_penalty,
-                     Ltv_penalty=args.Ltv_penalty, Lcategory_penalty=args.Lcategory_penalty)
+def resumed_batch_size(default):
+    """
+    Batch size of the checkpoints of this experiment, default if there are
+    none or default is one of them. The batch size is part of the model dir,
+    resuming with another one would start a new run
+    """
+    checkpoint_dir = os.path.join(args.experiment_dir, "checkpoint")
+    if not os.path.isdir(checkpoint_dir):
+        return default
+    pattern = re.compile(r"^experiment_%d_batch_(\d+)(_|$)" % args.experiment_id)
+    batch_sizes = set()
+    for name in os.listdir(checkpoint_dir):
+        match = pattern.match(name)
+        if match and tf.train.get_checkpoint_state(os.path.join(checkpoint_dir, name)):
+            batch_sizes.add(int(match.group(1)))
+    if not batch_sizes or default in batch_sizes:
+        return default
+    if len(batch_sizes) > 1:
+        raise Exception("checkpoints of experiment %d with batch sizes %s, give --batch_size to pick one" %
+                        (args.experiment_id, ",".join(str(b) for b in sorted(batch_sizes))))
+    batch_size = batch_sizes.pop()
+    print("resuming experiment %d with its batch size %d instead of %d" % (args.experiment_id, batch_size, default))
+    return batch_size
+
+
+if args.batch_size is None:
+    # the profile batch size is only for new runs
+    args.batch_size = resumed_batch_size(profile["batch_size"]) if args.resume else profile["batch_size"]
+
+
+def parse_stages(spec):
+    stages = list()
+    for stage in spec.split(","):
+        fields = [int(f) for f in stage.split(":")]
+        size, steps = fields[0], fields[1]
+        batch_size = fields[2] if len(fields) > 2 else args.batch_size
+        stages.append((size, steps, batch_size))
+    return stages
+
+
+def stage_model(image_size, base_size, batch_size):
+    return GEGAN(args.experiment_dir, batch_size=batch_size, experiment_id=args.experiment_id,
+                 input_width=image_size, output_width=image_size, base_width=base_size,
+                 embedding_num=args.embedding_num, embedding_dim=args.embedding_dim, L1_penalty=args.L1_penalty,
+                 Lconst_penalty=args.Lconst_penalty, Lcategory_penalty=args.Lcategory_penalty,
+                 recompute=args.recompute, precision=args.precision, loss_scale=args.loss_scale,
+                 preview_factor=args.preview_factor)
+
+
+def stage_done(model_dir, steps):
+    """
+    Whether the stage saved the checkpoint of its last step
+    """
+    ckpt = tf.train.get_checkpoint_state(model_dir)
+    return bool(ckpt) and int(ckpt.model_checkpoint_path.rsplit("-", 1)[1]) >= steps - 1
+
+
+def train_stage(reducer, image_size, base_size, batch_size, max_steps, init_dir=None):
+    config = session_config(profile, num_processes=args.num_workers)
+
+    # every stage has its own graph, the shapes depend on the image size
+    with tf.Graph().as_default(), tf.Session(config=config) as sess:
+        model = stage_model(image_size, base_size, batch_size)
         model.register_session(sess)
-        model.build_model(is_training=True, inst_norm=args.inst_norm)
-        model.train(lr=args.lr, epoch=args.epoch, resume=args.resume,
-                    schedule=args.schedule, freeze_encoder=args.freeze_encoder,
-                    sample_steps=args.sample_steps, checkpoint_steps=args.checkpoint_steps)
+        model.build_train_graph(inst_norm=args.inst_norm, freeze_encoder=args.freeze_encoder, reducer=reducer,
+                                reader_threads=profile["reader_threads"], accumulate_steps=args.accumulate_steps,
+                                fine_tune=fine_tune, sampling=args.sampling, graph_cache=args.graph_cache)
+        stats = model.train(lr=args.lr, epoch=args.epoch, resume=args.resume,
+                            schedule=args.schedule, freeze_encoder=args.freeze_encoder,
+                            flip_labels=args.flip_labels, fine_tune=fine_tune, phases=phases,
+                            plateau_delta=args.plateau_delta, plateau_warmup=args.plateau_warmup,
+                            sampling=args.sampling, priority={"alpha": args.priority_alpha,
+                                                              "beta": args.priority_beta,
+                                                              "floor": args.priority_floor},
+                            sample_steps=args.sample_steps, checkpoint_steps=args.checkpoint_steps,
+                            max_steps=max_steps, reducer=reducer, reader_threads=profile["reader_threads"],
+                            accumulate_steps=args.accumulate_steps, bn_mode=args.bn_mode,
+                            init_dir=init_dir, fade_steps=args.fade_steps)
+        _, model_dir = model.get_model_id_and_dir()
+        return stats, model_dir
+
+
+def train_worker(reducer=None):
+    if not args.progressive:
+        return train_stage(reducer, args.image_size, args.image_size, args.batch_size, args.max_steps)[0]
+
+    # start at a low resolution, every following stage grows the model
+    # and is initialized with the weights of the previous one
+    stages = parse_stages(args.progressive)
+    base_size = stages[0][0]
+    init_dir = None
+    stats = None
+    for image_size, steps, batch_size in stages:
+        _, model_dir = stage_model(image_size, base_size, batch_size).get_model_id_and_dir()
+        if args.resume and stage_done(model_dir, steps):
+            print("progressive stage: size %d already trained in %s" % (image_size, model_dir))
+            init_dir = model_dir
+            continue
+        print("progressive stage: size %d, %d steps, batch size %d" % (image_size, steps, batch_size))
+        stats, init_dir = train_stage(reducer, image_size, base_size, batch_size, steps, init_dir)
+    return stats
+
+
+def start_evaluator():
+    """
+    Evaluate the checkpoints in a separate process, it exits after the
+    trainer (this process) is gone
+    """
+    image_size, base_size, batch_size = args.image_size, args.image_size, args.batch_size
+    if args.progressive:
+        # the checkpoints of the last stage
+        stages = parse_stages(args.progressive)
+        image_size, _, batch_size = stages[-1]
+        base_size = stages[0][0]
+    evaluate = os.path.join(os.path.dirname(os.path.abspath(__file__)), "evaluate.py")
+    cmd = [sys.executable, evaluate, "--experiment_dir=%s" % args.experiment_dir,
+           "--experiment_id=%d" % args.experiment_id, "--batch_size=%d" % batch_size,
+           "--eval_dir=%s" % args.eval_dir, "--eval_batch_size=%d" % args.eval_batch_size,
+           "--image_size=%d" % image_size, "--base_size=%d" % base_size,
+           "--embedding_num=%d" % args.embedding_num, "--embedding_dim=%d" % args.embedding_dim,
+           "--inst_norm=%d" % args.inst_norm, "--watch_pid=%d" % os.getpid()]
+    return subprocess.Popen(cmd)
+
+
+def main(_):
+    if args.eval_dir:
+        start_evaluator()
+    if args.num_workers > 1:
+        # workers have to be forked before any session is created
+        run_workers(args.num_workers, train_worker)
+    else:
+        train_worker()
 
 
 if __name__ == '__main__':